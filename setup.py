@@ -29,6 +29,7 @@ setup(name='aCT',
             'actbootstrap = act.common.aCTBootstrap:main',
             'actmain = act.common.aCTMain:main',
             'actreport = act.common.aCTReport:main',
+            'actdbmigrate = act.common.aCTDBMigrate:main',
             'actcriticalmonitor = act.common.aCTCriticalMonitor:main',
             'actheartbeatwatchdog = act.atlas.aCTHeartbeatWatchdog:main',
             'actldmxadmin = act.ldmx.aCTLDMXAdmin:main',
@@ -0,0 +1,76 @@
+# aCTCheckSchedule.py
+#
+# Time of the next status check of ARC jobs
+#
+import arc
+
+class aCTCheckSchedule:
+    '''
+    Computes when each job of a cluster should next be checked, instead of
+    checking all jobs every jobs/checkinterval.
+
+    For each arcstate the rate at which jobs leave the state is measured from
+    the checks made on this cluster. A job is checked again after
+    jobs/checkfraction of the mean time jobs spend in its state, but never
+    later than the time it has already spent in the state, so jobs which just
+    changed state are checked often and the interval grows as they age.
+    Running jobs are checked more often as they approach their requested
+    walltime, when many of them finish. Intervals are between
+    jobs/checkinterval and jobs/checkmaxinterval, which should be a few
+    minutes since it bounds how long a finished job waits to be noticed.
+    States not in adaptivestates, e.g. finishing, and states with too few
+    observations are checked every jobs/checkinterval.
+    '''
+
+    adaptivestates = ('submitted', 'running', 'holding')
+
+    def __init__(self, log, conf):
+        self.log = log
+        self.conf = conf
+        # arcstate: [seconds observed in the state, jobs which left it],
+        # decayed so that recent checks dominate
+        self.observed = {}
+
+    def observe(self, arcstate, elapsed, changed):
+        '''
+        Record a check of a job in arcstate last checked elapsed seconds ago,
+        which changed state or not
+        '''
+        decay = 0.999
+        obs = self.observed.setdefault(arcstate, [0.0, 0.0])
+        obs[0] = obs[0] * decay + max(elapsed, 0)
+        obs[1] = obs[1] * decay + (1 if changed else 0)
+
+    def rate(self, arcstate):
+        '''Rate per second of jobs leaving arcstate, None if unknown'''
+        seconds, changes = self.observed.get(arcstate, (0, 0))
+        if seconds < 100 * int(self.conf.get(['jobs', 'checkinterval'])):
+            return None
+        # assume at least one change to stay on the safe side
+        return max(changes, 1.0) / seconds
+
+    def interval(self, arcstate, timeinstate, job=None):
+        '''
+        Seconds until the next check of job, a job in arcstate for
+        timeinstate seconds
+        '''
+        base = int(self.conf.get(['jobs', 'checkinterval']))
+        maxinterval = int(self.conf.get(['jobs', 'checkmaxinterval']) or base)
+        rate = self.rate(arcstate)
+        if arcstate not in self.adaptivestates or maxinterval <= base or rate is None:
+            return base
+
+        interval = min(float(self.conf.get(['jobs', 'checkfraction']) or 0.1) / rate, timeinstate)
+        if arcstate == 'running' and job is not None:
+            walltime = job.RequestedTotalWallTime.GetPeriod()
+            # Walltime reported by ARC 6 is multiplied by cores
+            if arc.ARC_VERSION_MAJOR >= 6 and job.RequestedSlots > 0:
+                walltime //= job.RequestedSlots
+            if walltime > 0:
+                # halve the interval to the walltime at each check
+                interval = min(interval, (walltime - timeinstate) / 2)
+        return int(min(max(interval, base), maxinterval))
+
+    def summary(self):
+        '''Return a string of the mean time in each measured state'''
+        return ', '.join(['%s: %ds' % (state, 1 / self.rate(state)) for state in sorted(self.observed) if self.rate(state)])
@@ -3,34 +3,70 @@
 # Cleans jobs from CE and ARC DB
 #
 
+import functools
 import arc
 
 from act.common.aCTProcess import aCTProcess
+from act.common import aCTStats
+from act.arc.aCTFetcher import removeManifest
+from act.db.aCTDBQuery import aCTDBQuery
 
 class aCTCleaner(aCTProcess):
 
-    def processToClean(self):
+    notifystates = {'arcjobs': ('toclean',)}
+
+    def __init__(self, cluster=None, pool=None):
+        aCTProcess.__init__(self, cluster, pool)
+        # Jobs are read jobs/cleanbatch at a time and cleaned on the CE in
+        # chunks of jobs/cleanchunk in a pool of jobs/cleanthreads threads.
+        # Chunks taking longer than jobs/cleantimeout seconds are abandoned.
+        self.batch = int(self.conf.get(['jobs', 'cleanbatch']) or 1000)
+        self.chunk = int(self.conf.get(['jobs', 'cleanchunk']) or 200)
+        self.timeout = int(self.conf.get(['jobs', 'cleantimeout']) or 300)
+        self.pool = self.workerPool(int(self.conf.get(['jobs', 'cleanthreads']) or 4), self.timeout, 'cleaner')
 
-        jobstoclean = self.db.getArcJobs("arcstate='toclean' and cluster='"+self.cluster+"' limit 100")
+    def close(self):
+        self.closePool(self.pool)
+        aCTProcess.close(self)
 
-        if not jobstoclean:
-            return
+    def cleanChunk(self, proxystring, jobs):
+        '''
+        Clean jobs, a list of (id, appjobid, arc.Job, created), on the CE with
+        the credential proxystring and return the IDs not cleaned. Runs in the
+        worker pool.
+        '''
+        job_supervisor = aCTStats.instrument(arc.JobSupervisor(self.userConfig(proxystring), [j[2] for j in jobs]), 'arc')
+        job_supervisor.Update()
+        job_supervisor.Clean()
+        return set(job_supervisor.GetIDsNotProcessed())
 
-        self.log.info("Cleaning %d jobs" % sum(len(v) for v in jobstoclean.values()))
-        for proxyid, jobs in jobstoclean.items():
-            self.uc.CredentialString(str(self.db.getProxy(proxyid)))
+    def processToClean(self):
 
-            job_supervisor = arc.JobSupervisor(self.uc, [j[2] for j in jobs])
-            job_supervisor.Update()
-            job_supervisor.Clean()
+        select = aCTDBQuery().eq('arcstate', 'toclean').eq('cluster', self.cluster)
+        for jobstoclean in self.db.iterArcJobs(select, self.db.jobcontrolattrs, batch=self.batch):
+            self.log.info("Cleaning %d jobs" % sum(len(v) for v in jobstoclean.values()))
+            todelete = []
+            for proxyid, jobs in jobstoclean.items():
+                clean = functools.partial(self.cleanChunk, str(self.db.getProxy(proxyid)))
 
-            notcleaned = job_supervisor.GetIDsNotProcessed()
+                for chunk, f in self.pool.mapChunks(clean, jobs, self.chunk, self.timeout):
+                    try:
+                        notcleaned = f.result()
+                    except Exception as e:
+                        # left in toclean to try again next time
+                        self.log.warning("Failed to clean %d jobs of proxy %s: %s" % (len(chunk), proxyid, str(e)))
+                        continue
 
-            for (id, appjobid, job, created) in jobs:
-                if job.JobID in notcleaned:
-                    self.log.error("%s: Could not clean job %s" % (appjobid, job.JobID))
+                    for (id, appjobid, job, created) in chunk:
+                        if job.JobID in notcleaned:
+                            self.log.error("%s: Could not clean job %s" % (appjobid, job.JobID))
+                        # left by a fetch interrupted before the job was cleaned
+                        removeManifest(self.tmpdir, job.JobID)
+                        todelete.append(id)
 
-                self.db.deleteArcJob(id)
+            self.db.deleteArcJobs(todelete)
+            if self.pastDeadline():
+                return
 
     def process(self):
 
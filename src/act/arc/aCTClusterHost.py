@@ -0,0 +1,170 @@
+# aCTClusterHost.py
+#
+# Runs the status, fetcher and cleaner agents of many ARC clusters in one
+# process
+#
+import hashlib
+import os
+import sys
+import time
+import traceback
+
+from act.common import aCTConfig
+from act.common import aCTLogger
+from act.common import aCTSignal
+from act.common import aCTStats
+from act.common.aCTWorkerPool import aCTWorkerPool
+from act.arc.aCTDBArc import aCTDBArc
+from act.arc.aCTStatus import aCTStatus
+from act.arc.aCTFetcher import aCTFetcher
+from act.arc.aCTCleaner import aCTCleaner
+
+
+def hostIndex(cluster, nhosts):
+    '''Return the index of the host serving cluster, stable across processes'''
+    return int(hashlib.md5(cluster.encode()).hexdigest(), 16) % nhosts
+
+
+class aCTClusterHost:
+    '''
+    Hosts aCTStatus, aCTFetcher and aCTCleaner agents for the active ARC
+    clusters assigned to it, instead of one process per agent and cluster.
+    Enabled by hosting/enabled in the config, aCTProcessManager then starts
+    hosting/processes hosts, each given its index on the command line.
+    Clusters are spread over hosts by a hash of their name.
+
+    Agents share the DB connection of the process and a pool of
+    hosting/threads worker threads, and are run one after the other. An
+    exception in an agent is logged and the agent is created again after a
+    pause, without affecting other clusters. Each step of an agent has a
+    deadline of hosting/steptimeout seconds after which it stops starting new
+    work, and an agent exceeding it anyway is skipped for as long as it took,
+    so a slow cluster cannot starve the others. Agents backing off from a
+    failing cluster set a holdoff time until which they are not run.
+    '''
+
+    agentclasses = (aCTStatus, aCTFetcher, aCTCleaner)
+
+    def __init__(self, index):
+        self.index = index
+        self.name = 'aCTClusterHost-%d' % index
+        self.logger = aCTLogger.aCTLogger(self.name)
+        self.log = self.logger()
+        self.criticallogger = aCTLogger.aCTLogger('aCTCritical', arclog=False)
+        self.criticallog = self.criticallogger()
+
+        self.conf = aCTConfig.aCTConfigARC()
+        self.db = aCTDBArc(self.log)
+        # tasks of all agents, each submitted with the agent's own timeout
+        self.pool = aCTWorkerPool(self.log, int(self.conf.get(['hosting', 'threads']) or 8), name='clusterhost')
+        # cluster: list of agents in the order of agentclasses, None for
+        # agents to create on their next run
+        self.agents = {}
+        # (cluster, agent index): time before which the agent is not run
+        self.holdoff = {}
+        self.tclusters = 0
+        self.log.info("Started %s", self.name)
+
+    def updateClusters(self):
+        '''Add agents for new clusters of this host and remove old ones'''
+        nhosts = int(self.conf.get(['hosting', 'processes']) or 1)
+        clusters = set(c['cluster'] for c in self.db.getActiveClusters() if c['cluster'])
+        mine = set(c for c in clusters if hostIndex(c, nhosts) == self.index)
+        for cluster in set(self.agents) - mine:
+            self.log.info("Stopping agents for %s", cluster)
+            for i in range(len(self.agentclasses)):
+                self.closeAgent(cluster, i)
+            del self.agents[cluster]
+        for cluster in mine - set(self.agents):
+            self.log.info("Starting agents for %s", cluster)
+            self.agents[cluster] = [None] * len(self.agentclasses)
+
+    def closeAgent(self, cluster, i):
+        agent = self.agents[cluster][i]
+        self.agents[cluster][i] = None
+        if agent:
+            try:
+                agent.close()
+            except Exception as e:
+                self.log.warning("%s: failed to close %s: %s", cluster, agent.name, str(e))
+
+    def runAgent(self, cluster, i):
+        '''Run one loop of agent i of cluster, creating it if necessary'''
+        agent = self.agents[cluster][i]
+        name = self.agentclasses[i].__name__
+        steptimeout = int(self.conf.get(['hosting', 'steptimeout']) or 600)
+        try:
+            if not agent:
+                agent = self.agentclasses[i](cluster, self.pool)
+                self.agents[cluster][i] = agent
+            aCTStats.activate(agent.stats)
+            agent.deadline = time.time() + steptimeout
+            duration = agent.processLoop()
+        except aCTSignal.ExceptInterrupt:
+            raise
+        except:
+            self.log.critical("%s: unexpected exception in %s, restarting it in 60s", cluster, name)
+            self.log.critical(traceback.format_exc())
+            self.criticallog.critical("%s %s: %s", name, cluster, traceback.format_exc())
+            self.closeAgent(cluster, i)
+            self.holdoff[(cluster, i)] = time.time() + 60
+            return
+
+        if duration > steptimeout:
+            self.log.warning("%s: %s took %ds, skipping it for as long", cluster, name, duration)
+            self.holdoff[(cluster, i)] = time.time() + duration
+        if agent.holdoff > time.time():
+            self.holdoff[(cluster, i)] = max(self.holdoff.get((cluster, i), 0), agent.holdoff)
+        # restart periodically to release ARC resources, as separate processes do
+        ip = int(self.conf.get(['periodicrestart', name.lower()]) or 0)
+        if ip and time.time() - agent.starttime > ip:
+            self.log.info("%s: periodic restart of %s", cluster, name)
+            self.closeAgent(cluster, i)
+
+    def run(self):
+        '''
+        Main loop
+        '''
+        try:
+            while 1:
+                self.conf.parse()
+                if time.time() - self.tclusters > 60:
+                    self.updateClusters()
+                    self.tclusters = time.time()
+                looptime = time.time()
+                downtime = self.conf.getList(['downtime', 'item'])
+                for cluster in list(self.agents):
+                    if cluster in downtime:
+                        continue
+                    for i in range(len(self.agentclasses)):
+                        if self.holdoff.get((cluster, i), 0) > time.time():
+                            continue
+                        self.holdoff.pop((cluster, i), None)
+                        self.runAgent(cluster, i)
+                # same pace as standalone agents when there is little to do
+                time.sleep(max(0, looptime + 5 - time.time()))
+        except aCTSignal.ExceptInterrupt as x:
+            self.log.info("Received interrupt %s, exiting", str(x))
+        except:
+            self.log.critical("*** Unexpected exception! ***")
+            self.log.critical(traceback.format_exc())
+            self.log.critical("*** Process exiting ***")
+            self.criticallog.critical(traceback.format_exc())
+
+    def finish(self):
+        '''
+        Clean up code when process exits
+        '''
+        for cluster in self.agents:
+            for i in range(len(self.agentclasses)):
+                self.closeAgent(cluster, i)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.db.close()
+        self.log.info("Cleanup for %s", self.name)
+        os._exit(0)
+
+
+if __name__ == '__main__':
+    host = aCTClusterHost(int(sys.argv[1]) if len(sys.argv) == 2 else 0)
+    host.run()
+    host.finish()
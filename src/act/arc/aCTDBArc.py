@@ -1,44 +1,53 @@
-import re
 import os
 import arc
 from act.db.aCTDB import aCTDB
+from act.db.aCTDBQuery import aCTDBQuery
+from act.arc import aCTJobCodec
+from act.arc.aCTJobCodec import aCTJobRow
 
 class aCTDBArc(aCTDB):
 
+    indexes = {'arcjobs': {
+                   # status, fetcher, cleaner: jobs of a cluster in a state not checked recently
+                   'arcstate_cluster_tarcstate': ('arcstate', 'cluster', 'tarcstate'),
+                   # status: jobs of a cluster due for their next check
+                   'arcstate_cluster_nextcheck': ('arcstate', 'cluster', 'nextcheck'),
+                   # submitter limits: queued and running jobs per cluster and share
+                   'cluster_arcstate_fairshare': ('cluster', 'arcstate', 'fairshare', 'priority'),
+                   # submitter: jobs to submit per share and proxy
+                   'arcstate_fairshare_proxyid': ('arcstate', 'fairshare', 'proxyid', 'priority'),
+                   # status: jobs stuck too long in a state
+                   'state_tstate': ('State', 'tstate')},
+               'arcjob_clusters': {
+                   'arcjobid': ('arcjobid',)}}
+
+    columns = {'arcjobs': {'claimedby': 'VARCHAR(255)',
+                           'claimexpiry': 'DATETIME NULL',
+                           'nextcheck': 'DATETIME NULL'}}
+
+    counts = {'arcjobs': ('arcjobcounts', {'cluster': 'VARCHAR(255)',
+                                           'fairshare': 'VARCHAR(50)',
+                                           'arcstate': 'VARCHAR(12)'})}
+
     def __init__(self, log):
         aCTDB.__init__(self, log, 'arcjobs')
 
         self.proxydir = self.conf.get(["voms","proxystoredir"])
-
-        # mapping from Job class attribute types to column types
-        self.jobattrmap = {int: 'integer',
-                      str: 'varchar(255)',
-                      arc.JobState: 'varchar(255)',
-                      arc.StringList: 'varchar(1024)',
-                      arc.URL: 'varchar(255)',
-                      arc.Period: 'int',
-                      arc.Time: 'datetime',
-                      arc.StringStringMap: 'varchar(1024)'}
-        ignoremems=['STDIN',
-                    'STDOUT',
-                    'STDERR',
-                    'STAGEINDIR',
-                    'STAGEOUTDIR',
-                    'SESSIONDIR',
-                    'JOBLOG',
-                    'JOBDESCRIPTION',
-                    'JobDescriptionDocument']
-
-        # Attributes of Job class mapped to DB column type
-        self.jobattrs={}
-        j=arc.Job()
-        for i in dir(j):
-            if re.match('^__',i):
-                continue
-            if i in ignoremems:
-                continue
-            if type(getattr(j, i)) in self.jobattrmap:
-                self.jobattrs[i] = type(getattr(j, i))
+        # select jobs by cluster through arcjob_clusters instead of LIKE on
+        # clusterlist, once the table and the triggers filling it exist
+        self.clustermap = 'arcjobs.clustermap' in self.getSchema()
+
+        # conversion between arc.Job and arcjobs columns
+        self.codec = aCTJobCodec.codec()
+        # Attributes of Job class mapped to their type
+        self.jobattrs = self.codec.jobattrs
+        # Attributes JobSupervisor needs to find and manage a job on the CE,
+        # enough for getArcJobs() callers which do not write back the job
+        self.jobcontrolattrs = ('JobID', 'IDFromEndpoint', 'Name', 'LocalIDFromManager', 'DelegationID',
+                                'ServiceInformationURL', 'ServiceInformationInterfaceName',
+                                'JobStatusURL', 'JobStatusInterfaceName',
+                                'JobManagementURL', 'JobManagementInterfaceName',
+                                'StageInDir', 'StageOutDir', 'SessionDir', 'State', 'RestartState')
 
 
     def createTables(self):
@@ -67,9 +76,20 @@ class aCTDBArc(aCTDB):
           - priority: ARC job priority, extracted from the job description
           - fairshare: A string representing a share. Job submission for the same
             cluster will be spread evenly over shares.
+          - claimedby: submitter which claimed the job for submission
+          - claimexpiry: time after which the claim can be taken back
+          - nextcheck: time of the next status check, NULL for checkinterval
+            after tarcstate. Reset when arcstate changes.
         jobdescriptions: job description added by the application engine
           - id: primary key
           - jobdescription: job description text
+        arcjobcounts: number of jobs per cluster, fairshare and arcstate, kept
+        up to date by triggers on arcjobs, see aCTDB.getCounts()
+        arcjob_clusters: one row per cluster in the clusterlist of a job, to
+        select jobs for a cluster without scanning clusterlist with LIKE. Kept
+        in sync with arcjobs by triggers, see createClusterMap()
+          - arcjobid: id in arcjobs
+          - cluster: one entry of clusterlist
         proxies: columns are the following:
           - id:
           - proxy:
@@ -99,7 +119,7 @@ class aCTDBArc(aCTDB):
             appjobid VARCHAR(16),
             priority SMALLINT,
             fairshare VARCHAR(50),
-            """+",".join(['%s %s' % (k, self.jobattrmap[v]) for k, v in self.jobattrs.items()])+")"
+            """+",".join(['%s %s' % (k, v) for k, v in list(self.columns['arcjobs'].items()) + list(self.codec.columnTypes().items())])+")"
 
         # First check if table already exists
         c = self.db.getCursor()
@@ -140,6 +160,17 @@ class aCTDBArc(aCTDB):
             self.log.error("failed create table %s" %x)
             return False
 
+        try:
+            c.execute("drop table arcjob_clusters")
+        except:
+            pass
+        if not self.createClusterMap() or not self.createIndexes():
+            return False
+        if not self.createCounts():
+            self.log.warning("job counts will be made by scanning arcjobs")
+        if not self.recordSchema():
+            return False
+
         # Create proxies table (can be dropped without asking)
         self.log.info("creating proxies table")
         create="""CREATE TABLE proxies (
@@ -164,6 +195,79 @@ class aCTDBArc(aCTDB):
 
         return True
 
+    def detectSchema(self):
+        '''
+        Features of aCTDB.detectSchema() plus "arcjobs.clustermap" if
+        arcjob_clusters and its triggers exist
+        '''
+        features = aCTDB.detectSchema(self)
+        if self.tableExists('arcjob_clusters') and set(self._clusterMapTriggers()) <= self.getTriggers():
+            features.add('arcjobs.clustermap')
+        return features
+
+    def _clusterMapTriggers(self):
+        '''
+        Return {trigger name: definition} keeping arcjob_clusters in sync
+        with the clusterlist of arcjobs, whichever code inserts, updates or
+        deletes jobs
+        '''
+        # insert one row per non-empty entry of NEW.clusterlist
+        fill = "BEGIN DECLARE rest VARCHAR(1024); DECLARE cl VARCHAR(255); SET rest = IFNULL(NEW.clusterlist, ''); " \
+               "WHILE rest != '' DO " \
+               "SET cl = TRIM(SUBSTRING_INDEX(rest, ',', 1)); " \
+               "SET rest = IF(LOCATE(',', rest) > 0, SUBSTRING(rest, LOCATE(',', rest) + 1), ''); " \
+               "IF cl != '' THEN INSERT IGNORE INTO arcjob_clusters (arcjobid, cluster) VALUES (NEW.id, cl); END IF; " \
+               "END WHILE; END"
+        clear = "DELETE FROM arcjob_clusters WHERE arcjobid=OLD.id"
+        return {'arcjobs_clusters_insert': "AFTER INSERT ON arcjobs FOR EACH ROW %s" % fill,
+                'arcjobs_clusters_delete': "AFTER DELETE ON arcjobs FOR EACH ROW %s" % clear,
+                'arcjobs_clusters_update': "AFTER UPDATE ON arcjobs FOR EACH ROW BEGIN IF NOT (OLD.clusterlist <=> NEW.clusterlist) " \
+                                           "THEN %s; %s; END IF; END" % (clear, fill)}
+
+    def createClusterMap(self):
+        '''
+        Create arcjob_clusters table if it doesn't exist with the triggers
+        maintaining it and fill it from the clusterlist of existing jobs.
+        Returns False on failure, in which case jobs are selected with LIKE on
+        clusterlist. Creating triggers needs the privileges described in
+        aCTDB.createCounts().
+        '''
+        self.log.info("creating arcjob_clusters table")
+        create = "CREATE TABLE IF NOT EXISTS arcjob_clusters (" \
+                 "arcjobid INTEGER NOT NULL, " \
+                 "cluster VARCHAR(255) NOT NULL, " \
+                 "PRIMARY KEY (cluster, arcjobid))"
+        c = self.db.getCursor()
+        try:
+            c.execute(create)
+            # triggers first so that jobs inserted while filling are not missed
+            for name, trigger in self._clusterMapTriggers().items():
+                c.execute("DROP TRIGGER IF EXISTS %s" % name)
+                c.execute("CREATE TRIGGER %s %s" % (name, trigger))
+            c.execute("SELECT id, clusterlist FROM arcjobs WHERE clusterlist != ''")
+            rows = [(row['id'], cl) for row in c.fetchall() for cl in self._splitClusterList(row['clusterlist'])]
+            for i in range(0, len(rows), 1000):
+                c.executemany("INSERT IGNORE INTO arcjob_clusters (arcjobid, cluster) VALUES (%s, %s)", rows[i:i+1000])
+            self.Commit()
+        except Exception as x:
+            self.log.error("failed create table %s" %x)
+            return False
+        self.log.info("added %d entries to arcjob_clusters" % len(rows))
+        self.clustermap = True
+        return True
+
+    def _splitClusterList(self, clusterlist):
+        return set(cl.strip() for cl in clusterlist.split(',') if cl.strip())
+
+    def clusterListClause(self, cluster):
+        '''
+        Return (clause, params...) selecting jobs with cluster in their
+        clusterlist, to pass to aCTDBQuery.raw()
+        '''
+        if self.clustermap:
+            return ("id IN (SELECT arcjobid FROM arcjob_clusters WHERE cluster=%s)", cluster)
+        return ("(clusterlist like %s or clusterlist like %s)", '%'+cluster, '%'+cluster+',%')
+
     def insertArcJob(self, job):
         '''
         Add new arc Job object. Only used for testing and recreating db.
@@ -175,7 +279,7 @@ class aCTDBArc(aCTDB):
         c.execute("SELECT LAST_INSERT_ID()")
         jobdescid = c.fetchone()['LAST_INSERT_ID()']
 
-        j = self._job2db(job)
+        j = self.codec.job2db(job)
         c.execute("insert into arcjobs (created,tstate,jobdesc"+",".join(j.keys())+") values ('"+str(self.getTimeStamp())+"','"+str(self.getTimeStamp())+"','"+str(jobdescid)+"','"+"','".join(j.values())+"')")
         c.execute("SELECT LAST_INSERT_ID()")
         row = c.fetchone()
@@ -224,6 +328,8 @@ class aCTDBArc(aCTDB):
         c.execute(s, list(desc.values()))
         c.execute("SELECT LAST_INSERT_ID()")
         row = c.fetchone()
+        # new job may go to any cluster in clusterlist
+        self.notify(state=desc['arcstate'])
         self.Commit()
         return row
 
@@ -231,14 +337,32 @@ class aCTDBArc(aCTDB):
         '''
         Delete job from ARC table.
         '''
+        self.deleteArcJobs([id])
+
+    def deleteArcJobs(self, ids, batch=1000):
+        '''
+        Delete jobs and their job descriptions from ARC tables, batch jobs per
+        statement, and commit once
+        '''
         c=self.db.getCursor()
-        c.execute("select jobdesc from arcjobs where id="+str(id))
-        row = c.fetchone()
-        if row:
-            c.execute("delete from jobdescriptions where id="+str(row['jobdesc']))
-        c.execute("delete from arcjobs where id="+str(id))
+        ids = [int(i) for i in ids]
+        for i in range(0, len(ids), batch):
+            idlist = ",".join([str(id) for id in ids[i:i+batch]])
+            c.execute("select jobdesc from arcjobs where id in ("+idlist+")")
+            descs = [str(int(row['jobdesc'])) for row in c.fetchall() if row['jobdesc'] is not None]
+            if descs:
+                c.execute("delete from jobdescriptions where id in ("+",".join(descs)+")")
+            c.execute("delete from arcjobs where id in ("+idlist+")")
         self.Commit()
 
+    def _resetNextCheck(self, desc):
+        '''
+        Jobs changing arcstate are checked after the default checkinterval
+        unless desc sets their nextcheck
+        '''
+        if self.scheduled:
+            desc.setdefault('nextcheck', None)
+
     def updateArcJob(self, id, desc, job=None):
         '''
         Update arc job fields specified in desc and fields represented by arc
@@ -253,21 +377,55 @@ class aCTDBArc(aCTDB):
         Job if job is specified. Does not commit after executing update.
         '''
         c = self.db.getCursor()
-        c.execute("select id from arcjobs where id=%d limit 1" % id)
+        c.execute("select id, cluster from arcjobs where id=%d limit 1" % id)
         row = c.fetchone()
         if row is None:
             self.log.warning("Arc job id %d no longer exists" % id)
             return
+        if 'arcstate' in desc:
+            self.notify(desc['cluster'] if 'cluster' in desc else row['cluster'], desc['arcstate'])
+            self._resetNextCheck(desc)
 
         desc['modified']=self.getTimeStamp()
         s = "update arcjobs set " + ",".join(['%s=%%s' % (k) for k in desc.keys()])
+        values = list(desc.values())
         if job:
-            s += "," + ",".join(['%s=%%s' % (k) for k in self._job2db(job).keys()])
-        s+=" where id="+str(id)
-        if job:
-            c.execute(s, list(desc.values()) + list(self._job2db(job).values()))
-        else:
-            c.execute(s, list(desc.values()))
+            jobdesc = self.codec.job2db(job)
+            s += "," + ",".join(['%s=%%s' % (k) for k in jobdesc.keys()])
+            values += list(jobdesc.values())
+        s+=" where id=%s"
+        # Same columns are updated many times so use prepared statement
+        self.db.executePrepared(s, values + [id])
+
+    def updateArcJobsBulk(self, jobs):
+        '''
+        Update many arc jobs and commit once. jobs is a list of
+        (id, desc, job) where desc and job are as in updateArcJob() and job
+        may be None. Ids which no longer exist are ignored.
+        '''
+        if not jobs:
+            return
+        rows = []
+        # id: new arcstate of jobs with unknown cluster
+        changed = {}
+        for (id, desc, job) in jobs:
+            desc = desc.copy()
+            if job:
+                desc.update(self.codec.job2db(job))
+            if 'arcstate' in desc:
+                if 'cluster' in desc:
+                    self.notify(desc['cluster'], desc['arcstate'])
+                else:
+                    changed[id] = desc['arcstate']
+                self._resetNextCheck(desc)
+            rows.append((id, desc))
+        self._updateBulkLazy('id', rows)
+        if changed:
+            c = self.db.getCursor()
+            c.execute("SELECT id, cluster FROM arcjobs WHERE id IN (%s)" % ",".join([str(int(i)) for i in changed]))
+            for row in c.fetchall():
+                self.notify(row['cluster'], changed[row['id']])
+        self.Commit()
 
     def updateArcJobs(self, desc, select):
         '''
@@ -282,10 +440,37 @@ class aCTDBArc(aCTDB):
         Does not commit after executing update.
         '''
         desc['modified']=self.getTimeStamp()
+        where, params = self._where(select)
+        if 'arcstate' in desc:
+            self.notify(state=desc['arcstate'])
+            self._resetNextCheck(desc)
         s = "update arcjobs set " + ",".join(['%s=%%s' % (k) for k in desc.keys()])
-        s+=" where "+select
+        s+=" where "+where
         c=self.db.getCursor()
-        c.execute(s, list(desc.values()))
+        c.execute(s, list(desc.values()) + (params or []))
+
+    def claimArcJobs(self, select, columns, cluster, owner, lease):
+        '''
+        Claim jobs matching select for submission to cluster by owner, setting
+        them to submitting, and return a list of column: value dictionaries.
+        Jobs being claimed by other submitters are skipped. The claim expires
+        after lease seconds, see reclaimArcJobs().
+        '''
+        desc = {'arcstate': 'submitting', 'cluster': cluster, 'tarcstate': self.getTimeStamp()}
+        return self._claim(select, ['id'] + [c for c in columns if c != 'id'], desc, owner, lease)
+
+    def reclaimArcJobs(self, cluster, owner, lease):
+        '''
+        Set jobs left in submitting for cluster back to tosubmit if owner
+        claimed them, i.e. their submission failed, or if their claim expired
+        since the submitter which claimed them died.
+        '''
+        select = aCTDBQuery().eq('arcstate', 'submitting').eq('cluster', cluster) \
+                             .raw(*self._claimedClause(owner, lease, 'tarcstate'))
+        desc = {"arcstate": "tosubmit", "tarcstate": self.getTimeStamp(), "cluster": None}
+        if self.leases:
+            desc.update({"claimedby": None, "claimexpiry": None})
+        self.updateArcJobs(desc, select)
 
     def getArcJobInfo(self,id,columns=[]):
         '''
@@ -312,31 +497,76 @@ class aCTDBArc(aCTDB):
             if not res:
                 self.log.debug("Could not get lock: %s"%str(res))
                 return []
-        c.execute("SELECT "+self._column_list2str(columns)+" FROM "+tables+" WHERE "+select)
+        where, params = self._where(select)
+        c.execute("SELECT "+self._column_list2str(columns)+" FROM "+tables+" WHERE "+where, params)
         rows=c.fetchall()
         return rows
 
-    def getArcJobs(self,select):
+    def getArcJobsShares(self, select):
         '''
-        Return a dictionary of {proxyid: [(id, appjobid, arc.Job, created), ...]} for jobs matching select
+        Return {(fairshare, proxyid): (number of jobs, max priority)} for jobs
+        matching select
         '''
         c=self.db.getCursor()
-        c.execute("SELECT id, proxyid, appjobid, created, "+",".join(self.jobattrs.keys())+" FROM arcjobs WHERE "+select)
-        rows=c.fetchall()
-        d = {}
-        if isinstance(rows, tuple):
-            rows = dict(zip([col[0] for col in c.description], zip(*[list(row) for row in rows])))
-            for row in rows:
-                d[row[0]] = self._db2job(dict(zip([col[0] for col in c.description], row[1:])))
-        # mysql returns list of dictionaries
-        if isinstance(rows, list):
-            for row in rows:
-                if not row['proxyid'] in d:
-                    d[row['proxyid']] = []
-                d[row['proxyid']].append((row['id'], row['appjobid'], self._db2job(row), row['created']))
+        where, params = self._where(select)
+        c.execute("SELECT fairshare, proxyid, COUNT(*) AS n, MAX(priority) AS maxpriority FROM arcjobs WHERE "+where+
+                  " GROUP BY fairshare, proxyid", params)
+        return dict(((row['fairshare'], row['proxyid']), (int(row['n']), row['maxpriority'] or 0)) for row in c.fetchall())
+
+    def getArcJobs(self, select, columns=None, info=()):
+        '''
+        Return a dictionary of {proxyid: [(id, appjobid, arc.Job, created), ...]} for jobs matching select.
+        Jobs are aCTJobRow which create the arc.Job when it is first used.
 
+        columns is a list of Job attributes to read, by default all. Other
+        attributes keep their default values so jobs read with columns must
+        not be written back with updateArcJob(). Attributes unknown to this
+        ARC version are ignored. info is a list of other arcjobs columns to
+        read into the info dictionary of each aCTJobRow.
+        '''
+        if columns is None:
+            columns = self.codec.columns
+        else:
+            columns = tuple(col for col in columns if col in self.jobattrs)
+        info = tuple(info)
+        c=self.db.getCursor()
+        where, params = self._where(select)
+        fixed = ('id', 'proxyid', 'appjobid', 'created') + info
+        c.execute("SELECT "+",".join(fixed+columns)+" FROM arcjobs WHERE "+where, params)
+        d = {}
+        n = len(fixed)
+        for row in c.fetchall():
+            # mysql returns dictionaries, other DBs tuples
+            if isinstance(row, dict):
+                row = [row[col] for col in fixed+columns]
+            job = aCTJobRow(row[0], row[2], row[3], columns, tuple(row[n:]))
+            if info:
+                job.info = dict(zip(info, row[4:n]))
+            d.setdefault(row[1], []).append(job)
         return d
 
+    def iterArcJobsInfo(self, select, columns=[], tables="arcjobs", batch=1000, key="arcjobs.id"):
+        '''
+        Generator of lists of at most batch column: value dictionaries for
+        jobs matching select, paging on key. select cannot have ORDER BY or
+        LIMIT.
+        '''
+        keycol = key.split('.')[-1]
+        if columns and key not in columns and keycol not in columns:
+            columns = list(columns) + [key]
+        return self._iterPages(lambda q: self.getArcJobsInfo(q, columns, tables), select, key, batch,
+                               lambda rows: (len(rows), rows[-1][keycol] if rows else None))
+
+    def iterArcJobs(self, select, columns=None, batch=1000, info=()):
+        '''
+        Generator of getArcJobs() results for at most batch jobs matching
+        select, paging on id. select cannot have ORDER BY or LIMIT.
+        '''
+        def lastkey(jobs):
+            ids = [j.id for rows in jobs.values() for j in rows]
+            return (len(ids), max(ids) if ids else None)
+        return self._iterPages(lambda q: self.getArcJobs(q, columns, info), select, 'id', batch, lastkey)
+
     def getArcJobDescription(self, jobdescid):
         '''
         Return the job description for the given id in jobdescriptions
@@ -353,7 +583,8 @@ class aCTDBArc(aCTDB):
         Return the count of jobs in the table matching select
         '''
         c=self.db.getCursor()
-        c.execute("SELECT COUNT(*) FROM arcjobs WHERE "+select)
+        where, params = self._where(select)
+        c.execute("SELECT COUNT(*) FROM arcjobs WHERE "+where, params)
         row = c.fetchone()
         return row['COUNT(*)']
 
@@ -386,64 +617,6 @@ class aCTDBArc(aCTDB):
         rows=c.fetchall()
         return rows
 
-    def _db2job(self, dbinfo):
-        '''
-        Convert a dictionary of DB key value into arc Job object
-        '''
-        j = arc.Job()
-        for attr in self.jobattrs:
-            if attr not in dbinfo or dbinfo[attr] is None:
-                continue
-            # Some object types need special treatment
-            if self.jobattrs[attr] == arc.StringList:
-                l = arc.StringList()
-                for item in dbinfo[attr].split('|'):
-                    l.append(item)
-                setattr(j, attr, l)
-                continue
-            if self.jobattrs[attr] == arc.StringStringMap:
-                m = arc.StringStringMap()
-                d = eval(dbinfo[attr])
-                if not isinstance(d, dict):
-                    continue
-                for (k,v) in d.items():
-                    m[k] = v
-                setattr(j, attr, m)
-                continue
-
-            setattr(j, attr, self.jobattrs[attr](str(dbinfo[attr])))
-        return j
-
-    def _job2db(self, job):
-        '''
-        Convert an arc Job object to a dictionary of column name: value
-        '''
-        d = {}
-        for attr in self.jobattrs:
-            if self.jobattrs[attr] == int or self.jobattrs[attr] == str:
-                d[attr] = str(getattr(job, attr))[:250]
-            elif self.jobattrs[attr] == arc.JobState:
-                d[attr] = getattr(job, attr).GetGeneralState()
-            elif self.jobattrs[attr] == arc.StringList:
-                d[attr] = '|'.join(getattr(job, attr))[:1000]
-            elif self.jobattrs[attr] == arc.URL:
-                d[attr] = getattr(job, attr).str().replace(r'\2f',r'/')
-            elif self.jobattrs[attr] == arc.Period:
-                d[attr] = str(getattr(job, attr).GetPeriod())
-            elif self.jobattrs[attr] == arc.Time:
-                if getattr(job, attr).GetTime() != -1:
-                    # Use UTC time but strip trailing Z since mysql doesn't like it
-                    t = str(getattr(job, attr).str(arc.UTCTime))
-                    d[attr] = re.sub('Z$', '', t)
-            elif self.jobattrs[attr] == arc.StringStringMap:
-                ssm = getattr(job, attr)
-                tmpdict = dict(zip(ssm.keys(), ssm.values()))
-                d[attr] = str(tmpdict)[:1000]
-            # Force everything to ASCII
-            if attr in d:
-                d[attr] = ''.join([i for i in d[attr] if ord(i) < 128])
-        return d
-
     def _writeProxyFile(self, proxypath, proxy):
         with open(proxypath, 'w') as f:
             f.write(proxy)
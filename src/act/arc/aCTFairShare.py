@@ -0,0 +1,171 @@
+# aCTFairShare.py
+#
+# Scheduling of job submission over fair shares
+#
+import fcntl
+import importlib
+import json
+import os
+import re
+
+
+def getScheduler(log, conf, cluster, statedir):
+    '''
+    Return the scheduler configured in fairshare/scheduler, the name of a
+    module defining a class of the same name, by default aCTFairShare. The
+    class is created with (log, conf, statefile).
+    '''
+    name = conf.get(['fairshare', 'scheduler']) or 'act.arc.aCTFairShare'
+    statefile = os.path.join(statedir, 'fairshare-%s.json' % re.sub(r'[^\w.-]', '_', cluster or 'none'))
+    module = importlib.import_module(name)
+    return getattr(module, name.split('.')[-1])(log, conf, statefile)
+
+
+class aCTFairShare:
+    '''
+    Deficit round robin of job submission over shares, which are
+    (fairshare, proxyid) pairs of jobs waiting for a cluster.
+
+    Each round a share earns fairshare/quantum jobs times its weight, set
+    per fairshare name in the config (shares not listed have
+    fairshare/defaultweight, and weight 0 stops a share apart from the high
+    priority jobs aCTSubmitter lets through):
+
+      <fairshare>
+        <share><name>prod</name><weight>3</weight></share>
+        <share><name>test</name><weight>1</weight></share>
+      </fairshare>
+
+    Rounds are repeated until the free slots are given out or no share has
+    more jobs waiting. Credit not used is kept for the next call (up to one
+    batch), so shares get slots in proportion to their weights even when
+    few slots are free at a time. Shares with no jobs waiting lose their
+    credit. Credit is only spent through charge() with the number of jobs
+    actually submitted. Deficits are saved to statefile since the
+    submitter exits and is restarted often. The file is shared by the
+    submitters of a cluster, which add their changes to it under a lock so
+    that they schedule as one.
+
+    Another scheduler can be set in fairshare/scheduler, providing the
+    same schedule() and charge() methods.
+    '''
+
+    def __init__(self, log, conf, statefile=None):
+        self.log = log
+        self.conf = conf
+        self.statefile = statefile
+        # share: jobs the share may submit before others get their turn
+        self.deficit = {}
+        # shares in round robin order
+        self.order = []
+        # deficits in statefile when last read or written, to find the
+        # changes made by this process
+        self.saved = {}
+        self.load()
+
+    def read(self):
+        '''Return (order, deficit) stored in statefile'''
+        order = []
+        deficit = {}
+        try:
+            with open(self.statefile) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return (order, deficit)
+        for fairshare, proxyid, d in state:
+            share = (fairshare, proxyid)
+            order.append(share)
+            deficit[share] = d
+        return (order, deficit)
+
+    def load(self):
+        if not self.statefile:
+            return
+        (self.order, self.deficit) = self.read()
+        self.saved = dict(self.deficit)
+
+    def save(self):
+        '''
+        Add the changes to deficits since the last save to statefile, which
+        other submitters of the cluster may have changed meanwhile, and take
+        the result as the current deficits
+        '''
+        if not self.statefile:
+            return
+        try:
+            with open(self.statefile + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                (order, deficit) = self.read()
+                merged = {}
+                for share in self.order:
+                    base = deficit.get(share, self.saved.get(share, 0.0))
+                    merged[share] = base + self.deficit.get(share, 0.0) - self.saved.get(share, 0.0)
+                # keep shares of other submitters, unless this one dropped them
+                others = [s for s in order if s not in merged and s not in self.saved]
+                for share in others:
+                    merged[share] = deficit[share]
+                state = [(share[0], share[1], merged[share]) for share in self.order + others]
+                # per process name in case the lock is not honoured
+                tmpfile = '%s.%d.tmp' % (self.statefile, os.getpid())
+                with open(tmpfile, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmpfile, self.statefile)
+        except OSError as e:
+            self.log.warning('Failed to save fair-share state to %s: %s' % (self.statefile, str(e)))
+            return
+        self.order = self.order + others
+        self.deficit = merged
+        self.saved = dict(merged)
+
+    def weight(self, share):
+        w = self.conf.getCond(['fairshare', 'share'], 'name=%s' % share[0], ['weight'])
+        if w is None:
+            w = self.conf.get(['fairshare', 'defaultweight'])
+        return float(w) if w is not None else 1.0
+
+    def schedule(self, waiting, free, batch=100):
+        '''
+        Return a list of (share, njobs) to submit, at most free jobs in total
+        and batch per share, out of waiting: {share: number of jobs waiting}.
+        The list is ordered by remaining credit, so the share owed most is
+        submitted first.
+        '''
+        quantum = float(self.conf.get(['fairshare', 'quantum']) or 1)
+        weights = dict((s, self.weight(s)) for s, n in waiting.items() if n > 0)
+        active = [s for s, w in weights.items() if w > 0]
+        # shares with nothing waiting lose their credit
+        self.order = [s for s in self.order if s in weights] + [s for s in active if s not in self.order]
+        self.deficit = dict((s, d) for s, d in self.deficit.items() if s in weights)
+
+        remaining = dict((s, min(waiting[s], batch)) for s in active)
+        alloc = dict.fromkeys(active, 0)
+        credit = dict.fromkeys(active, 0.0)
+        while free > 0 and any(remaining.values()):
+            for s in self.order:
+                if free <= 0:
+                    break
+                if not remaining.get(s):
+                    continue
+                credit[s] += quantum * weights[s]
+                n = min(int(self.deficit.get(s, 0.0) + credit[s] - alloc[s]), remaining[s], free)
+                if n > 0:
+                    alloc[s] += n
+                    remaining[s] -= n
+                    free -= n
+        for s in active:
+            # unused credit is bounded like in DRR
+            self.deficit[s] = min(self.deficit.get(s, 0.0) + credit[s], batch + quantum * weights[s])
+        self.save()
+
+        position = dict((s, i) for i, s in enumerate(self.order))
+        result = sorted([(s, n) for s, n in alloc.items() if n], key=lambda x: (-self.deficit[x[0]], position[x[0]]))
+        self.log.debug('Fair-share allocation: %s' % ', '.join(['%s/%s: %d' % (s[0], s[1], n) for s, n in result]))
+        return result
+
+    def charge(self, share, njobs):
+        '''Spend the credit of share for njobs submitted and move it to the end of the round'''
+        self.deficit[share] = self.deficit.get(share, 0.0) - njobs
+        if share in self.order:
+            self.order.remove(share)
+        self.order.append(share)
+        self.save()
@@ -9,41 +9,72 @@ import errno
 import arc
 import shutil
 import fnmatch, re
-from threading import Thread
+import json
+import threading
+import concurrent.futures
 
 from act.common.aCTProcess import aCTProcess
+from act.common import aCTStats
 from act.common import aCTUtils
+from act.db.aCTDBQuery import aCTDBQuery
 
-class fetchSomeThr(Thread):
-    """
-    Helper function for threading
-    """
-    def __init__ (self, func, jobs, downloadfiles):
-        Thread.__init__(self)
-        self.func = func
-        self.jobs = jobs
-        self.downloadfiles = downloadfiles
-        self.result = (None, None, None)
-    def run(self):
-        self.result = self.func(self.jobs, self.downloadfiles)
+def manifestPath(tmpdir, jobid):
+    '''Path of the download manifest of jobid, see aCTFetcher.loadManifest()'''
+    return tmpdir + jobid[jobid.rfind('/'):] + '.manifest'
+
+def removeManifest(tmpdir, jobid):
+    '''
+    Remove the download manifest of jobid, when its output was fetched or
+    the job left the states where it is fetched
+    '''
+    if not jobid:
+        return
+    try:
+        os.unlink(manifestPath(tmpdir, jobid))
+    except OSError:
+        pass
 
 class aCTFetcher(aCTProcess):
     '''
     Downloads output data for finished ARC jobs.
     '''
 
-    def fetchAll(self, jobs):
+    notifystates = {'arcjobs': ('tofetch', 'finished')}
+
+    def __init__(self, cluster=None, pool=None):
+        aCTProcess.__init__(self, cluster, pool)
+        # Downloads run in a pool of fetcher/threads threads. Jobs are grouped
+        # by CE endpoint into at most fetcher/connections tasks per endpoint,
+        # each reusing one connection for its jobs. A task taking more than
+        # fetcher/timeout seconds per job, and at most fetcher/grouptimeout
+        # seconds, is abandoned and retried later.
+        self.timeout = int(self.conf.get(['fetcher', 'timeout']) or 600)
+        self.grouptimeout = int(self.conf.get(['fetcher', 'grouptimeout']) or 3600)
+        self.connections = int(self.conf.get(['fetcher', 'connections']) or 2)
+        # connection URL: number of tasks submitted which have not returned,
+        # including abandoned ones which may still be downloading
+        self.busy = {}
+        # JobIDs of the jobs in these tasks
+        self.inflight = set()
+        self.busylock = threading.Lock()
+        self.pool = self.workerPool(int(self.conf.get(['fetcher', 'threads']) or 4), self.timeout, 'fetcher')
+
+    def close(self):
+        self.closePool(self.pool)
+        aCTProcess.close(self)
+
+    def fetchAll(self, jobs, uc):
 
         # Get all outputs using Job Supervisor
-        job_supervisor = arc.JobSupervisor(self.uc, list(jobs.values()))
+        job_supervisor = aCTStats.instrument(arc.JobSupervisor(uc, list(jobs.values())), 'arc')
         job_supervisor.Update()
         dirs = arc.StringList()
         job_supervisor.Retrieve(self.tmpdir, False, False, dirs)
 
         return (list(job_supervisor.GetIDsProcessed()), list(job_supervisor.GetIDsNotProcessed()))
 
-    def listUrlRecursive(self, url, fname='', filelist=[]):
-        dp = aCTUtils.DataPoint(url+'/'+fname, self.uc)
+    def listUrlRecursive(self, url, uc, fname='', filelist=[]):
+        dp = aCTUtils.DataPoint(url+'/'+fname, uc)
         files = dp.h.List(arc.DataPoint.INFO_TYPE_NAME | arc.DataPoint.INFO_TYPE_TYPE)
         if not files[1]:
             self.log.warning("Failed listing %s/%s" % (url, fname))
@@ -52,22 +83,66 @@ class aCTFetcher(aCTProcess):
             if f.GetType()==f.file_type_file:
                 filelist.append((fname+'/'+f.GetName()).strip('/'))
             elif f.GetType()==f.file_type_dir:
-                filelist = self.listUrlRecursive(url, (fname+'/'+str(f.GetName())).strip('/'), filelist)
+                filelist = self.listUrlRecursive(url, uc, (fname+'/'+str(f.GetName())).strip('/'), filelist)
         return filelist
 
 
-    def fetchSome(self, jobs, downloadfiles):
+    def manifestPath(self, jobid):
+        return manifestPath(self.tmpdir, jobid)
+
+    def loadManifest(self, jobid):
+        '''
+        Return the download manifest of jobid, {"files": {file: {"size": bytes,
+        "adler32": checksum}}, "expanded": {downloadfiles: files}} recording
+        files completely downloaded and the expansion of wildcards by a
+        previous attempt
+        '''
+        try:
+            with open(self.manifestPath(jobid)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest.setdefault('files', {})
+        manifest.setdefault('expanded', {})
+        return manifest
+
+    def saveManifest(self, jobid, manifest):
+        path = self.manifestPath(jobid)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.log.warning('Failed to write manifest %s: %s', path, str(e))
+
+    def removeManifest(self, jobid):
+        removeManifest(self.tmpdir, jobid)
+
+    def isDownloaded(self, localfile, entry):
+        '''True if localfile matches its manifest entry'''
+        if not entry:
+            return False
+        try:
+            return os.path.getsize(localfile) == entry['size'] and aCTUtils.adler32(localfile) == entry['adler32']
+        except OSError:
+            return False
+
+    def fetchSome(self, jobs, downloadfiles, uc):
 
         # Get specified files for the jobs in downloadfiles
         # jobs: id: Job object
         # downloadfiles: id: list of files relative to session dir, with wildcards
+        # uc: UserConfig with the credential of the jobs
+        # Files downloaded are recorded in a manifest per job so that a retry
+        # only downloads the files missing. Returns also the bytes downloaded.
         if not jobs or not downloadfiles:
-            return ([], [], [])
+            return ([], [], [], 0)
 
         # construct datapoint object, initialising connection. Use the same
-        # object until base URL changes. TODO group by base URL.
-        datapoint = aCTUtils.DataPoint(next(iter(jobs.values())).JobID, self.uc)
+        # object until base URL changes, jobs are grouped by base URL.
+        datapoint = aCTUtils.DataPoint(next(iter(jobs.values())).JobID, uc)
         dp = datapoint.h
+        connurl = arc.URL(next(iter(jobs.values())).JobID).ConnectionURL()
         dm = arc.DataMover()
         dm.retry(False)
         dm.passive(True)
@@ -75,16 +150,19 @@ class aCTFetcher(aCTProcess):
         fetched = []
         notfetched = []
         notfetchedretry = []
+        nbytes = 0
 
         for (id, job) in jobs.items():
             if id not in downloadfiles:
                 continue
             jobid = job.JobID
+            manifest = self.loadManifest(jobid)
 
             # If connection URL is different reconnect
-            if arc.URL(jobid).ConnectionURL() != dp:
-                datapoint = aCTUtils.DataPoint(jobid, self.uc)
+            if arc.URL(jobid).ConnectionURL() != connurl:
+                datapoint = aCTUtils.DataPoint(jobid, uc)
                 dp = datapoint.h
+                connurl = arc.URL(jobid).ConnectionURL()
             localdir = self.tmpdir + jobid[jobid.rfind('/'):] + '/'
             sessiondir = jobid
             # Check for REST
@@ -92,9 +170,12 @@ class aCTFetcher(aCTProcess):
                 sessiondir += '/session'
 
             files = downloadfiles[id].split(';')
-            if re.search('[\*\[\]\?]', downloadfiles[id]):
+            if downloadfiles[id] in manifest['expanded']:
+                # wildcards expanded by a previous attempt
+                files = manifest['expanded'][downloadfiles[id]]
+            elif re.search('[\*\[\]\?]', downloadfiles[id]):
                 # found wildcard, need to get sessiondir list
-                remotefiles = self.listUrlRecursive(sessiondir)
+                remotefiles = self.listUrlRecursive(sessiondir, uc, '', [])
                 expandedfiles = []
                 for wcf in files:
                     if re.search('[\*\[\]\?]', wcf):
@@ -104,9 +185,15 @@ class aCTFetcher(aCTProcess):
                         expandedfiles.append(wcf)
                 # remove duplicates from wildcard matching through set
                 files = list(set(expandedfiles))
+                if remotefiles:
+                    manifest['expanded'][downloadfiles[id]] = files
+                    self.saveManifest(jobid, manifest)
 
             for f in files:
                 localfile = str(localdir + f)
+                if self.isDownloaded(localfile, manifest['files'].get(f)):
+                    self.log.debug('Already downloaded %s', localfile)
+                    continue
                 localfiledir = localfile[:localfile.rfind('/')]
                 # create required local dirs
                 try:
@@ -116,15 +203,18 @@ class aCTFetcher(aCTProcess):
                         self.log.warning('Failed to create directory %s: %s', localfiledir, os.strerror(e.errno))
                         notfetched.append(jobid)
                         break
+                # remove anything left by an interrupted download
+                if os.path.lexists(localfile):
+                    os.unlink(localfile)
                 # Check for diagnostic files in REST
                 if job.JobManagementInterfaceName == 'org.nordugrid.arcrest' and f.startswith('gmlog/'):
                     remotefile = arc.URL(str(jobid + '/diagnose/' + f[6:]))
                 else:
                     remotefile = arc.URL(str(sessiondir + '/' + f))
                 if not dp.SetURL(remotefile):
-                    datapoint = aCTUtils.DataPoint(remotefile.str(), self.uc)
+                    datapoint = aCTUtils.DataPoint(remotefile.str(), uc)
                     dp = datapoint.h
-                localdp = aCTUtils.DataPoint(localfile, self.uc)
+                localdp = aCTUtils.DataPoint(localfile, uc)
                 # do the copy
                 status = dm.Transfer(dp, localdp.h, arc.FileCache(), arc.URLMap())
                 if not status and str(status).find('File unavailable') == -1: # tmp fix for globus error which is always retried
@@ -136,30 +226,111 @@ class aCTFetcher(aCTProcess):
                         notfetched.append(jobid)
                     break
                 self.log.info('Downloaded %s', dp.GetURL().str())
+                if status and os.path.isfile(localfile):
+                    size = os.path.getsize(localfile)
+                    nbytes += size
+                    manifest['files'][f] = {'size': size, 'adler32': aCTUtils.adler32(localfile)}
+                    self.saveManifest(jobid, manifest)
             if jobid not in notfetched and jobid not in notfetchedretry:
                 fetched.append(jobid)
-        return (fetched, notfetched, notfetchedretry)
+        return (fetched, notfetched, notfetchedretry, nbytes)
 
 
-    def fetchJobs(self, arcstate, nextarcstate):
+    def groupJobs(self, jobs):
+        '''
+        Split jobs, a dictionary of id: Job, into a list of (connection URL,
+        {id: Job}) with at most fetcher/connections groups per URL
+        '''
+        byurl = {}
+        for (id, job) in jobs.items():
+            byurl.setdefault(arc.URL(job.JobID).ConnectionURL(), []).append((id, job))
+        groups = []
+        for url, items in byurl.items():
+            n = min(self.connections, len(items))
+            groups.extend([(url, dict(items[i::n])) for i in range(n)])
+        return groups
+
+    def downloadedBytes(self, jobid):
+        '''Size of the files downloaded for jobid'''
+        nbytes = 0
+        for root, dirs, files in os.walk(self.tmpdir + jobid[jobid.rfind('/'):]):
+            for f in files:
+                try:
+                    nbytes += os.lstat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+        return nbytes
+
+    def fetchGroup(self, jobs, downloadfiles, uc):
+        '''
+        Download outputs of jobs, a dictionary of id: Job with the same
+        connection URL, all files if downloadfiles is None, using the
+        UserConfig uc. Runs in the worker pool. Returns (fetched, notfetched,
+        notfetchedretry, bytes).
+        '''
+        if downloadfiles is None:
+            # We don't know if a failure from JobSupervisor is retryable or not
+            # so always retry
+            (f, r) = self.fetchAll(jobs, uc)
+            return (f, [], r, sum(self.downloadedBytes(jobid) for jobid in f))
+        return self.fetchSome(jobs, downloadfiles, uc)
+
+    def fetchGroupTask(self, url, proxystring, jobs, downloadfiles):
+        '''
+        fetchGroup() for the pool with a UserConfig of its own for
+        proxystring, since an abandoned task keeps downloading while the
+        agent moves on to other proxies. Marks url and jobs as no longer busy
+        when the download returns, even if the task was abandoned before.
+        '''
+        try:
+            return self.fetchGroup(jobs, downloadfiles, self.userConfig(proxystring))
+        finally:
+            with self.busylock:
+                self.busy[url] -= 1
+                if not self.busy[url]:
+                    del self.busy[url]
+                self.inflight.difference_update([job.JobID for job in jobs.values()])
 
-        # Get list of jobs in the right state
-        jobstofetch = self.db.getArcJobs("arcstate='"+arcstate+"' and cluster='"+self.cluster+"'" + " limit 100")
+    def fetchJobs(self, arcstate, nextarcstate):
 
-        if not jobstofetch:
-            return
+        # Get jobs in the right state, 100 at a time
+        select = aCTDBQuery().eq('arcstate', arcstate).eq('cluster', self.cluster)
+        for jobstofetch in self.db.iterArcJobs(select, self.db.jobcontrolattrs, batch=100):
+            if not self.fetchJobsPage(jobstofetch, arcstate, nextarcstate) or self.pastDeadline():
+                return
+
+    def fetchJobsPage(self, jobstofetch, arcstate, nextarcstate):
+        '''
+        Fetch outputs of jobstofetch, a dictionary of proxyid: jobs. Returns
+        False if all failed and fetching should stop for now.
+        '''
         self.log.info("Fetching %i jobs" % sum(len(v) for v in jobstofetch.values()))
 
         fetched = []; notfetched = []; notfetchedretry = []
+        # jobs left for a later attempt
+        skipped = set()
         for proxyid, jobs in jobstofetch.items():
-            self.uc.CredentialString(str(self.db.getProxy(proxyid)))
-
-            # Clean the download dir just in case something was left from previous attempt
+            proxystring = str(self.db.getProxy(proxyid))
+
+            # Jobs still being downloaded by an abandoned task are left alone
+            # until it returns, so that its files and manifest are not changed
+            # under it
+            with self.busylock:
+                inflight = [job for job in jobs if job[2].JobID in self.inflight]
+            if inflight:
+                self.log.warning('Not fetching %d jobs still being downloaded by a timed out task' % len(inflight))
+                skipped.update([job[2].JobID for job in inflight])
+                jobs = [job for job in jobs if job[2].JobID not in skipped]
+
+            # Clean the download dir just in case something was left from previous attempt,
+            # unless the manifest of the previous attempt says what can be kept
             for job in jobs:
-                shutil.rmtree(self.tmpdir + job[2].JobID[job[2].JobID.rfind('/'):], True)
+                if not os.path.exists(self.manifestPath(job[2].JobID)):
+                    shutil.rmtree(self.tmpdir + job[2].JobID[job[2].JobID.rfind('/'):], True)
 
             # Get list of downloadable files for these jobs
-            filestodl = self.db.getArcJobsInfo("arcstate='"+arcstate+"' and cluster='"+self.cluster+"' and proxyid='"+str(proxyid)+"'", ['id', 'downloadfiles'])
+            filestodl = self.db.getArcJobsInfo(aCTDBQuery().eq('arcstate', arcstate).isin('id', [j[0] for j in jobs]),
+                                               ['id', 'downloadfiles'])
             # id: downloadfiles
             downloadfiles = dict((row['id'], row['downloadfiles']) for row in filestodl)
             # jobs to download all files
@@ -167,47 +338,67 @@ class aCTFetcher(aCTProcess):
             # jobs to download specific files
             jobs_downloadsome = dict((j[0], j[2]) for j in jobs if j[0] in downloadfiles and downloadfiles[j[0]])
 
-            # We don't know if a failure from JobSupervisor is retryable or not
-            # so always retry
-            (f, r) = self.fetchAll(jobs_downloadall)
-            fetched.extend(f)
-            notfetchedretry.extend(r)
-
-            nthreads=1
-            jobkeys=list(jobs_downloadsome.keys())
-            # split job list in nthreads sublists
-            jl=[jobkeys[i:i + nthreads] for i in range(0, len(jobkeys), nthreads)]
-
-            for l in jl:
-                tlist = []
-                # loop over sublist
-                for j in l:
-                    # one job per thread
-                    onejob=dict((k,jobs_downloadsome[k]) for k in [j])
-                    t = fetchSomeThr(self.fetchSome, onejob ,downloadfiles)
-                    tlist.append(t)
-                    t.start()
-                for t in tlist:
-                    t.join()
-                    (f,n,r) = t.result
-                    fetched.extend(f)
-                    notfetched.extend(n)
-                    notfetchedretry.extend(r)
+            # one task per group of jobs sharing a connection
+            tasks = [(url, group, None) for (url, group) in self.groupJobs(jobs_downloadall)] + \
+                    [(url, group, downloadfiles) for (url, group) in self.groupJobs(jobs_downloadsome)]
+            with self.busylock:
+                busy = set(self.busy)
+            # an endpoint with an abandoned task still running is not given
+            # more work until the task returns
+            for (url, group, dl) in tasks:
+                if url in busy:
+                    self.log.warning('Not fetching %d jobs from %s while a timed out download is still running' % (len(group), url))
+                    skipped.update([job.JobID for job in group.values()])
+            tasks = [t for t in tasks if t[0] not in busy]
+            futures = {}
+            for (url, group, dl) in tasks:
+                with self.busylock:
+                    self.busy[url] = self.busy.get(url, 0) + 1
+                    self.inflight.update([job.JobID for job in group.values()])
+                timeout = min(self.timeout * len(group), self.grouptimeout)
+                futures[self.pool.submitTimeout(timeout, self.fetchGroupTask, url, proxystring, group, dl)] = (url, group)
+            start = time.time()
+            # url: [bytes, seconds until its last task finished]
+            transferred = {}
+            for future in concurrent.futures.as_completed(futures):
+                (url, group) = futures[future]
+                try:
+                    (f,n,r,nbytes) = future.result()
+                except Exception as e:
+                    self.log.warning('Failed to download %d jobs from %s, will retry: %s' % (len(group), url, str(e)))
+                    with self.busylock:
+                        # a timed out task may still be writing these jobs
+                        skipped.update([job.JobID for job in group.values() if job.JobID in self.inflight])
+                    notfetchedretry.extend([job.JobID for job in group.values() if job.JobID not in skipped])
+                    continue
+                fetched.extend(f)
+                notfetched.extend(n)
+                notfetchedretry.extend(r)
+                transferred[url] = [transferred.get(url, [0])[0] + nbytes, time.time() - start]
+
+            for url, (nbytes, seconds) in transferred.items():
+                rate = nbytes / max(seconds, 0.001)
+                aCTStats.observe('fetch_bytes_per_second', rate, url)
+                self.log.info('Downloaded %.1f MB from %s in %ds, %.2f MB/s' % (nbytes / 1e6, url, seconds, rate / 1e6))
 
         # Check for massive failure, and back off before trying again
         # TODO: downtime awareness
         if len(notfetched) > 10 and len(notfetched) == len(jobstofetch) or \
            len(notfetchedretry) > 10 and len(notfetchedretry) == len(jobstofetch):
-            self.log.error("Failed to get any jobs from %s, sleeping for 5 mins" % self.cluster)
-            time.sleep(300)
-            return
+            self.log.error("Failed to get any jobs from %s, pausing for 5 mins" % self.cluster)
+            self.holdoff = time.time() + 300
+            return False
 
         for proxyid, jobs in jobstofetch.items():
             for (id, appjobid, job, created) in jobs:
+                if job.JobID in skipped:
+                    continue
                 if job.JobID in notfetchedretry:
                     self.log.warning("%s: Could not get output from job %s" % (appjobid, job.JobID))
-                    # Remove download directory to allow retry
-                    shutil.rmtree(self.tmpdir + job.JobID[job.JobID.rfind('/'):], True)
+                    # Remove download directory to allow retry, unless the
+                    # manifest allows to resume
+                    if not os.path.exists(self.manifestPath(job.JobID)):
+                        shutil.rmtree(self.tmpdir + job.JobID[job.JobID.rfind('/'):], True)
                     # Check if job still exists
                     fileinfo = arc.FileInfo()
                     self.uc.CredentialString(str(self.db.getProxy(proxyid)))
@@ -216,17 +407,22 @@ class aCTFetcher(aCTProcess):
                     # TODO Check other permanent errors
                     if not status and status.GetErrno() == errno.ENOENT:
                         self.log.warning("%s: Job %s no longer exists" % (appjobid, job.JobID))
+                        shutil.rmtree(self.tmpdir + job.JobID[job.JobID.rfind('/'):], True)
+                        self.removeManifest(job.JobID)
                         self.db.updateArcJob(id, {"arcstate": "donefailed",
                                                   "tarcstate": self.db.getTimeStamp()})
                     # Otherwise try again next time
                 elif job.JobID in notfetched:
                     self.log.error("%s: Failed to download job %s" % (appjobid, job.JobID))
+                    self.removeManifest(job.JobID)
                     self.db.updateArcJob(id, {"arcstate": "donefailed",
                                               "tarcstate": self.db.getTimeStamp()})
                 else:
                     self.log.info("%s: Downloaded job %s" % (appjobid, job.JobID))
+                    self.removeManifest(job.JobID)
                     self.db.updateArcJob(id, {"arcstate": nextarcstate,
                                               "tarcstate": self.db.getTimeStamp()})
+        return True
 
 
     def process(self):
@@ -0,0 +1,213 @@
+# aCTJobCodec.py
+#
+# Conversion between arc.Job objects and rows of the arcjobs table
+#
+import ast
+import json
+import re
+import arc
+
+# Mapping from Job class attribute types to column types
+jobattrmap = {int: 'integer',
+              str: 'varchar(255)',
+              arc.JobState: 'varchar(255)',
+              arc.StringList: 'varchar(1024)',
+              arc.URL: 'varchar(255)',
+              arc.Period: 'int',
+              arc.Time: 'datetime',
+              arc.StringStringMap: 'varchar(1024)'}
+
+# Job attributes which are not stored
+ignoremems = ['STDIN',
+              'STDOUT',
+              'STDERR',
+              'STAGEINDIR',
+              'STAGEOUTDIR',
+              'SESSIONDIR',
+              'JOBLOG',
+              'JOBDESCRIPTION',
+              'JobDescriptionDocument']
+
+# Process-wide codec, created on first use
+_codec = None
+
+
+def _ascii(value):
+    '''Drop non-ASCII characters'''
+    return value.encode('ascii', 'ignore').decode('ascii')
+
+def _encodeMap(ssm, maxlen=1000):
+    '''
+    JSON encoding of a StringStringMap. Items which do not fit in maxlen are
+    left out so that the stored value is always valid JSON.
+    '''
+    d = dict(zip(ssm.keys(), ssm.values()))
+    value = json.dumps(d)
+    while len(value) > maxlen and d:
+        d.popitem()
+        value = json.dumps(d)
+    return value
+
+def _decodeMap(value):
+    '''
+    Return a StringStringMap from its JSON encoding, or None if value
+    cannot be parsed. Rows written by older versions used str(dict).
+    '''
+    try:
+        d = json.loads(value)
+    except ValueError:
+        try:
+            d = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return None
+    if not isinstance(d, dict):
+        return None
+    m = arc.StringStringMap()
+    for (k, v) in d.items():
+        m[str(k)] = str(v)
+    return m
+
+def _decodeList(value):
+    l = arc.StringList()
+    for item in value.split('|'):
+        l.append(item)
+    return l
+
+def _encodeTime(t):
+    if t.GetTime() == -1:
+        return None
+    # Use UTC time but strip trailing Z since mysql doesn't like it
+    return re.sub('Z$', '', str(t.str(arc.UTCTime)))
+
+# Functions converting a Job attribute of each type to its column value,
+# None means the column is not set
+_encoders = {int: lambda v: str(v)[:250],
+             str: lambda v: str(v)[:250],
+             arc.JobState: lambda v: v.GetGeneralState(),
+             arc.StringList: lambda v: '|'.join(v)[:1000],
+             arc.URL: lambda v: v.str().replace(r'\2f', r'/'),
+             arc.Period: lambda v: str(v.GetPeriod()),
+             arc.Time: _encodeTime,
+             arc.StringStringMap: _encodeMap}
+
+# Functions converting a column value to a Job attribute of each type, None
+# means the attribute is not set
+_decoders = {arc.StringList: _decodeList,
+             arc.StringStringMap: _decodeMap}
+
+
+class aCTJobCodec:
+    '''
+    Converts arc.Job objects to and from dictionaries of arcjobs column:
+    value. The stored attributes of arc.Job and their conversions are found
+    once by introspection, use codec() to get the shared instance.
+    '''
+
+    def __init__(self):
+        # Attributes of Job class mapped to their type, in column order
+        self.jobattrs = {}
+        j = arc.Job()
+        for i in dir(j):
+            if i.startswith('__') or i in ignoremems:
+                continue
+            t = type(getattr(j, i))
+            if t in jobattrmap:
+                self.jobattrs[i] = t
+        self.columns = tuple(self.jobattrs.keys())
+        # StringList attributes, which ARC appends to when updating a job
+        self.listcolumns = tuple(attr for attr, t in self.jobattrs.items() if t == arc.StringList)
+        self.encoders = [(attr, _encoders[t]) for attr, t in self.jobattrs.items()]
+        self.decoders = [(attr, _decoders.get(t, lambda v, t=t: t(str(v)))) for attr, t in self.jobattrs.items()]
+        self.decoderof = dict(self.decoders)
+
+    def columnTypes(self):
+        '''Return a dictionary of column name: column type'''
+        return dict((attr, jobattrmap[t]) for attr, t in self.jobattrs.items())
+
+    def db2job(self, dbinfo):
+        '''
+        Convert a dictionary of DB key value into arc Job object
+        '''
+        if dbinfo is None:
+            return None
+        j = arc.Job()
+        for attr, decode in self.decoders:
+            value = dbinfo.get(attr)
+            if value is None:
+                continue
+            value = decode(value)
+            if value is not None:
+                setattr(j, attr, value)
+        return j
+
+    def row2job(self, columns, values):
+        '''
+        Convert a sequence of values of the given columns into arc Job object
+        '''
+        j = arc.Job()
+        for attr, value in zip(columns, values):
+            if value is None:
+                continue
+            value = self.decoderof[attr](value)
+            if value is not None:
+                setattr(j, attr, value)
+        return j
+
+    def job2db(self, job):
+        '''
+        Convert an arc Job object to a dictionary of column name: value
+        '''
+        d = {}
+        for attr, encode in self.encoders:
+            value = encode(getattr(job, attr))
+            if value is not None:
+                # Force everything to ASCII
+                d[attr] = _ascii(value)
+        return d
+
+
+class aCTJobRow:
+    '''
+    Job selected by aCTDBArc.getArcJobs(), usable as the tuple
+    (id, appjobid, arc.Job, created). Only the column values are kept until
+    the arc.Job is first used, then the values are dropped.
+    '''
+
+    __slots__ = ('id', 'appjobid', 'created', 'columns', 'values', 'info', '_job')
+
+    def __init__(self, id, appjobid, created, columns, values):
+        self.id = id
+        self.appjobid = appjobid
+        self.created = created
+        # tuple of column names shared by all rows of a query
+        self.columns = columns
+        self.values = values
+        # other columns requested with getArcJobs(info=...)
+        self.info = None
+        self._job = None
+
+    @property
+    def job(self):
+        if self._job is None:
+            self._job = codec().row2job(self.columns, self.values)
+            self.values = None
+        return self._job
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, i):
+        if i in (2, -2):
+            return self.job
+        return (self.id, self.appjobid, None, self.created)[i]
+
+    def __iter__(self):
+        return iter((self.id, self.appjobid, self.job, self.created))
+
+
+def codec():
+    '''Return the process-wide aCTJobCodec'''
+    global _codec
+    if _codec is None:
+        _codec = aCTJobCodec()
+    return _codec
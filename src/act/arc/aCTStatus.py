@@ -4,9 +4,14 @@
 #
 import re
 import time
+import datetime
+import functools
 import arc
 
 from act.common.aCTProcess import aCTProcess
+from act.common import aCTStats
+from act.arc.aCTCheckSchedule import aCTCheckSchedule
+from act.db.aCTDBQuery import aCTDBQuery
 
 class aCTStatus(aCTProcess):
     '''
@@ -14,28 +19,27 @@ class aCTStatus(aCTProcess):
     status in the DB.
     '''
 
-    def __init__(self):
+    notifystates = {'arcjobs': ('cancelling',)}
 
-        aCTProcess.__init__(self)
+    def __init__(self, cluster=None, pool=None):
+
+        aCTProcess.__init__(self, cluster, pool)
 
         # store the last checkJobs time to avoid overloading of GIIS
         self.checktime=time.time()
 
+        # Jobs are queried in chunks of jobs/checkchunk running in a pool of
+        # jobs/checkthreads threads. Chunks taking longer than
+        # jobs/checktimeout seconds are abandoned and checked next time.
+        self.checkchunk = int(self.conf.get(['jobs', 'checkchunk']) or 200)
+        self.checktimeout = int(self.conf.get(['jobs', 'checktimeout']) or 300)
+        self.pool = self.workerPool(int(self.conf.get(['jobs', 'checkthreads']) or 4), self.checktimeout, 'status')
+        # time of the next check of each job, if the nextcheck column exists
+        self.schedule = aCTCheckSchedule(self.log, self.conf)
 
-    def resetJobs(self, jobstoreset):
-        '''
-        Empty all StringLists in jobs so that when they are updated they do not
-        contain duplicate values, since ARC always appends to these lists.
-        '''
-        emptylist = arc.StringList()
-        j = arc.Job()
-        attrstoreset = [attr for attr in dir(j) if type(getattr(j, attr)) == arc.StringList]
-
-        for jobs in jobstoreset.values():
-            for job in jobs:
-                for attr in attrstoreset:
-                    setattr(job[2], attr, emptylist)
-
+    def close(self):
+        self.closePool(self.pool)
+        aCTProcess.close(self)
 
     def processJobErrors(self, id, appjobid, failedjob):
         '''
@@ -84,92 +88,153 @@ class aCTStatus(aCTProcess):
             return
         self.checktime=time.time()
 
-        # check jobs which were last checked more than checkinterval ago
-        jobstocheck=self.db.getArcJobs("arcstate in ('submitted', 'running', 'finishing', 'cancelling', 'holding') and " \
-                                       "jobid not like '' and cluster='"+self.cluster+"' and "+ \
-                                       self.db.timeStampLessThan("tarcstate", self.conf.get(['jobs','checkinterval'])) + \
-                                       " limit 100000")
-
-        njobstocheck = sum(len(v) for v in jobstocheck.values())
-        if not njobstocheck:
-            return
-        self.log.info("%d jobs to check" % njobstocheck)
-        self.resetJobs(jobstocheck)
+        # check jobs which are due, or were last checked more than
+        # checkinterval ago if they have no nextcheck
+        select = aCTDBQuery().isin('arcstate', ['submitted', 'running', 'finishing', 'cancelling', 'holding']) \
+                             .ne('jobid', '').eq('cluster', self.cluster)
+        if self.db.scheduled:
+            select.raw("(%s or (nextcheck IS NULL and %s))" % (self.db.timeStampLessThan("nextcheck", 0), self.db.timeStampLessThan("tarcstate", "%s")),
+                       int(self.conf.get(['jobs','checkinterval'])))
+            # to measure how long jobs stay in each state
+            info = ('arcstate', 'tarcstate', 'tstate')
+        else:
+            select.raw(self.db.timeStampLessThan("tarcstate", "%s"), int(self.conf.get(['jobs','checkinterval'])))
+            info = ()
+        # StringLists are not read so that updated jobs do not contain
+        # duplicate values, since ARC always appends to these lists
+        columns = [c for c in self.db.codec.columns if c not in self.db.codec.listcolumns]
+        # jobs are checked and updated in pages to keep memory use flat
+        batch = int(self.conf.get(['jobs', 'checkbatch']) or 1000)
+        njobstocheck = 0
+        for jobstocheck in self.db.iterArcJobs(select, columns, batch, info):
+            n = sum(len(v) for v in jobstocheck.values())
+            njobstocheck += n
+            self.log.info("%d jobs to check" % n)
+            self.checkJobsPage(jobstocheck)
+            if self.pastDeadline():
+                break
+
+        if njobstocheck:
+            self.log.info('Done')
+            if self.db.scheduled:
+                self.log.debug('Mean time in state: %s' % self.schedule.summary())
+
+    def updateChunk(self, proxystring, jobs):
+        '''
+        Query the status of jobs, a list of (id, appjobid, arc.Job, created),
+        with the credential proxystring and return (updated jobs, IDs not
+        updated). Runs in the worker pool.
+        '''
+        job_supervisor = aCTStats.instrument(arc.JobSupervisor(self.userConfig(proxystring), [j[2] for j in jobs]), 'arc')
+        job_supervisor.Update()
+        return (list(job_supervisor.GetAllJobs()), set(job_supervisor.GetIDsNotProcessed()))
 
-        # Loop over proxies
+    def checkJobsPage(self, jobstocheck):
+        '''
+        Update the status of jobstocheck, a dictionary of proxyid: jobs
+        '''
+        # Loop over proxies, each chunk has its own UserConfig for the proxy
         for proxyid, jobs in jobstocheck.items():
-            self.uc.CredentialString(str(self.db.getProxy(proxyid)))
+            update = functools.partial(self.updateChunk, str(self.db.getProxy(proxyid)))
+
+            # results are written as each chunk completes
+            for chunk, f in self.pool.mapChunks(update, jobs, self.checkchunk, self.checktimeout):
+                try:
+                    jobsupdated, jobsnotupdated = f.result()
+                except Exception as e:
+                    # the jobs keep their tarcstate so are checked again next time
+                    self.log.warning("Failed to update %d jobs of proxy %s: %s" % (len(chunk), proxyid, str(e)))
+                    continue
+                self.processUpdates(chunk, jobsupdated, jobsnotupdated)
 
-            job_supervisor = arc.JobSupervisor(self.uc, [j[2] for j in jobs])
-            job_supervisor.Update()
-            jobsupdated = job_supervisor.GetAllJobs()
-            jobsnotupdated = job_supervisor.GetIDsNotProcessed()
+    def processUpdates(self, jobs, jobsupdated, jobsnotupdated):
+        '''
+        Write the updated status of jobs to the DB
+        '''
+        # DB updates are written in bulk for all jobs of the chunk
+        updates = []
 
-            for (originaljobinfo, updatedjob) in zip(jobs, jobsupdated):
-                (id, appjobid, originaljob, created) = originaljobinfo
-                if updatedjob.JobID in jobsnotupdated:
-                    self.log.error("%s: Failed to find information on %s" % (appjobid, updatedjob.JobID))
-                    continue
-                if updatedjob.JobID != originaljob.JobID:
-                    # something went wrong with list order
-                    self.log.warning("%s: Bad job id (%s), expected %s" % (appjobid, updatedjob.JobID, originaljob.JobID))
-                    continue
-                # compare strings here to get around limitations of JobState API
-                # map INLRMS:S and O to HOLD (not necessary when ARC 4.1 is used)
-                if updatedjob.State.GetGeneralState() == 'Queuing' and (updatedjob.State.GetSpecificState() == 'INLRMS:S' or updatedjob.State.GetSpecificState() == 'INLRMS:O'):
-                    updatedjob.State = arc.JobState('Hold')
-                if originaljob.State.GetGeneralState() == updatedjob.State.GetGeneralState() \
-                     and self.cluster not in ['gsiftp://gar-ex-etpgrid1.garching.physik.uni-muenchen.de:2811/preempt', 'gsiftp://arc1-it4i.farm.particle.cz/qfree', 'gsiftp://arc2-it4i.farm.particle.cz/qfree']:
-                    # just update timestamp
-                    # Update numbers every time for superMUC since walltime is missing for finished jobs
-                    self.db.updateArcJob(id, {'tarcstate': self.db.getTimeStamp()})
-                    continue
+        for (originaljobinfo, updatedjob) in zip(jobs, jobsupdated):
+            (id, appjobid, originaljob, created) = originaljobinfo
+            if updatedjob.JobID in jobsnotupdated:
+                self.log.error("%s: Failed to find information on %s" % (appjobid, updatedjob.JobID))
+                continue
+            if updatedjob.JobID != originaljob.JobID:
+                # something went wrong with list order
+                self.log.warning("%s: Bad job id (%s), expected %s" % (appjobid, updatedjob.JobID, originaljob.JobID))
+                continue
+            # compare strings here to get around limitations of JobState API
+            # map INLRMS:S and O to HOLD (not necessary when ARC 4.1 is used)
+            if updatedjob.State.GetGeneralState() == 'Queuing' and (updatedjob.State.GetSpecificState() == 'INLRMS:S' or updatedjob.State.GetSpecificState() == 'INLRMS:O'):
+                updatedjob.State = arc.JobState('Hold')
+            if originaljob.State.GetGeneralState() == updatedjob.State.GetGeneralState() \
+                 and self.cluster not in ['gsiftp://gar-ex-etpgrid1.garching.physik.uni-muenchen.de:2811/preempt', 'gsiftp://arc1-it4i.farm.particle.cz/qfree', 'gsiftp://arc2-it4i.farm.particle.cz/qfree']:
+                # just update timestamp
+                # Update numbers every time for superMUC since walltime is missing for finished jobs
+                desc = {'tarcstate': self.db.getTimeStamp()}
+                if originaljobinfo.info:
+                    now = datetime.datetime.utcnow()
+                    arcstate = originaljobinfo.info['arcstate']
+                    self.schedule.observe(arcstate, self.age(originaljobinfo.info['tarcstate'], now), False)
+                    interval = self.schedule.interval(arcstate, self.age(originaljobinfo.info['tstate'], now), updatedjob)
+                    desc['nextcheck'] = self.db.getTimeStamp(time.time() + interval)
+                updates.append((id, desc, None))
+                continue
 
-                self.log.info("%s: Job %s: %s -> %s (%s)" % (appjobid, originaljob.JobID, originaljob.State.GetGeneralState(),
-                               updatedjob.State.GetGeneralState(), updatedjob.State.GetSpecificState()))
-
-                # state changed, update whole Job object
-                arcstate = 'submitted'
-                if updatedjob.State == arc.JobState.FINISHED:
-                    if updatedjob.ExitCode == -1:
-                        # Missing exit code, but assume success
-                        self.log.warning("%s: Job %s FINISHED but has missing exit code, setting to zero" % (appjobid, updatedjob.JobID))
-                        updatedjob.ExitCode = 0
-                    arcstate = 'finished'
-                    self.log.debug('%s: reported walltime %d, cputime %d' % (appjobid, updatedjob.UsedTotalWallTime.GetPeriod(), updatedjob.UsedTotalCPUTime.GetPeriod()))
-                elif updatedjob.State == arc.JobState.FAILED:
-                    # EMI-ES reports cancelled jobs as failed so check substate (this is fixed in ARC 6.8)
-                    if 'cancel' in updatedjob.State.GetSpecificState():
-                        arcstate = 'cancelled'
-                    else:
-                        arcstate = self.processJobErrors(id, appjobid, updatedjob)
-                elif updatedjob.State == arc.JobState.KILLED:
+            self.log.info("%s: Job %s: %s -> %s (%s)" % (appjobid, originaljob.JobID, originaljob.State.GetGeneralState(),
+                           updatedjob.State.GetGeneralState(), updatedjob.State.GetSpecificState()))
+
+            # state changed, update whole Job object
+            arcstate = 'submitted'
+            if updatedjob.State == arc.JobState.FINISHED:
+                if updatedjob.ExitCode == -1:
+                    # Missing exit code, but assume success
+                    self.log.warning("%s: Job %s FINISHED but has missing exit code, setting to zero" % (appjobid, updatedjob.JobID))
+                    updatedjob.ExitCode = 0
+                arcstate = 'finished'
+                self.log.debug('%s: reported walltime %d, cputime %d' % (appjobid, updatedjob.UsedTotalWallTime.GetPeriod(), updatedjob.UsedTotalCPUTime.GetPeriod()))
+            elif updatedjob.State == arc.JobState.FAILED:
+                # EMI-ES reports cancelled jobs as failed so check substate (this is fixed in ARC 6.8)
+                if 'cancel' in updatedjob.State.GetSpecificState():
                     arcstate = 'cancelled'
-                elif updatedjob.State == arc.JobState.RUNNING:
-                    arcstate = 'running'
-                elif updatedjob.State == arc.JobState.FINISHING:
-                    arcstate = 'finishing'
-                elif updatedjob.State == arc.JobState.HOLD:
-                    arcstate = 'holding'
-                elif updatedjob.State == arc.JobState.DELETED or \
-                     updatedjob.State == arc.JobState.OTHER:
-                    # unexpected
-                    arcstate = 'failed'
-
-                # Walltime reported by ARC 6 is multiplied by cores
-                if arc.ARC_VERSION_MAJOR >= 6 and updatedjob.RequestedSlots > 0:
-                    updatedjob.UsedTotalWallTime = arc.Period(updatedjob.UsedTotalWallTime.GetPeriod() // updatedjob.RequestedSlots)
-                # Fix crazy wallclock and CPU times
-                if updatedjob.UsedTotalWallTime > arc.Time() - arc.Time(int(created.strftime("%s"))):
-                    fixedwalltime = arc.Time() - arc.Time(int(created.strftime("%s")))
-                    self.log.warning("%s: Fixing reported walltime %d to %d" % (appjobid, updatedjob.UsedTotalWallTime.GetPeriod(), fixedwalltime.GetPeriod()))
-                    updatedjob.UsedTotalWallTime = fixedwalltime
-                if updatedjob.UsedTotalCPUTime > arc.Period(10**7):
-                    self.log.warning("%s: Discarding reported CPUtime %d" % (appjobid, updatedjob.UsedTotalCPUTime.GetPeriod()))
-                    updatedjob.UsedTotalCPUTime = arc.Period(-1)
-                self.db.updateArcJob(id, {'arcstate': arcstate, 'tarcstate': self.db.getTimeStamp(), 'tstate': self.db.getTimeStamp()}, updatedjob)
-
-        self.log.info('Done')
+                else:
+                    arcstate = self.processJobErrors(id, appjobid, updatedjob)
+            elif updatedjob.State == arc.JobState.KILLED:
+                arcstate = 'cancelled'
+            elif updatedjob.State == arc.JobState.RUNNING:
+                arcstate = 'running'
+            elif updatedjob.State == arc.JobState.FINISHING:
+                arcstate = 'finishing'
+            elif updatedjob.State == arc.JobState.HOLD:
+                arcstate = 'holding'
+            elif updatedjob.State == arc.JobState.DELETED or \
+                 updatedjob.State == arc.JobState.OTHER:
+                # unexpected
+                arcstate = 'failed'
+
+            # Walltime reported by ARC 6 is multiplied by cores
+            if arc.ARC_VERSION_MAJOR >= 6 and updatedjob.RequestedSlots > 0:
+                updatedjob.UsedTotalWallTime = arc.Period(updatedjob.UsedTotalWallTime.GetPeriod() // updatedjob.RequestedSlots)
+            # Fix crazy wallclock and CPU times
+            if updatedjob.UsedTotalWallTime > arc.Time() - arc.Time(int(created.strftime("%s"))):
+                fixedwalltime = arc.Time() - arc.Time(int(created.strftime("%s")))
+                self.log.warning("%s: Fixing reported walltime %d to %d" % (appjobid, updatedjob.UsedTotalWallTime.GetPeriod(), fixedwalltime.GetPeriod()))
+                updatedjob.UsedTotalWallTime = fixedwalltime
+            if updatedjob.UsedTotalCPUTime > arc.Period(10**7):
+                self.log.warning("%s: Discarding reported CPUtime %d" % (appjobid, updatedjob.UsedTotalCPUTime.GetPeriod()))
+                updatedjob.UsedTotalCPUTime = arc.Period(-1)
+            if originaljobinfo.info:
+                self.schedule.observe(originaljobinfo.info['arcstate'], self.age(originaljobinfo.info['tarcstate']),
+                                      arcstate != originaljobinfo.info['arcstate'])
+            updates.append((id, {'arcstate': arcstate, 'tarcstate': self.db.getTimeStamp(), 'tstate': self.db.getTimeStamp()}, updatedjob))
+
+        self.db.updateArcJobsBulk(updates)
+
+    def age(self, timestamp, now=None):
+        '''Seconds since timestamp, a UTC datetime from the DB'''
+        if not timestamp:
+            return 0
+        return ((now or datetime.datetime.utcnow()) - timestamp).total_seconds()
 
     def checkLostJobs(self):
         '''
@@ -177,9 +242,10 @@ class aCTStatus(aCTProcess):
         '''
 
         # 2 days limit. TODO: configurable?
-        jobs=self.db.getArcJobsInfo("(arcstate='submitted' or arcstate='running' or arcstate='cancelling' or arcstate='finished') and " \
-                                    "cluster='"+self.cluster+"' and "+self.db.timeStampLessThan("tarcstate", 172800),
-                                    ['id', 'appjobid', 'JobID', 'arcstate'])
+        select = aCTDBQuery().isin('arcstate', ['submitted', 'running', 'cancelling', 'finished']) \
+                             .eq('cluster', self.cluster) \
+                             .raw(self.db.timeStampLessThan("tarcstate", "%s"), 172800)
+        jobs=self.db.getArcJobsInfo(select, ['id', 'appjobid', 'JobID', 'arcstate'])
 
         for job in jobs:
             if job['arcstate'] == 'cancelling':
@@ -224,9 +290,9 @@ class aCTStatus(aCTProcess):
                     # Otherwise mark cancelled
                     self.db.updateArcJob(job['id'], {'arcstate': 'cancelled', 'tarcstate': self.db.getTimeStamp(), 'tstate': self.db.getTimeStamp()})
 
-        jobs = self.db.getArcJobsInfo("arcstate='cancelling' and " \
-                                      "cluster='"+self.cluster+"' and "+self.db.timeStampLessThan("tstate", 3600),
-                                      ['id', 'appjobid'])
+        select = aCTDBQuery().eq('arcstate', 'cancelling').eq('cluster', self.cluster) \
+                             .raw(self.db.timeStampLessThan("tstate", "%s"), 3600)
+        jobs = self.db.getArcJobsInfo(select, ['id', 'appjobid'])
         for job in jobs:
             self.log.info("%s: Job stuck in cancelling for more than 1 hour, marking cancelled" % job['appjobid'])
             self.db.updateArcJob(job['id'], {'arcstate': 'cancelled', 'tarcstate': self.db.getTimeStamp(), 'tstate': self.db.getTimeStamp()})
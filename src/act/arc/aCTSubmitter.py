@@ -1,9 +1,19 @@
 import re
+import socket
 import time
+import threading
+import contextlib
+import functools
 import arc
-from random import shuffle
 from act.common.aCTProcess import aCTProcess
+from act.common import aCTStats
 from act.common.aCTSignal import ExceptInterrupt
+from act.arc.aCTTargetCache import aCTTargetCache
+from act.common.aCTWorkerPool import aCTWorkerPool
+from act.arc import aCTJobCodec
+from act.arc import aCTFairShare
+from act.arc.aCTFetcher import removeManifest
+from act.db.aCTDBQuery import aCTDBQuery
 import multiprocessing, logging
 import signal
 import os
@@ -22,99 +32,6 @@ def KillPool(pool):
         pass
     pool.terminate()
 
-class JobConv:
-
-    def __init__(self):
-        self.jobattrmap = {int: 'integer',
-                      str: 'varchar(255)',
-                      arc.JobState: 'varchar(255)',
-                      arc.StringList: 'varchar(1024)',
-                      arc.URL: 'varchar(255)',
-                      arc.Period: 'int',
-                      arc.Time: 'datetime',
-                      arc.StringStringMap: 'varchar(1024)'}
-        ignoremems=['STDIN',
-                    'STDOUT',
-                    'STDERR',
-                    'STAGEINDIR',
-                    'STAGEOUTDIR',
-                    'SESSIONDIR',
-                    'JOBLOG',
-                    'JOBDESCRIPTION',
-                    'JobDescriptionDocument']
-
-        # Attributes of Job class mapped to DB column type
-        self.jobattrs={}
-        j=arc.Job()
-        for i in dir(j):
-            if re.match('^__',i):
-                continue
-            if i in ignoremems:
-                continue
-            if type(getattr(j, i)) in self.jobattrmap:
-                self.jobattrs[i] = type(getattr(j, i))
-
-    def db2job(self,dbinfo):
-        '''
-        Convert a dictionary of DB key value into arc Job object
-        '''
-        if dbinfo is None:
-            return None
-        j = arc.Job()
-        for attr in self.jobattrs:
-            if attr not in dbinfo or dbinfo[attr] is None:
-                continue
-            # Some object types need special treatment
-            if self.jobattrs[attr] == arc.StringList:
-                l = arc.StringList()
-                for item in dbinfo[attr].split('|'):
-                    l.append(item)
-                setattr(j, attr, l)
-                continue
-            if self.jobattrs[attr] == arc.StringStringMap:
-                m = arc.StringStringMap()
-                d = eval(dbinfo[attr])
-                if not isinstance(d, dict):
-                    continue
-                for (k,v) in d.items():
-                    m[k] = v
-                setattr(j, attr, m)
-                continue
-
-            setattr(j, attr, self.jobattrs[attr](str(dbinfo[attr])))
-        return j
-
-    def job2db(self,job):
-        '''
-        Convert an arc Job object to a dictionary of column name: value
-        '''
-        d = {}
-        for attr in self.jobattrs:
-            if self.jobattrs[attr] == int or self.jobattrs[attr] == str:
-                d[attr] = str(getattr(job, attr))[:250]
-            elif self.jobattrs[attr] == arc.JobState:
-                d[attr] = getattr(job, attr).GetGeneralState()
-            elif self.jobattrs[attr] == arc.StringList:
-                d[attr] = '|'.join(getattr(job, attr))[:1000]
-            elif self.jobattrs[attr] == arc.URL:
-                d[attr] = getattr(job, attr).str().replace(r'\2f',r'/')
-            elif self.jobattrs[attr] == arc.Period:
-                d[attr] = str(getattr(job, attr).GetPeriod())
-            elif self.jobattrs[attr] == arc.Time:
-                if getattr(job, attr).GetTime() != -1:
-                    # Use UTC time but strip trailing Z since mysql doesn't like it
-                    t = str(getattr(job, attr).str(arc.UTCTime))
-                    d[attr] = re.sub('Z$', '', t)
-            elif self.jobattrs[attr] == arc.StringStringMap:
-                ssm = getattr(job, attr)
-                tmpdict = dict(zip(ssm.keys(), ssm.values()))
-                d[attr] = str(tmpdict)[:1000]
-            # Force everything to ASCII
-                        # Force everything to ASCII
-            if attr in d:
-                d[attr] = ''.join([i for i in d[attr] if ord(i) < 128])
-        return d
-
 def Submit(id, appjobid, jobdescstr, ucproxy, timeout):
 
     global queuelist
@@ -162,11 +79,46 @@ def Submit(id, appjobid, jobdescstr, ucproxy, timeout):
         log.error("%s: Submission failed" % appjobid)
         return None
 
-    jconv = JobConv()
-    return jconv.job2db(job)
+    return aCTJobCodec.codec().job2db(job)
 
 class aCTSubmitter(aCTProcess):
 
+    notifystates = {'arcjobs': ('tosubmit', 'tocancel', 'toresubmit', 'torerun')}
+
+    def __init__(self):
+        aCTProcess.__init__(self)
+        # Targets from infosys are reused for infosyscache/ttl seconds and
+        # refreshed in the background up to infosyscache/maxage
+        self.targetcache = aCTTargetCache(self.log,
+                                          ttl=int(self.conf.get(['infosyscache', 'ttl']) or 300),
+                                          maxage=int(self.conf.get(['infosyscache', 'maxage']) or 1800),
+                                          timeout=int(self.conf.get(['atlasgiis', 'timeout']) or 20))
+        # Jobs are claimed for submission under this name, for jobs/submitlease
+        # seconds after which other submitters may take them back
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease = int(self.conf.get(['jobs', 'submitlease']) or 3600)
+        # Shares of waiting jobs to submit, by default deficit round robin
+        self.scheduler = aCTFairShare.getScheduler(self.log, self.conf, self.cluster, self.tmpdir)
+        # Jobs to cancel or resubmit are read jobs/cleanbatch at a time and
+        # cancelled on the CE in chunks of jobs/cleanchunk, as in aCTCleaner
+        self.cleanbatch = int(self.conf.get(['jobs', 'cleanbatch']) or 1000)
+        self.cleanchunk = int(self.conf.get(['jobs', 'cleanchunk']) or 200)
+        self.pool = aCTWorkerPool(self.log, int(self.conf.get(['jobs', 'cleanthreads']) or 4),
+                                  timeout=int(self.conf.get(['jobs', 'cleantimeout']) or 300), name='cancel')
+        # number of pool threads inside ARC, including those of chunks
+        # abandoned by the pool, see submit()
+        self.arccalls = 0
+        self.arclock = threading.Lock()
+
+    def close(self):
+        # release jobs claimed before exiting, e.g. after a submission timeout
+        try:
+            self.reclaimJobs()
+        except Exception as e:
+            self.log.warning("Failed to release claimed jobs: %s" % str(e))
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        aCTProcess.close(self)
+
     def submit(self):
         """
         Main function to submit jobs.
@@ -179,6 +131,18 @@ class aCTSubmitter(aCTProcess):
             self.log.info('Submission suspended due to downtime')
             return
 
+        # no thread may be inside ARC libraries when forking the submission
+        # processes, so wait for cancel and resubmit chunks which timed out
+        # and for infosys queries in the background, including timed out ones
+        with self.arclock:
+            arccalls = self.arccalls
+        if arccalls:
+            self.log.warning('Not submitting while %d timed out cancel or resubmit tasks are running' % arccalls)
+            return
+        if not self.targetcache.waitRefresh(int(self.conf.get(['atlasgiis', 'timeout']) or 20)):
+            self.log.warning('Not submitting while background infosys queries are running')
+            return
+
         # check for any site-specific limits or status
         clusterstatus = self.conf.getCond(["sites", "site"], f"endpoint={self.cluster}", ["status"]) or 'online'
         if clusterstatus == 'offline':
@@ -186,7 +150,7 @@ class aCTSubmitter(aCTProcess):
             return
 
         clustermaxjobs = int(self.conf.getCond(["sites", "site"], f"endpoint={self.cluster}", ["maxjobs"]) or 999999)
-        nsubmitted = self.db.getNArcJobs(f"cluster='{self.cluster}'")
+        nsubmitted = self.db.getCount(cluster=self.cluster)
         if nsubmitted >= clustermaxjobs:
             self.log.info(f'{nsubmitted} submitted jobs is greater than or equal to max jobs {clustermaxjobs}')
             return
@@ -201,68 +165,72 @@ class aCTSubmitter(aCTProcess):
             clusterhost = clusterurl.Host()
             clusterqueue = clusterurl.Path()[1:] # strip off leading slash
 
-        # Apply fair-share
+        # Jobs waiting for this cluster by share, i.e. (fairshare, proxyid)
+        select = aCTDBQuery().eq('arcstate', 'tosubmit')
         if self.cluster:
-            fairshares = self.db.getArcJobsInfo("arcstate='tosubmit' and clusterlist like '%"+self.cluster+"%'", ['fairshare', 'proxyid'])
+            # jobs may be taken by submitters of other clusters in the clusterlist
+            select.raw(*self.db.clusterListClause(self.cluster))
         else:
-            fairshares = self.db.getArcJobsInfo("arcstate='tosubmit' and clusterlist=''", ['fairshare', 'proxyid'])
+            select.eq('clusterlist', '')
+        shares = self.db.getArcJobsShares(select)
 
-        if not fairshares:
+        if not shares:
             self.log.info('Nothing to submit')
             return
 
-        # split by proxy for GU queues
-        fairshares = list(set([(p['fairshare'], p['proxyid']) for p in fairshares]))
-        # For proxy bug - see below
-        shuffle(fairshares)
-
-        for fairshare, proxyid in fairshares:
-
-            # apply maxjobs limit (check above should make sure greater than zero)
-            # Note: relies on exit after first loop
-            limit = min(clustermaxjobs - nsubmitted, 100)
-            try:
-                # catch any exceptions here to avoid leaving lock
-                if self.cluster:
-                    # Lock row for update in case multiple clusters are specified
-                    #jobs=self.db.getArcJobsInfo("arcstate='tosubmit' and ( clusterlist like '%{0}' or clusterlist like '%{0},%' ) and fairshare='{1}' order by priority desc limit 10".format(self.cluster, fairshare),
-                    jobs=self.db.getArcJobsInfo("arcstate='tosubmit' and ( clusterlist like '%{0}' or clusterlist like '%{0},%' ) and fairshare='{1}' and proxyid='{2}' limit {3}".format(self.cluster, fairshare, proxyid, limit),
-                                                columns=["id", "jobdesc", "appjobid", "priority", "proxyid", "clusterlist"], lock=True)
-                    if jobs:
-                        self.log.debug("started lock for writing %d jobs"%len(jobs))
-                else:
-                    jobs=self.db.getArcJobsInfo("arcstate='tosubmit' and clusterlist='' and fairshare='{0} and proxyid={1}' limit {2}".format(fairshare, proxyid, limit),
-                                                columns=["id", "jobdesc", "appjobid", "priority", "proxyid", "clusterlist"])
-                # mark submitting in db
-                jobs_taken=[]
-                for j in jobs:
-                    jd={'cluster': self.cluster, 'arcstate': 'submitting', 'tarcstate': self.db.getTimeStamp()}
-                    self.db.updateArcJobLazy(j['id'],jd)
-                    jobs_taken.append(j)
-                jobs=jobs_taken
-
-            finally:
-                if self.cluster:
-                    try:
-                        self.db.Commit(lock=True)
-                        self.log.debug("ended lock")
-                    except:
-                        self.log.warning("Failed to release DB lock")
-                else:
-                    self.db.Commit()
+        # Limit queued jobs to queuefraction of running jobs plus queueoffset,
+        # set for the site or in jobs
+        counts = self.db.getCounts(('fairshare', 'arcstate'), cluster=self.cluster, arcstate=['submitted', 'running'])
+        nqueued = sum(n for (fs, state), n in counts.items() if state == 'submitted')
+        nrunning = sum(n for (fs, state), n in counts.items() if state == 'running')
+        qfraction = float(self.conf.getCond(["sites", "site"], f"endpoint={self.cluster}", ["queuefraction"]) or
+                          self.conf.get(['jobs', 'queuefraction']) or 0.15)
+        qoffset = int(self.conf.getCond(["sites", "site"], f"endpoint={self.cluster}", ["queueoffset"]) or
+                      self.conf.get(['jobs', 'queueoffset']) or 100)
+        free = max(0, min(int(nrunning * qfraction + qoffset) - nqueued, clustermaxjobs - nsubmitted))
+        self.log.debug("running %d, queued %d, free %d" % (nrunning, nqueued, free))
+
+        # list of (share, number of jobs, minimum priority)
+        allocation = [(share, n, None) for share, n in self.scheduler.schedule(dict((s, v[0]) for s, v in shares.items()), free)]
+        # high priority jobs are submitted above the limit, if they have higher
+        # priority than jobs already queued for their fairshare
+        spare = clustermaxjobs - nsubmitted - sum(n for share, n, p in allocation)
+        for share, (n, maxpriowaiting) in shares.items():
+            if maxpriowaiting <= 10 or spare <= 0 or share in [a[0] for a in allocation]:
+                continue
+            qjobs = self.db.getArcJobsInfo(aCTDBQuery().eq('cluster', self.cluster).eq('arcstate', 'submitted').eq('fairshare', share[0])
+                                           .order('priority', desc=True).limit(1), ['priority'])
+            maxprioqueued = qjobs[0]['priority'] if qjobs and qjobs[0]['priority'] is not None else 0
+            if maxpriowaiting > maxprioqueued:
+                self.log.info("Overriding limit for fairshare %s, maxpriowaiting: %d > maxprioqueued: %d" % (share[0], maxpriowaiting, maxprioqueued))
+                allocation.append((share, min(spare, 100), maxprioqueued))
+                spare -= min(spare, 100)
+
+        if not allocation:
+            self.log.info("%s already at limit of submitted jobs" % self.cluster)
+            return
+
+        for (fairshare, proxyid), limit, minpriority in allocation:
+
+            select = aCTDBQuery().eq('arcstate', 'tosubmit')
+            if self.cluster:
+                # jobs may be taken by submitters of other clusters in the clusterlist
+                select.raw(*self.db.clusterListClause(self.cluster))
+            else:
+                select.eq('clusterlist', '')
+            if minpriority is not None:
+                select.raw('priority>%s', minpriority)
+            # highest priority first within the share
+            select.eq('fairshare', fairshare).eq('proxyid', proxyid).order('priority', desc=True).limit(limit)
+            # mark submitting in db, skipping jobs other submitters are claiming
+            jobs = self.db.claimArcJobs(select, ["id", "jobdesc", "appjobid", "priority", "proxyid", "clusterlist"],
+                                        self.cluster, self.owner, self.lease)
 
             if len(jobs) == 0:
                 #self.log.debug("No jobs to submit")
                 continue
             self.log.info("Submitting %d jobs for fairshare %s and proxyid %d" % (len(jobs), fairshare, proxyid))
 
-            # max waiting priority
-            try:
-                maxpriowaiting = max(jobs,key = lambda x : x['priority'])['priority']
-            except:
-                maxpriowaiting = 0
-            self.log.info("Maximum priority of waiting jobs: %d" % maxpriowaiting)
-
             # Query infosys - either local or index
             if self.cluster:
                 if self.cluster.find('://') != -1:
@@ -293,13 +261,10 @@ class aCTSubmitter(aCTProcess):
             self.uc.CredentialString(proxystring)
             global usercred
             usercred = self.uc
-            # retriever contains a list of CE endpoints
-            retriever = arc.ComputingServiceRetriever(self.uc, infoendpoints)
-            retriever.wait()
-            # targets is the list of queues
+            # targets is the list of queues, possibly cached from a previous query
             # parse target.ComputingService.ID for the CE hostname
             # target.ComputingShare.Name is the queue name
-            targets = retriever.GetExecutionTargets()
+            targets = self.targetcache.getTargets(self.uc, infoendpoints, proxystring)
 
             # Filter only sites for this process
             queuelist=[]
@@ -335,36 +300,9 @@ class aCTSubmitter(aCTProcess):
                     target.ComputingShare.LocalWaitingJobs = 0
                     target.ComputingShare.PreLRMSWaitingJobs = 0
                     target.ExecutionEnvironment.CPUClockSpeed = 2000
-                    qjobs=self.db.getArcJobsInfo("cluster='" +str(self.cluster)+ "' and  arcstate='submitted' and fairshare='%s'" % fairshare, ['id','priority'])
-                    rjobs=self.db.getArcJobsInfo("cluster='" +str(self.cluster)+ "' and  arcstate='running' and fairshare='%s'" % fairshare, ['id'])
-
-                    # max queued priority
-                    try:
-                        maxprioqueued = max(qjobs,key = lambda x : x['priority'])['priority']
-                    except:
-                        maxprioqueued = 0
-                    self.log.info("Max priority queued: %d" % maxprioqueued)
-
-                    # Limit number of submitted jobs using configuration or default (0.15 + 100/num of shares)
-                    # Note: assumes only a few shares are used
-                    qfraction = float(self.conf.get(['jobs', 'queuefraction'])) if self.conf.get(['jobs', 'queuefraction']) else 0.15
-                    qoffset = int(self.conf.get(['jobs', 'queueoffset'])) if self.conf.get(['jobs', 'queueoffset']) else 100
-                    jlimit = len(rjobs) * qfraction + qoffset/len(fairshares)
-                    self.log.debug("running %d, queued %d, queue limit %d" % (len(rjobs), len(qjobs), jlimit))
-                    if str(self.cluster).find('arc-boinc-0') != -1:
-                        jlimit = len(rjobs)*0.15 + 400
-                    if str(self.cluster).find('XXXpikolit') != -1:
-                        jlimit = len(rjobs)*0.15 + 100
-                    if str(self.cluster).find('arc05.lcg') != -1:
-                        jlimit = len(rjobs)*0.15 + 400
-                    target.ComputingShare.PreLRMSWaitingJobs=len(qjobs)
-                    if len(qjobs) < jlimit or ( ( maxpriowaiting > maxprioqueued ) and ( maxpriowaiting > 10 ) ) :
-                        if maxpriowaiting > maxprioqueued :
-                            self.log.info("Overriding limit, maxpriowaiting: %d > maxprioqueued: %d" % (maxpriowaiting, maxprioqueued))
-                        queuelist.append(target)
-                        self.log.debug("Adding target %s:%s" % (targethost, targetqueue))
-                    else:
-                        self.log.info("%s/%s already at limit of submitted jobs for fairshare %s" % (targethost, targetqueue, fairshare))
+                    target.ComputingShare.PreLRMSWaitingJobs = counts.get((fairshare, 'submitted'), 0)
+                    queuelist.append(target)
+                    self.log.debug("Adding target %s:%s" % (targethost, targetqueue))
 
             # check if any queues are available, if not leave and try again next time
             if not queuelist:
@@ -391,6 +329,8 @@ class aCTSubmitter(aCTProcess):
                 npools=int(self.conf.get(['parallelsubmit','npools']))
             self.log.debug("Starting submitters: %s" % npools)
 
+            # no thread may be inside ARC libraries when forking, refreshes
+            # were waited for above and only start after submission
             pool = multiprocessing.Pool(npools)
             #results = []
             #for task in tasks:
@@ -402,11 +342,11 @@ class aCTSubmitter(aCTProcess):
             # timeout per submission
             timeout = 60
             stopflag = False
+            nsubmittedshare = 0
             for result,task in zip(results,tasks):
                 try:
                     jdb = result.get(timeout)
-                    jconv = JobConv()
-                    job = jconv.db2job(jdb)
+                    job = aCTJobCodec.codec().db2job(jdb)
                 except multiprocessing.TimeoutError:
                     self.log.error("%s: submission timeout: exit and try again" % task[1])
                     # abort submission if Submit process is stuck
@@ -414,11 +354,14 @@ class aCTSubmitter(aCTProcess):
                     KillPool(pool)
                     pool.join()
                     stopflag = True
+                    self.targetcache.invalidate(infoendpoints, proxystring)
                     # reduce timeout to finish quickly
                     timeout = 0.1
                     continue
                 if job is None:
                     self.log.error("%s: no job defined for %d" % (task[1], task[0]))
+                    # cached target may be out of date
+                    self.targetcache.invalidate(infoendpoints, proxystring)
                     continue
                 jd={}
                 jd['arcstate']='submitted'
@@ -429,6 +372,8 @@ class aCTSubmitter(aCTProcess):
                 self.log.info("%s: job id %s" % (task[1], job.JobID))
                 jd['cluster']=self.cluster
                 self.db.updateArcJobLazy(task[0],jd,job)
+                nsubmittedshare += 1
+            self.scheduler.charge((fairshare, proxyid), nsubmittedshare)
             if not stopflag:
                 pool.terminate()
                 pool.join()
@@ -449,110 +394,158 @@ class aCTSubmitter(aCTProcess):
         return
 
 
-    def checkFailedSubmissions(self):
+    def reclaimJobs(self):
+        '''
+        Release jobs this submitter failed to submit and jobs whose claim
+        expired since their submitter died
+        '''
+        self.db.reclaimArcJobs(self.cluster, self.owner, self.lease)
 
-        jobs = self.db.getArcJobsInfo("arcstate='submitting' and cluster='"+self.cluster+"'", ["id"])
+    @contextlib.contextmanager
+    def arcCall(self, proxystring):
+        '''
+        Yield a UserConfig of its own for proxystring to a pool thread calling
+        ARC, counting the call in arccalls until it returns
+        '''
+        with self.arclock:
+            self.arccalls += 1
+        try:
+            yield self.userConfig(proxystring)
+        finally:
+            with self.arclock:
+                self.arccalls -= 1
 
-        for j in jobs:
-            self.db.updateArcJob(j['id'], {"arcstate": "tosubmit",
-                                           "tarcstate": self.db.getTimeStamp(),
-                                           "cluster": None})
+    def cancelChunk(self, proxystring, jobs):
+        '''
+        Cancel jobs, a list of (id, appjobid, arc.Job, created), on the CE and
+        return the IDs not cancelled. Runs in the worker pool.
+        '''
+        with self.arcCall(proxystring) as uc:
+            job_supervisor = aCTStats.instrument(arc.JobSupervisor(uc, [j[2] for j in jobs]), 'arc')
+            job_supervisor.Update()
+            job_supervisor.Cancel()
+            return set(job_supervisor.GetIDsNotProcessed())
 
     def processToCancel(self):
 
         if self.cluster:
-            jobstocancel = self.db.getArcJobs("arcstate='tocancel' and (cluster='{0}' or clusterlist like '%{0}' or clusterlist like '%{0},%')".format(self.cluster))
+            clause, *params = self.db.clusterListClause(self.cluster)
+            select = aCTDBQuery().eq('arcstate', 'tocancel').raw('(cluster=%s or '+clause+')', self.cluster, *params)
         else:
-            jobstocancel = self.db.getArcJobs("arcstate='tocancel' and cluster=''")
-        if not jobstocancel:
+            select = aCTDBQuery().eq('arcstate', 'tocancel').eq('cluster', '')
+
+        for jobstocancel in self.db.iterArcJobs(select, self.db.jobcontrolattrs, batch=self.cleanbatch):
+            self.log.info("Cancelling %i jobs" % sum(len(v) for v in jobstocancel.values()))
+            for proxyid, jobs in jobstocancel.items():
+                cancel = functools.partial(self.cancelChunk, str(self.db.getProxy(proxyid)))
+
+                for chunk, f in self.pool.mapChunks(cancel, jobs, self.cleanchunk):
+                    try:
+                        notcancelled = f.result()
+                    except Exception as e:
+                        # left in tocancel to try again next time
+                        self.log.warning("Failed to cancel %d jobs of proxy %s: %s" % (len(chunk), proxyid, str(e)))
+                        continue
+
+                    updates = []
+                    for (id, appjobid, job, created) in chunk:
+                        # the output of a job cancelled while in tofetch is
+                        # not fetched any more
+                        removeManifest(self.tmpdir, job.JobID)
+
+                        if not job.JobID:
+                            # Job not submitted
+                            self.log.info("%s: Marking unsubmitted job cancelled" % appjobid)
+                            updates.append((id, {"arcstate": "cancelled",
+                                                 "tarcstate": self.db.getTimeStamp()}, None))
+
+                        elif job.JobID in notcancelled:
+                            if job.State == arc.JobState.UNDEFINED:
+                                # If longer than one hour since submission assume job never made it
+                                if arc.Time(int(created.strftime("%s"))) + arc.Period(3600) < arc.Time():
+                                    self.log.warning("%s: Assuming job %s is lost and marking as cancelled" % (appjobid, job.JobID))
+                                    updates.append((id, {"arcstate": "cancelled",
+                                                         "tarcstate": self.db.getTimeStamp()}, None))
+                                else:
+                                    # Job has not yet reached info system
+                                    self.log.warning("%s: Job %s is not yet in info system so cannot be cancelled" % (appjobid, job.JobID))
+                            else:
+                                self.log.error("%s: Could not cancel job %s" % (appjobid, job.JobID))
+                                # Just to mark as cancelled so it can be cleaned
+                                updates.append((id, {"arcstate": "cancelled",
+                                                     "tarcstate": self.db.getTimeStamp()}, None))
+                        else:
+                            updates.append((id, {"arcstate": "cancelling",
+                                                 "tarcstate": self.db.getTimeStamp(),
+                                                 "tstate": self.db.getTimeStamp()}, None))
+                    self.db.updateArcJobsBulk(updates)
+
+    def resubmitChunk(self, proxystring, jobs):
+        '''
+        Cancel and clean on the CE the submitted jobs among jobs, a list of
+        (id, appjobid, arc.Job, created). Runs in the worker pool.
+        '''
+        # Clean up jobs which were submitted
+        jobstoclean = [job[2] for job in jobs if job[2].JobID]
+
+        if not jobstoclean:
             return
 
-        self.log.info("Cancelling %i jobs" % sum(len(v) for v in jobstocancel.values()))
-        for proxyid, jobs in jobstocancel.items():
-            self.uc.CredentialString(str(self.db.getProxy(proxyid)))
+        with self.arcCall(proxystring) as uc:
 
-            job_supervisor = arc.JobSupervisor(self.uc, [j[2] for j in jobs])
+            # Put all jobs to cancel, however the supervisor will only cancel
+            # cancellable jobs and remove the rest so there has to be 2 calls
+            # to Clean()
+            job_supervisor = aCTStats.instrument(arc.JobSupervisor(uc, jobstoclean), 'arc')
             job_supervisor.Update()
+            self.log.info("Cancelling %i jobs" % len(jobstoclean))
             job_supervisor.Cancel()
 
-            notcancelled = job_supervisor.GetIDsNotProcessed()
-
-            for (id, appjobid, job, created) in jobs:
+            processed = job_supervisor.GetIDsProcessed()
+            notprocessed = job_supervisor.GetIDsNotProcessed()
+            # Clean the successfully cancelled jobs
+            if processed:
+                job_supervisor.SelectByID(processed)
+                self.log.info("Cleaning %i jobs" % len(processed))
+                if not job_supervisor.Clean():
+                    self.log.warning("Failed to clean some jobs")
+
+            # New job supervisor with the uncancellable jobs
+            if notprocessed:
+                notcancellable = [job for job in jobstoclean if job.JobID in notprocessed]
+                job_supervisor = aCTStats.instrument(arc.JobSupervisor(uc, notcancellable), 'arc')
+                job_supervisor.Update()
 
-                if not job.JobID:
-                    # Job not submitted
-                    self.log.info("%s: Marking unsubmitted job cancelled" % appjobid)
-                    self.db.updateArcJob(id, {"arcstate": "cancelled",
-                                              "tarcstate": self.db.getTimeStamp()})
-
-                elif job.JobID in notcancelled:
-                    if job.State == arc.JobState.UNDEFINED:
-                        # If longer than one hour since submission assume job never made it
-                        if arc.Time(int(created.strftime("%s"))) + arc.Period(3600) < arc.Time():
-                            self.log.warning("%s: Assuming job %s is lost and marking as cancelled" % (appjobid, job.JobID))
-                            self.db.updateArcJob(id, {"arcstate": "cancelled",
-                                                      "tarcstate": self.db.getTimeStamp()})
-                        else:
-                            # Job has not yet reached info system
-                            self.log.warning("%s: Job %s is not yet in info system so cannot be cancelled" % (appjobid, job.JobID))
-                    else:
-                        self.log.error("%s: Could not cancel job %s" % (appjobid, job.JobID))
-                        # Just to mark as cancelled so it can be cleaned
-                        self.db.updateArcJob(id, {"arcstate": "cancelled",
-                                                  "tarcstate": self.db.getTimeStamp()})
-                else:
-                    self.db.updateArcJob(id, {"arcstate": "cancelling",
-                                              "tarcstate": self.db.getTimeStamp(),
-                                              "tstate": self.db.getTimeStamp()})
+                self.log.info("Cleaning %i jobs" % len(notcancellable))
+                if not job_supervisor.Clean():
+                    self.log.warning("Failed to clean some jobs")
 
     def processToResubmit(self):
 
         if self.cluster:
-            jobstoresubmit = self.db.getArcJobs("arcstate='toresubmit' and cluster='"+self.cluster+"'")
+            select = aCTDBQuery().eq('arcstate', 'toresubmit').eq('cluster', self.cluster)
         else:
-            jobstoresubmit = self.db.getArcJobs("arcstate='toresubmit' and clusterlist=''")
-
-        for proxyid, jobs in jobstoresubmit.items():
-            self.uc.CredentialString(str(self.db.getProxy(proxyid)))
+            select = aCTDBQuery().eq('arcstate', 'toresubmit').eq('clusterlist', '')
 
-            # Clean up jobs which were submitted
-            jobstoclean = [job[2] for job in jobs if job[2].JobID]
+        for jobstoresubmit in self.db.iterArcJobs(select, self.db.jobcontrolattrs, batch=self.cleanbatch):
+            for proxyid, jobs in jobstoresubmit.items():
+                resubmit = functools.partial(self.resubmitChunk, str(self.db.getProxy(proxyid)))
 
-            if jobstoclean:
-
-                # Put all jobs to cancel, however the supervisor will only cancel
-                # cancellable jobs and remove the rest so there has to be 2 calls
-                # to Clean()
-                job_supervisor = arc.JobSupervisor(self.uc, jobstoclean)
-                job_supervisor.Update()
-                self.log.info("Cancelling %i jobs" % len(jobstoclean))
-                job_supervisor.Cancel()
-
-                processed = job_supervisor.GetIDsProcessed()
-                notprocessed = job_supervisor.GetIDsNotProcessed()
-                # Clean the successfully cancelled jobs
-                if processed:
-                    job_supervisor.SelectByID(processed)
-                    self.log.info("Cleaning %i jobs" % len(processed))
-                    if not job_supervisor.Clean():
-                        self.log.warning("Failed to clean some jobs")
-
-                # New job supervisor with the uncancellable jobs
-                if notprocessed:
-                    notcancellable = [job for job in jobstoclean if job.JobID in notprocessed]
-                    job_supervisor = arc.JobSupervisor(self.uc, notcancellable)
-                    job_supervisor.Update()
-
-                    self.log.info("Cleaning %i jobs" % len(notcancellable))
-                    if not job_supervisor.Clean():
-                        self.log.warning("Failed to clean some jobs")
-
-            # Empty job to reset DB info
-            j = arc.Job()
-            for (id, appjobid, job, created) in jobs:
-                self.db.updateArcJob(id, {"arcstate": "tosubmit",
-                                          "tarcstate": self.db.getTimeStamp(),
-                                          "cluster": None}, j)
+                for chunk, f in self.pool.mapChunks(resubmit, jobs, self.cleanchunk):
+                    try:
+                        f.result()
+                    except Exception as e:
+                        # left in toresubmit so that the old jobs are not left running
+                        self.log.warning("Failed to cancel %d jobs of proxy %s: %s" % (len(chunk), proxyid, str(e)))
+                        continue
+
+                    for (id, appjobid, job, created) in chunk:
+                        removeManifest(self.tmpdir, job.JobID)
+                    # Empty job to reset DB info
+                    j = arc.Job()
+                    self.db.updateArcJobsBulk([(id, {"arcstate": "tosubmit",
+                                                     "tarcstate": self.db.getTimeStamp(),
+                                                     "cluster": None}, j) for (id, appjobid, job, created) in chunk])
 
     def processToRerun(self):
 
@@ -560,7 +553,7 @@ class aCTSubmitter(aCTProcess):
             # Rerun only applies to job which have been submitted
             return
 
-        jobstorerun = self.db.getArcJobs("arcstate='torerun' and cluster='"+self.cluster+"'")
+        jobstorerun = self.db.getArcJobs("arcstate='torerun' and cluster='"+self.cluster+"'", self.db.jobcontrolattrs)
         if not jobstorerun:
             return
 
@@ -573,11 +566,11 @@ class aCTSubmitter(aCTProcess):
         for proxyid, jobs in jobstorerun.items():
             self.uc.CredentialString(str(self.db.getProxy(proxyid)))
 
-            job_supervisor = arc.JobSupervisor(self.uc, [j[2] for j in jobs])
+            job_supervisor = aCTStats.instrument(arc.JobSupervisor(self.uc, [j[2] for j in jobs]), 'arc')
             job_supervisor.Update()
             # Renew proxy to be safe
             job_supervisor.Renew()
-            job_supervisor = arc.JobSupervisor(self.uc, [j[2] for j in jobs])
+            job_supervisor = aCTStats.instrument(arc.JobSupervisor(self.uc, [j[2] for j in jobs]), 'arc')
             job_supervisor.Update()
             job_supervisor.Resume()
 
@@ -606,8 +599,10 @@ class aCTSubmitter(aCTProcess):
         self.processToRerun()
         # submit new jobs
         self.submit()
+        # query infosys again for targets used from cache
+        self.targetcache.refreshStale()
         # check jobs which failed to submit
-        self.checkFailedSubmissions()
+        self.reclaimJobs()
 
 
 # Main
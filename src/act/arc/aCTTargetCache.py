@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+import arc
+
+from act.common import aCTStats
+from act.common.aCTWorkerPool import aCTWorkerPool
+
+class aCTTargetCache:
+    '''
+    Cache of ExecutionTargets returned by infosys queries, keyed by the list
+    of info endpoints and their interfaces and by the proxy used, since what
+    an infosys returns may depend on the identity asking. Entries younger than ttl seconds
+    are used as they are. Older entries are still returned, up to maxage
+    seconds, and queried again in a background thread started by
+    refreshStale() (stale-while-revalidate). Entries are dropped with
+    invalidate(), e.g. after a submission failure, so the next lookup
+    queries infosys again.
+
+    The submitter forks processes to submit jobs and a fork while another
+    thread is inside the ARC libraries may leave locks held in the child.
+    refreshStale() should therefore be called after submissions are done,
+    and waitRefresh() before forking. A refresh abandoned by the pool timeout
+    may still be inside ARC, so waitRefresh() waits for its thread to return.
+    '''
+
+    def __init__(self, log, ttl=300, maxage=1800, timeout=20):
+        self.log = log
+        self.ttl = ttl
+        self.maxage = maxage
+        # key: (query time, retriever, targets). The retriever is kept since
+        # targets may refer to memory it owns
+        self.entries = {}
+        self.lock = threading.Lock()
+        # key: (infoendpoints, proxystring) of stale entries to refresh
+        self.stale = {}
+        # keys being refreshed in the background: future. A key is removed
+        # when its refresh returns, even after the pool timed it out
+        self.refreshing = {}
+        self.timeout = timeout
+        self.pool = aCTWorkerPool(log, 1, timeout=3*timeout, name='infosys')
+
+    def _key(self, infoendpoints, proxystring):
+        # digest of the proxy, to keep keys short and credentials out of logs
+        proxy = hashlib.sha1(proxystring.encode()).hexdigest()[:12]
+        return (tuple((e.URLString, e.InterfaceName) for e in infoendpoints), proxy)
+
+    def _query(self, uc, infoendpoints):
+        with aCTStats.timer('arc', 'ComputingServiceRetriever'):
+            retriever = arc.ComputingServiceRetriever(uc, infoendpoints)
+            retriever.wait()
+        return (time.time(), retriever, list(retriever.GetExecutionTargets()))
+
+    def _refresh(self, key, infoendpoints, proxystring):
+        try:
+            # separate UserConfig since the agent's one changes credential
+            cred_type = arc.initializeCredentialsType(arc.initializeCredentialsType.SkipCredentials)
+            uc = arc.UserConfig(cred_type)
+            uc.Timeout(self.timeout)
+            uc.CredentialString(proxystring)
+            entry = self._query(uc, infoendpoints)
+            with self.lock:
+                self.entries[key] = entry
+            self.log.debug('Refreshed %d targets from %s' % (len(entry[2]), str(key)))
+        except Exception as e:
+            self.log.warning('Background infosys query of %s failed: %s' % (str(key), str(e)))
+        finally:
+            with self.lock:
+                self.refreshing.pop(key, None)
+
+    def getTargets(self, uc, infoendpoints, proxystring):
+        '''
+        Return the list of ExecutionTargets for infoendpoints, querying them
+        with uc if there is no usable cached entry. proxystring is used for
+        background refreshes.
+        '''
+        key = self._key(infoendpoints, proxystring)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and now - entry[0] < self.ttl:
+            return entry[2]
+        if entry and now - entry[0] < self.maxage:
+            self.stale[key] = (infoendpoints, proxystring)
+            self.log.debug('Using targets from %s cached %ds ago' % (str(key), now - entry[0]))
+            return entry[2]
+
+        entry = self._query(uc, infoendpoints)
+        with self.lock:
+            if self.ttl > 0:
+                self.entries[key] = entry
+        return entry[2]
+
+    def invalidate(self, infoendpoints, proxystring):
+        key = self._key(infoendpoints, proxystring)
+        with self.lock:
+            if self.entries.pop(key, None):
+                self.log.info('Invalidated cached targets from %s' % str(key))
+
+    def refreshStale(self):
+        '''Start background queries for stale entries returned by getTargets()'''
+        for key, (infoendpoints, proxystring) in self.stale.items():
+            with self.lock:
+                if key in self.refreshing:
+                    continue
+                self.refreshing[key] = self.pool.submit(self._refresh, key, infoendpoints, proxystring)
+        self.stale = {}
+
+    def waitRefresh(self, timeout=None):
+        '''
+        Wait up to timeout seconds for the threads of background refreshes to
+        return, needed before forking since the child would inherit locks
+        held by a refresh thread. Returns False if some are still running.
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with self.lock:
+                if not self.refreshing:
+                    return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.1)
@@ -5,9 +5,11 @@ import traceback
 
 from act.common import aCTLogger
 from act.common import aCTConfig
-from act.common import aCTUtils
 from act.common import aCTSignal
+from act.common import aCTStats
+from act.common.aCTNotify import aCTNotify
 from act.arc import aCTDBArc
+from act.db.aCTDBMS import aCTDBLockError
 from act.condor import aCTDBCondor
 from act.atlas import aCTCRICParser
 from act.atlas import aCTAPFMon
@@ -20,6 +22,10 @@ class aCTATLASProcess:
     provides basic start and stop functionality.
     '''
 
+    # Job state changes which wake up the agent, as {table: states} where
+    # states None means any state. Subclasses list the states they process.
+    notifystates = {'pandajobs': None, 'arcjobs': None, 'condorjobs': None}
+
     def __init__(self, ceflavour=['ARC-CE']):
 
         # Get agent name from /path/to/aCTAgent.py
@@ -50,6 +56,15 @@ class aCTATLASProcess:
         self.osmap = {}
         self.sitesselect = ''
 
+        # Notifications of changes to the job states processed by the agent
+        self.notify = aCTNotify(self.log, self.arcconf)
+        for table, states in self.notifystates.items():
+            self.notify.listen(table, None, states)
+        self.loopinterval = float(self.arcconf.get(['notify', 'mininterval']) or 1)
+
+        # loop and Panda call timings exported by aCTMonitor
+        self.stats = aCTStats.setup(self.log, self.arcconf, self.name)
+
         # start time for periodic restart
         self.starttime=time.time()
         self.log.info("Started %s", self.name)
@@ -77,9 +92,21 @@ class aCTATLASProcess:
                 self.conf.parse()
                 self.arcconf.parse()
                 # do class-specific things
-                self.process()
-                # sleep
-                aCTUtils.sleep(2)
+                looptime = time.time()
+                try:
+                    self.process()
+                except aCTDBLockError as e:
+                    # rolled back, the jobs are processed again in the next loop
+                    self.log.warning("DB lock conflict: %s" % str(e))
+                # DB connection is shared by all tables
+                dbstats = self.dbarc.db.resetStats()
+                self.stats.observeLoop(time.time() - looptime, dbstats)
+                self.stats.write()
+                self.log.debug("DB operations in loop: %(queries)d queries, %(commits)d commits, %(reconnects)d reconnects, %(rows)d rows, %(lockwaits)d lock waits, %(dbtime).3fs" % dbstats)
+                # sleep until jobs change or for 2 seconds, but not less than
+                # loopinterval between loops
+                self.notify.wait(2)
+                time.sleep(max(0, looptime + self.loopinterval - time.time()))
                 # restart periodically in case of hangs
                 #ip=int(self.conf.get(['periodicrestart', self.name.lower()]))
                 #if time.time()-self.starttime > ip and ip != 0 :
@@ -97,5 +124,6 @@ class aCTATLASProcess:
         '''
         Clean up code when process exits
         '''
+        self.notify.close()
         self.log.info("Cleanup for %s", self.name)
         os._exit(0)
@@ -15,6 +15,10 @@ from act.atlas.aCTPandaJob import aCTPandaJob
 
 class aCTATLASStatus(aCTATLASProcess):
 
+    notifystates = {'pandajobs': ('tobekilled',),
+                    'arcjobs': ('submitted', 'holding', 'running', 'finishing', 'done', 'failed', 'donefailed',
+                                'cancelled', 'lost', 'tocancel', 'cancelling', 'toclean')}
+
     def __init__(self):
         aCTATLASProcess.__init__(self, ceflavour=['ARC-CE'])
 
@@ -108,24 +112,20 @@ class aCTATLASStatus(aCTATLASProcess):
         """
         select = "((arcjobs.arcstate in ('submitted', 'holding') and pandajobs.actpandastatus='sent') or"
         select += " (arcjobs.arcstate in ('tosubmit', 'submitting', 'submitted', 'holding') and pandajobs.actpandastatus='running'))"
-        select += " and arcjobs.id=pandajobs.arcjobid and pandajobs.sitename in %s limit 100000" % self.sitesselect
+        select += " and arcjobs.id=pandajobs.arcjobid and pandajobs.sitename in %s" % self.sitesselect
         columns = ["arcjobs.id", "arcjobs.cluster", "arcjobs.appjobid"]
-        jobstoupdate=self.dbarc.getArcJobsInfo(select, columns=columns, tables="arcjobs,pandajobs")
-
-        if len(jobstoupdate) == 0:
-            return
-        else:
+        for jobstoupdate in self.dbarc.iterArcJobsInfo(select, columns=columns, tables="arcjobs,pandajobs"):
             self.log.debug("Found %d submitted jobs (%s)" % (len(jobstoupdate), ','.join([j['appjobid'] for j in jobstoupdate])))
 
-        for aj in jobstoupdate:
-            select = "arcjobid='"+str(aj["id"])+"'"
-            desc = {}
-            desc["pandastatus"] = "starting"
-            desc["actpandastatus"] = "starting"
-            if aj['cluster']:
-                desc["computingElement"] = urlparse(aj['cluster']).hostname
-            self.dbpanda.updateJobsLazy(select, desc)
-        self.dbpanda.Commit()
+            updates = []
+            for aj in jobstoupdate:
+                desc = {}
+                desc["pandastatus"] = "starting"
+                desc["actpandastatus"] = "starting"
+                if aj['cluster']:
+                    desc["computingElement"] = urlparse(aj['cluster']).hostname
+                updates.append((aj["id"], desc))
+            self.dbpanda.updateJobsBulk(updates, key='arcjobid')
 
 
     def updateRunningJobs(self,state):
@@ -144,48 +144,53 @@ class aCTATLASStatus(aCTATLASProcess):
            select = "arcjobs.id=pandajobs.arcjobid and arcjobs.arcstate in ('running') and pandajobs.actpandastatus in ('starting', 'sent')"
         if state == "finishing":
            select = "arcjobs.id=pandajobs.arcjobid and arcjobs.arcstate in ('finishing') and pandajobs.actpandastatus in ('starting', 'sent', 'running')"
-        select += " and pandajobs.sitename in %s limit 100000" % self.sitesselect
+        select += " and pandajobs.sitename in %s" % self.sitesselect
 
         columns = ["arcjobs.id", "arcjobs.UsedTotalWalltime", "arcjobs.ExecutionNode",
                    "arcjobs.cluster", "arcjobs.RequestedSlots", "pandajobs.pandaid", "pandajobs.siteName", "arcjobs.appjobid"]
-        jobstoupdate=self.dbarc.getArcJobsInfo(select, columns=columns, tables="arcjobs,pandajobs")
-
-        if len(jobstoupdate) == 0:
-            return
-        else:
+        # jobs are updated in pages so that none are left out on large sites
+        for jobstoupdate in self.dbarc.iterArcJobsInfo(select, columns=columns, tables="arcjobs,pandajobs"):
             self.log.debug("Found %s: %d jobs (%s)" % (state, len(jobstoupdate), ','.join([j['appjobid'] for j in jobstoupdate])))
 
-        for aj in jobstoupdate:
-            select = "arcjobid='"+str(aj["id"])+"'"
-            desc = {}
-            desc["pandastatus"] = "running"
-            desc["actpandastatus"] = "running"
-            if state == "finishing":
-                desc["pandastatus"] = "transferring"
-                desc["actpandastatus"] = "transferring"
-            if len(aj["ExecutionNode"]) > 255:
-                desc["node"] = aj["ExecutionNode"][:254]
-                self.log.warning("%s: Truncating wn hostname from %s to %s" % (aj['pandaid'], aj['ExecutionNode'], desc['node']))
-            else:
-                desc["node"] = aj["ExecutionNode"]
-            desc["computingElement"] = urlparse(aj['cluster']).hostname
-            desc["startTime"] = self.getStartTime(datetime.datetime.utcnow(), aj['UsedTotalWalltime'])
-            desc["corecount"] = aj['RequestedSlots']
-            # When true pilot job has started running, turn of aCT heartbeats
-            if self.sites[aj['siteName']]['truepilot']:
-                self.log.info("%s: Job is running so stop sending heartbeats", aj['pandaid'])
-                desc['sendhb'] = 0
-            else:
-                # Update APFmon (done by wrapper for truepilot)
-                self.apfmon.updateJob(aj['pandaid'], 'running')
+            updates = []
+            for aj in jobstoupdate:
+                desc = {}
+                desc["pandastatus"] = "running"
+                desc["actpandastatus"] = "running"
+                if state == "finishing":
+                    desc["pandastatus"] = "transferring"
+                    desc["actpandastatus"] = "transferring"
+                if len(aj["ExecutionNode"]) > 255:
+                    desc["node"] = aj["ExecutionNode"][:254]
+                    self.log.warning("%s: Truncating wn hostname from %s to %s" % (aj['pandaid'], aj['ExecutionNode'], desc['node']))
+                else:
+                    desc["node"] = aj["ExecutionNode"]
+                desc["computingElement"] = urlparse(aj['cluster']).hostname
+                desc["startTime"] = self.getStartTime(datetime.datetime.utcnow(), aj['UsedTotalWalltime'])
+                desc["corecount"] = aj['RequestedSlots']
+                # When true pilot job has started running, turn of aCT heartbeats
+                if self.sites[aj['siteName']]['truepilot']:
+                    self.log.info("%s: Job is running so stop sending heartbeats", aj['pandaid'])
+                    desc['sendhb'] = 0
+                else:
+                    # Update APFmon (done by wrapper for truepilot)
+                    self.apfmon.updateJob(aj['pandaid'], 'running')
+                updates.append((aj["id"], desc))
 
             try:
-                self.dbpanda.updateJobsLazy(select, desc)
+                self.dbpanda.updateJobsBulk(updates, key='arcjobid')
             except:
-                desc['startTime'] = datetime.datetime.utcnow()
-                self.dbpanda.updateJobsLazy(select, desc)
-
-        self.dbpanda.Commit()
+                # Bad start time in one of the jobs, fall back to one by one
+                # discard the part of the bulk update done before the failure
+                self.dbpanda.Rollback()
+                for (arcjobid, desc) in updates:
+                    select = "arcjobid='"+str(arcjobid)+"'"
+                    try:
+                        self.dbpanda.updateJobsLazy(select, desc)
+                    except:
+                        desc['startTime'] = datetime.datetime.utcnow()
+                        self.dbpanda.updateJobsLazy(select, desc)
+                self.dbpanda.Commit()
 
 
     def updateFinishedJobs(self):
@@ -213,8 +218,8 @@ class aCTATLASStatus(aCTATLASProcess):
             self.log.debug("Found %d finished jobs (%s)" % (len(jobstoupdate), ','.join([j['appjobid'] for j in jobstoupdate])))
 
 
+        updates = []
         for aj in jobstoupdate:
-            select = "arcjobid='"+str(aj["id"])+"'"
             desc = {}
             desc["pandastatus"] = "transferring"
             desc["actpandastatus"] = "tovalidate"
@@ -227,13 +232,23 @@ class aCTATLASStatus(aCTATLASProcess):
             if not self.sites[aj['siteName']]['truepilot']:
                 # Update APFmon (done by wrapper for truepilot)
                 self.apfmon.updateJob(aj['appjobid'], 'exiting', exitcode=0)
-            try:
-                self.dbpanda.updateJobsLazy(select, desc)
-            except:
-                desc['startTime'] = datetime.datetime.utcnow()
-                desc['endTime'] = datetime.datetime.utcnow()
-                self.dbpanda.updateJobsLazy(select, desc)
-        self.dbpanda.Commit()
+            updates.append((aj["id"], desc))
+
+        try:
+            self.dbpanda.updateJobsBulk(updates, key='arcjobid')
+        except:
+            # Bad start or end time in one of the jobs, fall back to one by one
+            # discard the part of the bulk update done before the failure
+            self.dbpanda.Rollback()
+            for (arcjobid, desc) in updates:
+                select = "arcjobid='"+str(arcjobid)+"'"
+                try:
+                    self.dbpanda.updateJobsLazy(select, desc)
+                except:
+                    desc['startTime'] = datetime.datetime.utcnow()
+                    desc['endTime'] = datetime.datetime.utcnow()
+                    self.dbpanda.updateJobsLazy(select, desc)
+            self.dbpanda.Commit()
 
 
     def checkFailed(self, arcjobs):
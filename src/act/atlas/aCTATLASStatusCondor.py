@@ -7,6 +7,10 @@ class aCTATLASStatusCondor(aCTATLASProcess):
     Checks the status of condor jobs and reports back to pandajobs
     '''
 
+    notifystates = {'pandajobs': ('tobekilled',),
+                    'condorjobs': ('submitted', 'holding', 'running', 'done', 'failed', 'donefailed',
+                                   'cancelled', 'lost', 'tocancel', 'cancelling')}
+
     def __init__(self):
         aCTATLASProcess.__init__(self, ceflavour=['HTCONDOR-CE', 'CREAM-CE'])
 
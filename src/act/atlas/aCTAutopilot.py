@@ -1,4 +1,3 @@
-from threading import Thread
 import cgi
 import datetime
 import os
@@ -8,55 +7,17 @@ import time
 import shutil
 import arc
 from act.common import aCTProxy
-from act.common import aCTUtils
+from act.common.aCTWorkerPool import aCTWorkerPool
 from act.atlas import aCTPanda
+from act.atlas.aCTPandaAsync import aCTPandaAsync, runAll
 from act.atlas.aCTATLASProcess import aCTATLASProcess
 from act.atlas.aCTPandaJob import aCTPandaJob
-
-class PandaThr(Thread):
-    """
-    Helper function for threaded panda status update calls.
-    func is generic, but it is only used for aCTPanda.updateStatus call.
-    """
-    def __init__ (self,func,id,status,args={}):
-        Thread.__init__(self)
-        self.func=func
-        self.id = id
-        self.status = status
-        self.args = args
-        self.result = None
-    def run(self):
-        self.result=self.func(self.id,self.status,self.args)
-
-class PandaBulkThr(Thread):
-    """
-    Bulk update pandaStatus
-    """
-    def __init__ (self,func,ids,args):
-        Thread.__init__(self)
-        self.func=func
-        self.ids = ids
-        self.args = args
-        self.result = None
-    def run(self):
-        self.result=self.func(self.args)
-
-class PandaEventsThr(Thread):
-    """
-    Generic function for event service-related calls
-    """
-    def __init__ (self, func, id, node, data=None):
-        Thread.__init__(self)
-        self.func = func
-        self.id = id
-        self.node = node
-        self.data = data
-        self.result = None
-    def run(self):
-        self.result = self.func(self.node)
+from act.db.aCTDBQuery import aCTDBQuery
 
 class aCTAutopilot(aCTATLASProcess):
 
+    notifystates = {'pandajobs': ('starting', 'running', 'transferring', 'finished', 'failed', 'cancelled')}
+
     """
     Main class for Panda interaction. Three major functions: init, run, finish
     """
@@ -94,6 +55,10 @@ class aCTAutopilot(aCTATLASProcess):
         # queue interval
         self.queuestamp=0
         self.nthreads=int(self.conf.get(["panda","threads"]))
+        # Panda calls run concurrently in a pool of nthreads threads. Calls
+        # hanging beyond twice the connection timeout are abandoned.
+        self.pool = aCTWorkerPool(self.log, self.nthreads, timeout=2*int(self.conf.get(['panda','timeout'])), name='panda')
+        self.apandas = dict((role, aCTPandaAsync(panda, self.pool)) for role, panda in self.pandas.items())
 
         self.sites={}
 
@@ -105,13 +70,19 @@ class aCTAutopilot(aCTATLASProcess):
     def getPanda(self, sitename):
         return self.pandas.get(self.sites[sitename]['type'], self.pandas.get('production'))
 
+    def getAPanda(self, sitename):
+        return self.apandas.get(self.sites[sitename]['type'], self.apandas.get('production'))
+
 
     def updatePandaHeartbeat(self,pstatus):
         """
         Heartbeat status updates.
         """
         columns = ['pandaid', 'siteName', 'startTime', 'computingElement', 'node', 'corecount', 'eventranges']
-        jobs=self.dbpanda.getJobs("pandastatus='"+pstatus+"' and sendhb=1 and ("+self.dbpanda.timeStampLessThan("theartbeat", self.conf.get(['panda','heartbeattime']))+" or modified > theartbeat) limit 1000", columns)
+        select = aCTDBQuery().eq('pandastatus', pstatus).eq('sendhb', 1) \
+                             .raw("(%s or modified > theartbeat)" % self.dbpanda.timeStampLessThan("theartbeat", "%s"), int(self.conf.get(['panda','heartbeattime']))) \
+                             .limit(1000)
+        jobs=self.dbpanda.getJobs(select, columns)
         if not jobs:
             return
 
@@ -122,7 +93,7 @@ class aCTAutopilot(aCTATLASProcess):
             pstatus = 'starting'
             changed_pstatus = True
 
-        tlist=[]
+        calls = []
         for j in jobs:
             # Don't send transferring heartbeat for ES jobs, they must be in running while events are updated
             if pstatus == 'transferring' and j['eventranges']:
@@ -149,24 +120,23 @@ class aCTAutopilot(aCTATLASProcess):
                 jd['coreCount'] = corecount
             except:
                 self.log.warning('%s: no corecount available' % j['pandaid'])
-            t=PandaThr(self.getPanda(j['siteName']).updateStatus,j['pandaid'],pstatus,jd)
-            tlist.append(t)
-        aCTUtils.RunThreadsSplit(tlist, self.nthreads)
+            calls.append(((j['pandaid'], jd), self.getAPanda(j['siteName']).updateStatus(j['pandaid'], pstatus, jd)))
 
-        for t in tlist:
-            if t.result == None or 'StatusCode' not in t.result:
+        def handle(key, result):
+            pandaid, args = key
+            if result == None or 'StatusCode' not in result:
                 # Strange response from panda, try later
-                continue
-            if t.result['StatusCode'] and t.result['StatusCode'][0] == '60':
+                return
+            if result['StatusCode'] and result['StatusCode'][0] == '60':
                 self.log.error('Failed to contact Panda, proxy may have expired')
-                continue
-            if 'command' in t.result  and t.result['command'][0] != "NULL":
-                self.log.info("%s: response: %s" % (t.id,t.result) )
+                return
+            if 'command' in result  and result['command'][0] != "NULL":
+                self.log.info("%s: response: %s" % (pandaid,result) )
             jd={}
             if changed_pstatus:
                 jd['pandastatus']=pstatus
             # Make sure heartbeat is ahead of modified time so it is not picked up again
-            if self.sites[t.args['siteName']]['truepilot'] and pstatus == 'starting':
+            if self.sites[args['siteName']]['truepilot'] and pstatus == 'starting':
                 # Set theartbeat 1h in the future to allow job to start
                 # running and avoid race conditions with heartbeats
                 # Now heartbeat timeout is 2h so we remove the offset
@@ -176,13 +146,15 @@ class aCTAutopilot(aCTATLASProcess):
                 jd['theartbeat'] = self.dbpanda.getTimeStamp(time.time()+1)
             # If panda tells us to kill the job, set actpandastatus to tobekilled
             # and remove from heartbeats
-            if 'command' in t.result and ( ("tobekilled" in t.result['command'][0]) or ("badattemptnr" in t.result['command'][0]) ):
-                self.log.info('%s: cancelled by panda' % t.id)
+            if 'command' in result and ( ("tobekilled" in result['command'][0]) or ("badattemptnr" in result['command'][0]) ):
+                self.log.info('%s: cancelled by panda' % pandaid)
                 jd['actpandastatus']="tobekilled"
                 jd['pandastatus']=None
-            self.dbpanda.updateJob(t.id,jd)
+            self.dbpanda.updateJob(pandaid,jd)
 
-        self.log.info("Threads finished")
+        # Responses are handled as they arrive
+        runAll(calls, handle, self.nthreads, self.log)
+        self.log.info("Heartbeats finished")
 
 
     def updatePandaHeartbeatBulk(self,pstatus):
@@ -190,7 +162,10 @@ class aCTAutopilot(aCTATLASProcess):
         Heartbeat status updates in bulk.
         """
         columns = ['pandaid', 'siteName', 'startTime', 'computingElement', 'node', 'corecount', 'eventranges']
-        jobs=self.dbpanda.getJobs("pandastatus='"+pstatus+"' and sendhb=1 and ("+self.dbpanda.timeStampLessThan("theartbeat", self.conf.get(['panda','heartbeattime']))+" or modified > theartbeat) limit 1000", columns)
+        select = aCTDBQuery().eq('pandastatus', pstatus).eq('sendhb', 1) \
+                             .raw("(%s or modified > theartbeat)" % self.dbpanda.timeStampLessThan("theartbeat", "%s"), int(self.conf.get(['panda','heartbeattime']))) \
+                             .limit(1000)
+        jobs=self.dbpanda.getJobs(select, columns)
         #jobs=self.dbpanda.getJobs("pandastatus='"+pstatus+"' and sendhb=1 and ("+self.dbpanda.timeStampLessThan("theartbeat", 60)+" or modified > theartbeat) limit 1000", columns)
         if not jobs:
             return
@@ -202,7 +177,6 @@ class aCTAutopilot(aCTATLASProcess):
             pstatus = 'starting'
             changed_pstatus = True
 
-        tlist=[]
         jobsbyproxy = {}
         for j in jobs:
             # Don't send transferring heartbeat for ES jobs, they must be in running while events are updated
@@ -236,17 +210,18 @@ class aCTAutopilot(aCTATLASProcess):
             except:
                 jobsbyproxy[self.sites[j['siteName']]['type']] = [jd]
 
+        calls = []
         for sitetype, jobs in jobsbyproxy.items():
-            t = PandaBulkThr(self.pandas.get(sitetype, self.pandas.get('production')).updateStatuses, [j['jobId'] for j in jobs], jobs)
-            tlist.append(t)
-        aCTUtils.RunThreadsSplit(tlist, self.nthreads)
+            apanda = self.apandas.get(sitetype, self.apandas.get('production'))
+            calls.append(([j['jobId'] for j in jobs], apanda.updateStatuses(jobs)))
 
-        for t in tlist:
-            if not t or not t.result or not t.result[0]:
+        updates = []
+        def handle(ids, result):
+            if not result or not result[0]:
                 # Strange response from panda, try later
-                continue
+                return
 
-            for pandaid, response in zip(t.ids, t.result[1]):
+            for pandaid, response in zip(ids, result[1]):
                 try:
                     result = cgi.parse_qs(response)
                 except Exception:
@@ -272,9 +247,11 @@ class aCTAutopilot(aCTATLASProcess):
                     self.log.info('%s: cancelled by panda' % pandaid)
                     jd['actpandastatus'] = "tobekilled"
                     jd['pandastatus'] = None
-                self.dbpanda.updateJob(pandaid, jd)
+                updates.append((pandaid, jd))
 
-        self.log.info("Threads finished")
+        runAll(calls, handle, self.nthreads, self.log)
+        self.dbpanda.updateJobsBulk(updates)
+        self.log.info("Heartbeats finished")
 
 
     def updatePandaFinishedPilot(self):
@@ -290,7 +267,7 @@ class aCTAutopilot(aCTATLASProcess):
         self.log.info("Updating panda for %d finished jobs (%s)" % (len(jobs), ','.join([str(j['pandaid']) for j in jobs])))
 
         self.updateEvents(jobs)
-        tlist = []
+        calls = []
         for j in jobs:
             # If true pilot skip heartbeat and just update DB
             if not j['sendhb']:
@@ -331,30 +308,30 @@ class aCTAutopilot(aCTATLASProcess):
                     os.remove(fname)
 
             self.log.debug('%s: final heartbeat: %s' % (j['pandaid'], jobinfo.dictionary()))
-            t=PandaThr(self.getPanda(j['siteName']).updateStatus,j['pandaid'],j['pandastatus'],jobinfo.dictionary())
-            tlist.append(t)
-
-        aCTUtils.RunThreadsSplit(tlist, self.nthreads)
-
-        for t in tlist:
-            if t.result == None:
-                continue
-            if 'StatusCode' in t.result and t.result['StatusCode'] and t.result['StatusCode'][0] != '0':
+            args = jobinfo.dictionary()
+            calls.append(((j['pandaid'], j['pandastatus'], args), self.getAPanda(j['siteName']).updateStatus(j['pandaid'], j['pandastatus'], args)))
+
+        def handle(key, result):
+            pandaid, status, args = key
+            if result == None:
+                return
+            if 'StatusCode' in result and result['StatusCode'] and result['StatusCode'][0] != '0':
                 self.log.error('Error updating panda')
-                continue
+                return
             jd={}
             jd['pandastatus']=None
             jd['actpandastatus']='done'
-            if t.status == 'failed':
+            if status == 'failed':
                 jd['actpandastatus']='donefailed'
-            if 'pilotErrorCode' in t.args and t.args['pilotErrorCode'] == 1144:
+            if 'pilotErrorCode' in args and args['pilotErrorCode'] == 1144:
                 jd['actpandastatus']='donecancelled'
             jd['theartbeat']=self.dbpanda.getTimeStamp()
-            self.dbpanda.updateJob(t.id,jd)
+            self.dbpanda.updateJob(pandaid,jd)
             # Send done message to APFMon
-            self.apfmon.updateJob(t.id, 'done' if jd['actpandastatus'] == 'done' else 'fault')
+            self.apfmon.updateJob(pandaid, 'done' if jd['actpandastatus'] == 'done' else 'fault')
 
-        self.log.info("Threads finished")
+        runAll(calls, handle, self.nthreads, self.log)
+        self.log.info("Final heartbeats finished")
 
         # Clean inputfiles, pickle and eventranges
         for j in jobs:
@@ -376,7 +353,7 @@ class aCTAutopilot(aCTATLASProcess):
         Handle event service updates for finished jobs
         TOFIX for pilot2
         """
-        tlist=[]
+        calls = []
         for j in jobs:
             eventrangestoupdate = []
 
@@ -427,16 +404,15 @@ class aCTAutopilot(aCTATLASProcess):
                     except Exception as x:
                         self.log.error('%s: No pickle info found: %s' % (j['pandaid'], x))
                     else:
-                        t = PandaThr(self.getPanda(j['siteName']).updateStatus, j['pandaid'], 'transferring', jobmetrics)
-                        aCTUtils.RunThreadsSplit([t], self.nthreads)
+                        result = self.getPanda(j['siteName']).updateStatus(j['pandaid'], 'transferring', jobmetrics)
                         # If update fails panda won't see the zip and events
                         # will be rescheduled to another job
-                        if t.result == None or 'StatusCode' not in t.result:
+                        if result == None or 'StatusCode' not in result:
                             # Strange response from panda
                             continue
-                        if t.result['StatusCode'][0] == '60':
+                        if result['StatusCode'][0] == '60':
                             self.log.error('Failed to contact Panda, proxy may have expired')
-                        elif t.result['StatusCode'][0] == '30':
+                        elif result['StatusCode'][0] == '30':
                             self.log.error('Job was already killed')
 
                 eventranges = j['eventranges']
@@ -468,19 +444,19 @@ class aCTAutopilot(aCTATLASProcess):
                         json.dump(harvesterdict, f)
                 else:
                     updatenode = {'eventRanges': json.dumps(eventrangestoupdate)}
-                    t = PandaEventsThr(self.getPanda(j['siteName']).updateEventRanges, j['pandaid'], updatenode)
-                    tlist.append(t)
+                    calls.append((j['pandaid'], self.getAPanda(j['siteName']).updateEventRanges(updatenode)))
 
-        aCTUtils.RunThreadsSplit(tlist, self.nthreads)
-        for t in tlist:
+        def handle(pandaid, result):
             # If update fails events will be rescheduled to another job
-            if t.result == None or 'StatusCode' not in t.result:
+            if result == None or 'StatusCode' not in result:
                 # Strange response from panda
-                continue
-            if t.result['StatusCode'][0] == '60':
+                return
+            if result['StatusCode'][0] == '60':
                 self.log.error('Failed to contact Panda, proxy may have expired')
-            elif t.result['StatusCode'][0] == '30':
-                self.log.warning('%s: Job was already killed' % j['pandaid'])
+            elif result['StatusCode'][0] == '30':
+                self.log.warning('%s: Job was already killed' % pandaid)
+
+        runAll(calls, handle, self.nthreads, self.log)
 
 
     def checkJobs(self):
@@ -586,6 +562,9 @@ class aCTAutopilot(aCTATLASProcess):
             self.updateArchive()
             self.starttime = time.time()
 
+        for role, panda in self.pandas.items():
+            panda.logStats('%s: ' % role)
+
 
 if __name__ == '__main__':
     am=aCTAutopilot()
@@ -1,29 +1,15 @@
-from threading import Thread
+import concurrent.futures
 import time
 import arc
 from act.common import aCTProxy
-from act.common import aCTUtils
+from act.common.aCTWorkerPool import aCTWorkerPool
 from act.atlas import aCTPanda
 from act.atlas.aCTATLASProcess import aCTATLASProcess
 
-class PandaThr(Thread):
-    """
-    Helper function for threaded panda status update calls.
-    func is generic, but it is only used for aCTPanda.updateStatus call.
-    """
-    def __init__ (self,func,id,status,args={}):
-        Thread.__init__(self)
-        self.func=func
-        self.id = id
-        self.status = status
-        self.args = args
-        self.result = None
-    def run(self):
-        self.result=self.func(self.id,self.status,self.args)
-
-
 class aCTAutopilotSent(aCTATLASProcess):
 
+    notifystates = {'pandajobs': ('sent',)}
+
     """
     Main class for Panda interaction. Three major functions: init, run, finish
     """
@@ -58,6 +44,11 @@ class aCTAutopilotSent(aCTATLASProcess):
             self.pandas[role] = aCTPanda.aCTPanda(self.log, proxyfile)
             self.proxymap[role] = proxyid
 
+        # Panda calls run in a pool of panda/threads threads. Calls hanging
+        # beyond twice the connection timeout are abandoned.
+        self.pool = aCTWorkerPool(self.log, int(self.conf.get(["panda","threads"])),
+                                  timeout=2*int(self.conf.get(['panda','timeout'])), name='panda')
+
         # queue interval
         self.queuestamp=0
 
@@ -76,7 +67,6 @@ class aCTAutopilotSent(aCTATLASProcess):
         """
         Heartbeat status updates.
         """
-        nthreads=int(self.conf.get(["panda","threads"]))
         columns = ['pandaid', 'siteName', 'startTime', 'computingElement', 'node', 'corecount', 'eventranges']
         jobs=self.dbpanda.getJobs("pandastatus='"+pstatus+"' and sendhb=1 and ("+self.dbpanda.timeStampLessThan("theartbeat", self.conf.get(['panda','heartbeattime']))+" or modified > theartbeat) limit 1000", columns)
         if not jobs:
@@ -89,7 +79,7 @@ class aCTAutopilotSent(aCTATLASProcess):
             pstatus = 'starting'
             changed_pstatus = True
 
-        tlist=[]
+        futures = {}
         for j in jobs:
             # Don't send transferring heartbeat for ES jobs, they must be in running while events are updated
             if pstatus == 'transferring' and j['eventranges']:
@@ -114,25 +104,30 @@ class aCTAutopilotSent(aCTATLASProcess):
                 jd['jobMetrics']="coreCount=%s" % (j['corecount'] if j['corecount'] > 0 else self.sites[j['siteName']]['corecount'])
             except:
                 pass
-            t=PandaThr(self.getPanda(j['siteName']).updateStatus,j['pandaid'],pstatus,jd)
-            tlist.append(t)
-        aCTUtils.RunThreadsSplit(tlist,nthreads)
+            f = self.pool.submit(self.getPanda(j['siteName']).updateStatus, j['pandaid'], pstatus, jd)
+            futures[f] = (j['pandaid'], jd)
 
-        for t in tlist:
-            if t.result == None or 'StatusCode' not in t.result:
+        for f in concurrent.futures.as_completed(futures):
+            pandaid, args = futures[f]
+            try:
+                result = f.result()
+            except Exception as e:
+                self.log.error('%s: Panda call failed: %s' % (pandaid, e))
+                continue
+            if result == None or 'StatusCode' not in result:
                 # Strange response from panda, try later
                 continue
-            if t.result['StatusCode'] and t.result['StatusCode'][0] == '60':
+            if result['StatusCode'] and result['StatusCode'][0] == '60':
                 self.log.error('Failed to contact Panda, proxy may have expired')
                 continue
-            #self.log.debug('%s: %s' % (t.id, t.result))
-            if 'command' in t.result  and t.result['command'][0] != "NULL":
-                self.log.info("%s: response: %s" % (t.id,t.result) )
+            #self.log.debug('%s: %s' % (pandaid, result))
+            if 'command' in result  and result['command'][0] != "NULL":
+                self.log.info("%s: response: %s" % (pandaid,result) )
             jd={}
             if changed_pstatus:
                 jd['pandastatus']=pstatus
             # Make sure heartbeat is ahead of modified time so it is not picked up again
-            if self.sites[t.args['siteName']]['truepilot'] and pstatus == 'starting':
+            if self.sites[args['siteName']]['truepilot'] and pstatus == 'starting':
                 # Set theartbeat 1h in the future to allow job to start
                 # running and avoid race conditions with heartbeats
                 # Now heartbeat timeout is 2h so we remove the offset
@@ -142,13 +137,13 @@ class aCTAutopilotSent(aCTATLASProcess):
                 jd['theartbeat'] = self.dbpanda.getTimeStamp(time.time()+1)
             # If panda tells us to kill the job, set actpandastatus to tobekilled
             # and remove from heartbeats
-            if 'command' in t.result and ( ("tobekilled" in t.result['command'][0]) or ("badattemptnr" in t.result['command'][0]) ):
-                self.log.info('%s: cancelled by panda' % t.id)
+            if 'command' in result and ( ("tobekilled" in result['command'][0]) or ("badattemptnr" in result['command'][0]) ):
+                self.log.info('%s: cancelled by panda' % pandaid)
                 jd['actpandastatus']="tobekilled"
                 jd['pandastatus']=None
-            self.dbpanda.updateJob(t.id,jd)
+            self.dbpanda.updateJob(pandaid,jd)
 
-        self.log.info("Threads finished")
+        self.log.info("Heartbeats finished")
 
 
     def process(self):
@@ -8,3 +8,8 @@ def bootstrap():
     dbpanda = aCTDBPanda(log)
     if not dbpanda.createTables():
         print('Failed to create Panda tables, see aCTBootstrap.log for details')
+
+def migrate(log, dryrun):
+    '''Add missing indexes and count table to Panda tables, called by actdbmigrate'''
+    from act.common.aCTDBMigrate import migrate as migratedb
+    return migratedb(aCTDBPanda(log), dryrun)
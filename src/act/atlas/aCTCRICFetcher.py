@@ -9,6 +9,8 @@ from act.atlas.aCTATLASProcess import aCTATLASProcess
 
 class aCTCRICFetcher(aCTATLASProcess):
 
+    notifystates = {}
+
     def __init__(self):
         aCTATLASProcess.__init__(self)
         self.queues = self.conf.get(['cric','server'])
@@ -65,6 +67,8 @@ class aCTCRICFetcher(aCTATLASProcess):
         # store data to file
         self.storeToFile(queuesjson, self.queuesfile)
         self.storeToFile(osesjson, self.osesfile)
+        # parse once here for all other agents
+        self.cricparser.writeSnapshot()
         # temporary hack to avoid too much cric fetching
         time.sleep(600)
 
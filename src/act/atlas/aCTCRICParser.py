@@ -2,14 +2,23 @@ import logging
 import time
 import os, re, sys
 import json
+import pickle
 from act.common import aCTConfig
 
 class aCTCRICParser:
     '''
     Load cric jsons. If file changes since last load, reload. Then load site
     info from config and overwrite cric values.
+
+    aCTCRICFetcher stores the parsed cric info in a snapshot file next to
+    the json after each download, so that other agents load it from there
+    instead of all parsing the json themselves. The json is parsed if the
+    snapshot is missing or was made from other files or cric settings.
     '''
 
+    # format of the snapshot file, increase when the parsed info changes
+    snapshotversion = 1
+
     def __init__(self, logger):
         self.log = logger
         self.conf = aCTConfig.aCTConfigAPP()
@@ -169,6 +178,58 @@ class aCTCRICParser:
             self.osmap[bucket_id] = endpoint
             self.bucketmap[ep] = {'bucket_id': bucket_id, 'type': info['type']}
 
+    def _parseCRIC(self, cricfile):
+        '''Return (sites, osmap) parsed from the cric json files'''
+        pilotmgr = self.conf.get(['cric','pilotmanager'])
+        pilotver = self.conf.get(['cric','pilotversion'])
+        self._parseDDMEndpoints(self.conf.get(['cric', 'osfilename']))
+        return (self._parseCRICJson(cricfile, pilotmgr, pilotver), self.osmap)
+
+    def _snapshotKey(self, cricfile):
+        '''Return the files and settings used to parse cric info'''
+        osfile = self.conf.get(['cric', 'osfilename'])
+        return (os.stat(cricfile).st_mtime, os.stat(osfile).st_mtime, self.conf.get(['cric','pilotmanager']),
+                self.conf.get(['cric','pilotversion']), self.conf.get(['cric', 'maxjobs']))
+
+    def _loadSnapshot(self, cricfile, key):
+        '''Return (sites, osmap) from the snapshot of cricfile if it was made with key'''
+        try:
+            with open(cricfile + '.pickle', 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.log.warning("Failed to load cric snapshot: %s" % str(e))
+            return None
+        if snapshot.get('version') != self.snapshotversion or snapshot.get('key') != key:
+            return None
+        return (snapshot['sites'], snapshot['osmap'])
+
+    def writeSnapshot(self):
+        '''
+        Parse the cric json files and store the result for other agents,
+        unless the snapshot is already up to date
+        '''
+        self.conf.parse()
+        cricfile = self.conf.get(['cric','jsonfilename'])
+        if not cricfile:
+            return
+        try:
+            key = self._snapshotKey(cricfile)
+            if self._loadSnapshot(cricfile, key):
+                return
+            start = time.time()
+            (sites, osmap) = self._parseCRIC(cricfile)
+        except Exception as e:
+            self.log.warning("Failed to parse cric info: %s" % str(e))
+            return
+        snapshot = {'version': self.snapshotversion, 'key': key, 'sites': sites, 'osmap': osmap}
+        tmpfile = '%s.pickle.%d' % (cricfile, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cricfile + '.pickle')
+        self.log.info("Wrote cric snapshot in %g s" % (time.time() - start))
+
     def _mergeSiteDicts(self, dict1, dict2):
         for d in dict2.keys():
             if d in dict1:
@@ -201,11 +262,16 @@ class aCTCRICParser:
         # check if json file or config file changed before parsing
         if (self.tparse < cricmtime) or (self.tparse < os.stat(self.conf.configfile).st_mtime):
             self.log.info("CRIC file and/or config modified, reparsing site info")
-            pilotmgr = self.conf.get(['cric','pilotmanager'])
-            pilotver = self.conf.get(['cric','pilotversion'])
             start_parsing = time.time()
-            self._parseDDMEndpoints(self.conf.get(['cric', 'osfilename']))
-            self.sites = self._parseCRICJson(cricfile, pilotmgr, pilotver)
+            try:
+                snapshot = self._loadSnapshot(cricfile, self._snapshotKey(cricfile))
+            except OSError:
+                snapshot = None
+            if snapshot:
+                self.log.debug("Using cric snapshot %s.pickle" % cricfile)
+                (self.sites, self.osmap) = snapshot
+            else:
+                (self.sites, self.osmap) = self._parseCRIC(cricfile)
             self._mergeSiteDicts(self.sites, self._parseConfigSites())
             self.tparse = time.time()
             self.log.debug("Time to parse site info: %g s"%(self.tparse-start_parsing))
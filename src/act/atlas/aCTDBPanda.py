@@ -2,6 +2,15 @@ from act.db.aCTDB import aCTDB
 
 class aCTDBPanda(aCTDB):
 
+    indexes = {'pandajobs': {
+                   # autopilot: heartbeats due per panda status
+                   'pandastatus_sendhb_theartbeat': ('pandastatus', 'sendhb', 'theartbeat'),
+                   # getjobs and status: jobs per site and state
+                   'siteName_actpandastatus': ('siteName', 'actpandastatus')}}
+
+    counts = {'pandajobs': ('pandajobcounts', {'siteName': 'VARCHAR(255)',
+                                               'actpandastatus': 'VARCHAR(255)'})}
+
     def __init__(self, log):
         aCTDB.__init__(self, log, 'pandajobs')
 
@@ -48,6 +57,9 @@ class aCTDBPanda(aCTDB):
            - metadata: Generic json metadata sent by the client
            - error: Error string from a failed job
 
+        pandajobcounts: number of jobs per siteName and actpandastatus, kept
+        up to date by triggers on pandajobs, see aCTDB.getCounts()
+
         pandaarchive:
           - Selected fields from above list:
             - pandaid, siteName, actpandastatus, startTime, endTime
@@ -105,6 +117,12 @@ class aCTDBPanda(aCTDB):
         except Exception as x:
             self.log.error("failed create table %s" %x)
             return False
+        if not self.createIndexes():
+            return False
+        if not self.createCounts():
+            self.log.warning("job counts will be made by scanning pandajobs")
+        if not self.recordSchema():
+            return False
 
         str="""
         create table pandaarchive (
@@ -130,6 +148,17 @@ class aCTDBPanda(aCTDB):
         return True
 
 
+    def _notifyStates(self, desc):
+        '''
+        Mark jobs as changed to the actpandastatus and pandastatus in desc,
+        or to unknown states if there are none
+        '''
+        states = [desc[k] for k in ('actpandastatus', 'pandastatus') if desc.get(k)]
+        for state in states:
+            self.notify(state=state)
+        if not states:
+            self.notify()
+
     def insertJob(self,pandaid,pandajob,desc={}):
         desc['created']=self.getTimeStamp()
         desc['pandaid']=pandaid
@@ -139,6 +168,7 @@ class aCTDBPanda(aCTDB):
         c.execute(s,list(desc.values()))
         c.execute("SELECT LAST_INSERT_ID()")
         row = c.fetchone()
+        self._notifyStates(desc)
         self.Commit()
         return row
 
@@ -159,9 +189,24 @@ class aCTDBPanda(aCTDB):
     def updateJobLazy(self,pandaid,desc):
         desc['modified']=self.getTimeStamp()
         s="UPDATE pandajobs SET " + ",".join(['%s=%%s' % (k) for k in desc.keys()])
-        s+=" WHERE pandaid="+str(pandaid)
-        c=self.db.getCursor()
-        c.execute(s,list(desc.values()))
+        s+=" WHERE pandaid=%s"
+        self.db.executePrepared(s, list(desc.values()) + [pandaid])
+        if 'actpandastatus' in desc or 'pandastatus' in desc:
+            self._notifyStates(desc)
+
+    def updateJobsBulk(self, jobs, key='pandaid'):
+        '''
+        Update many jobs and commit once. jobs is a list of (keyvalue, desc)
+        where desc is set on the job(s) with column key equal to keyvalue.
+        '''
+        if not jobs:
+            return
+        rows = [(k, desc.copy()) for (k, desc) in jobs]
+        self._updateBulkLazy(key, rows)
+        for (k, desc) in rows:
+            if 'actpandastatus' in desc or 'pandastatus' in desc:
+                self._notifyStates(desc)
+        self.Commit()
 
     def updateJobs(self, select, desc):
         self.updateJobsLazy(select, desc)
@@ -169,10 +214,13 @@ class aCTDBPanda(aCTDB):
 
     def updateJobsLazy(self, select, desc):
         desc['modified']=self.getTimeStamp()
+        where, params = self._where(select)
         s="UPDATE pandajobs SET " + ",".join(['%s=%%s' % (k) for k in desc.keys()])
-        s+=" WHERE "+select
+        s+=" WHERE "+where
         c=self.db.getCursor()
-        c.execute(s,list(desc.values()))
+        c.execute(s,list(desc.values()) + (params or []))
+        if 'actpandastatus' in desc or 'pandastatus' in desc:
+            self._notifyStates(desc)
 
     def getJob(self,pandaid,columns=[]):
         c=self.db.getCursor()
@@ -182,13 +230,25 @@ class aCTDBPanda(aCTDB):
 
     def getJobs(self,select,columns=[]):
         c=self.db.getCursor()
-        c.execute("SELECT "+self._column_list2str(columns)+" FROM pandajobs WHERE "+select)
+        where, params = self._where(select)
+        c.execute("SELECT "+self._column_list2str(columns)+" FROM pandajobs WHERE "+where, params)
         rows=c.fetchall()
         return rows
 
+    def iterJobs(self, select, columns=[], batch=1000):
+        '''
+        Generator of lists of at most batch jobs matching select, paging on
+        id. select cannot have ORDER BY or LIMIT.
+        '''
+        if columns and 'id' not in columns:
+            columns = list(columns) + ['id']
+        return self._iterPages(lambda q: self.getJobs(q, columns), select, 'id', batch,
+                               lambda rows: (len(rows), rows[-1]['id'] if rows else None))
+
     def getNJobs(self,select):
         c=self.db.getCursor()
-        c.execute("select count(*) from pandajobs where " + select)
+        where, params = self._where(select)
+        c.execute("select count(*) from pandajobs where " + where, params)
         njobs=c.fetchone()['count(*)']
         return int(njobs)
 
@@ -3,11 +3,25 @@ import json
 import urllib.parse, socket, http.client
 import os
 import pickle
+import queue
+import select
 import ssl
+import threading
+import time
 from act.common import aCTConfig
+from act.common.aCTStats import timer
 
 class aCTPanda:
+    '''
+    Client for the Panda server API. HTTPS connections are kept alive and
+    reused by all threads using the same aCTPanda object, so the TLS handshake
+    with the proxy certificate is only done once per connection rather than
+    once per request.
+    '''
 
+    # errors sending on a reused connection meaning the server closed it
+    # while idle
+    staleerrors = (http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError)
 
     def __init__(self,logger, proxyfile):
         self.conf = aCTConfig.aCTConfigAPP()
@@ -26,18 +40,119 @@ class aCTPanda:
         self.context.verify_mode = ssl.CERT_REQUIRED
         self.context.load_verify_locations('/etc/pki/tls/certs/CERN-bundle.pem')
 
-    def __HTTPConnect__(self, mode, node):
-        urldata = None
-        try:
-            conn = http.client.HTTPSConnection(self.hostport, context=self.context)
-            rdata = urllib.parse.urlencode(node)
-            conn.request("POST", self.topdir+mode, rdata)
-            resp = conn.getresponse()
-            urldata = resp.read().decode()
+        # idle keep-alive connections, most recently used first
+        self.maxconnections = int(self.conf.get(['panda', 'connections']) or 10)
+        self.connections = queue.LifoQueue()
+        # number of attempts to connect to the server before giving up
+        self.retries = int(self.conf.get(['panda', 'retries']) or 3)
+        # counters per API method of calls, failures, new connections and
+        # seconds spent, see getStats()
+        self.stats = {}
+        self.statslock = threading.Lock()
+
+    def _getConnection(self):
+        '''Return (connection, reused) taking an idle connection if there is one'''
+        while True:
+            try:
+                conn = self.connections.get_nowait()
+            except queue.Empty:
+                return (http.client.HTTPSConnection(self.hostport, context=self.context, timeout=self.timeout), False)
+            # an idle connection is only readable if the server closed it
+            if conn.sock is not None and not select.select([conn.sock], [], [], 0)[0]:
+                return (conn, True)
             conn.close()
-        except Exception as x:
-            self.log.error("error in connection: %s" %x)
-        return urldata
+
+    def _releaseConnection(self, conn):
+        if self.connections.qsize() < self.maxconnections:
+            self.connections.put(conn)
+        else:
+            conn.close()
+
+    def _countCall(self, mode, seconds, failed, connects):
+        with self.statslock:
+            s = self.stats.setdefault(mode, {'calls': 0, 'failed': 0, 'connects': 0, 'seconds': 0.0})
+            s['calls'] += 1
+            s['failed'] += failed
+            s['connects'] += connects
+            s['seconds'] += seconds
+
+    def getStats(self):
+        '''Return and reset the per method counters of calls to the server'''
+        with self.statslock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def logStats(self, prefix=''):
+        '''Log and reset the counters of calls to the server'''
+        for mode, s in sorted(self.getStats().items()):
+            self.log.debug("%sPanda %s: %d calls, %d failed, %d new connections, %.3fs average" %
+                           (prefix, mode, s['calls'], s['failed'], s['connects'], s['seconds']/s['calls']))
+
+    def closeConnections(self):
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __HTTPConnect__(self, mode, node):
+        '''
+        POST node to the API method mode and return the response body, or None
+        on failure. A request is only sent again if it could not be sent on a
+        reused connection closed by the server, or if a new connection could
+        not be established. Once sent it is never repeated, even if the
+        connection is reset before the response, so that calls like getJob or
+        updateJob are not duplicated.
+        '''
+        rdata = urllib.parse.urlencode(node)
+        start = time.time()
+        connects = 0
+        attempt = 0
+        with timer('panda', mode):
+            while True:
+                conn, reused = self._getConnection()
+                try:
+                    if not reused:
+                        connects += 1
+                        conn.connect()
+                except Exception as x:
+                    conn.close()
+                    attempt += 1
+                    if attempt >= self.retries:
+                        self.log.error("error in connection: %s" %x)
+                        self._countCall(mode, time.time() - start, 1, connects)
+                        return None
+                    self.log.warning("error connecting to %s, will retry: %s" % (self.hostport, x))
+                    time.sleep(2**attempt)
+                    continue
+                try:
+                    conn.request("POST", self.topdir+mode, rdata, {'Content-Type': 'application/x-www-form-urlencoded'})
+                except self.staleerrors as x:
+                    conn.close()
+                    if reused:
+                        continue
+                    self.log.error("error in connection: %s" %x)
+                    self._countCall(mode, time.time() - start, 1, connects)
+                    return None
+                except Exception as x:
+                    conn.close()
+                    self.log.error("error in connection: %s" %x)
+                    self._countCall(mode, time.time() - start, 1, connects)
+                    return None
+                try:
+                    resp = conn.getresponse()
+                    urldata = resp.read().decode()
+                except Exception as x:
+                    conn.close()
+                    self.log.error("error in connection: %s" %x)
+                    self._countCall(mode, time.time() - start, 1, connects)
+                    return None
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._releaseConnection(conn)
+                self._countCall(mode, time.time() - start, 0, connects)
+                return urldata
 
     def getQueueStatus(self, queue=None):
         node = {}
@@ -12,6 +12,8 @@ class aCTPanda2Arc(aCTATLASProcess):
     Take new jobs in Panda table and insert then into the arcjobs table.
     '''
 
+    notifystates = {'pandajobs': ('sent', 'starting')}
+
     def __init__(self):
         aCTATLASProcess.__init__(self, ceflavour=['ARC-CE'])
 
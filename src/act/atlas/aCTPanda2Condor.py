@@ -8,6 +8,8 @@ class aCTPanda2Condor(aCTATLASProcess):
     Take new jobs in Panda table and insert then into the condorjobs table.
     '''
 
+    notifystates = {'pandajobs': ('sent', 'starting')}
+
     def __init__(self):
         aCTATLASProcess.__init__(self, ceflavour=['HTCONDOR-CE', 'CREAM-CE'])
 
@@ -0,0 +1,63 @@
+import asyncio
+import functools
+
+class aCTPandaAsync:
+    '''
+    asyncio front end to aCTPanda. Every method of aCTPanda is available as a
+    coroutine with the same name and arguments, e.g.
+
+      apanda = aCTPandaAsync(panda, executor)
+      runAll([(pandaid, apanda.updateStatus(pandaid, 'running', desc)), ...],
+             handler, concurrency=10)
+
+    Requests run in executor, a pool of long-lived threads, and use the
+    keep-alive connections of the aCTPanda object.
+    '''
+
+    def __init__(self, panda, executor):
+        self.panda = panda
+        self.executor = executor
+
+    def __getattr__(self, name):
+        func = getattr(self.panda, name)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        return call
+
+
+def runAll(calls, handler, concurrency=1, log=None):
+    '''
+    Run calls, a list of (key, coroutine), with at most concurrency of them in
+    progress at the same time. handler(key, result) is called in the calling
+    thread as soon as each call completes, so a slow request only delays its
+    own handling. Exceptions raised by a call or by handler are logged.
+    '''
+    if not calls:
+        return
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        async def limited(key, coro):
+            async with semaphore:
+                try:
+                    return (key, await coro, None)
+                except Exception as e:
+                    return (key, None, e)
+        for finished in asyncio.as_completed([limited(key, coro) for (key, coro) in calls]):
+            key, result, error = await finished
+            if error:
+                if log:
+                    log.error('%s: Panda call failed: %s' % (key, error))
+                continue
+            try:
+                handler(key, result)
+            except Exception as e:
+                if log:
+                    log.error('%s: Failed to handle Panda response: %s' % (key, e))
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
@@ -1,34 +1,18 @@
-from threading import Thread
 import re
 import time
 import random
 import arc
 from act.atlas import aCTPanda
+from act.atlas.aCTPandaAsync import aCTPandaAsync, runAll
 from act.common import aCTProxy
+from act.common.aCTWorkerPool import aCTWorkerPool
 from act.atlas.aCTATLASProcess import aCTATLASProcess
 
 
-class PandaGetThr(Thread):
-    """
-    Helper function for getting panda jobs
-    """
-    def __init__ (self, func, siteName, prodSourceLabel=None, getEventRanges=True, push=True):
-        Thread.__init__(self)
-        self.func = func
-        self.siteName = siteName
-        self.prodSourceLabel = prodSourceLabel
-        self.getEventRanges = getEventRanges
-        self.push = push
-        self.result = (None, None, None, None)
-    def run(self):
-        if not self.push:
-            self.result = (0, '', None, self.prodSourceLabel)
-        else:
-            self.result = self.func(self.siteName, self.prodSourceLabel, self.getEventRanges)
-
-
 class aCTPandaGetJobs(aCTATLASProcess):
 
+    notifystates = {}
+
     """
     Main class for Panda interaction. Three major functions: init, run, finish
     """
@@ -66,8 +50,16 @@ class aCTPandaGetJobs(aCTATLASProcess):
             self.pandas[role] = aCTPanda.aCTPanda(self.log, proxyfile)
             self.proxymap[psl] = proxyid
 
+        # getJob calls run concurrently in a pool of panda/threads threads.
+        # Calls hanging beyond twice the connection timeout are abandoned.
+        self.pool = aCTWorkerPool(self.log, int(self.conf.get(['panda','threads'])),
+                                      timeout=2*int(self.conf.get(['panda','timeout'])), name='panda')
+        self.apandas = dict((role, aCTPandaAsync(panda, self.pool)) for role, panda in self.pandas.items())
+
         # queue interval
         self.queuestamp=0
+        # time of last correction of pandajobs counts
+        self.treconcile=0
 
         # Register this aCT to APFMon
         self.apfmon.registerFactory()
@@ -111,6 +103,17 @@ class aCTPandaGetJobs(aCTATLASProcess):
     def getPanda(self, sitename):
         return self.pandas.get(self.sites[sitename]['type'], self.pandas.get('production'))
 
+    def getAPanda(self, sitename):
+        return self.apandas.get(self.sites[sitename]['type'], self.apandas.get('production'))
+
+    def getJobCall(self, site, prodSourceLabel, getEventRanges, push=True):
+        '''Return coroutine getting a job, or a pull mode placeholder'''
+        async def pull():
+            return (0, '', None, prodSourceLabel)
+        if not push:
+            return pull()
+        return self.getAPanda(site).getJob(site, prodSourceLabel, getEventRanges)
+
 
     def getJobs(self, num):
         """
@@ -146,12 +149,12 @@ class aCTPandaGetJobs(aCTATLASProcess):
             elif attrs['type'] == 'unified':
                 prodsourcelabel = 'unified'
 
+            counts = self.dbpanda.getCounts('actpandastatus', siteName=site)
             # Get number of jobs injected into ARC but not yet submitted
-            nsubmitting = self.dbpanda.getNJobs("actpandastatus='sent' and siteName='%s'" % site )
+            nsubmitting = counts.get('sent', 0)
 
             # Get total number of active jobs
-            nall = self.dbpanda.getNJobs("siteName='%s' and actpandastatus!='done' \
-                                          and actpandastatus!='donefailed' and actpandastatus!='donecancelled'" % site)
+            nall = sum(n for (state, n) in counts.items() if state not in ('done', 'donefailed', 'donecancelled'))
             self.log.info("Site %s: %i jobs in sent, %i total" % (site, nsubmitting, nall))
 
             # Limit number of jobs waiting submission to avoid getting too many
@@ -179,29 +182,28 @@ class aCTPandaGetJobs(aCTATLASProcess):
                 if stopflag:
                     continue
 
-                tlist = []
+                calls = []
 
                 for i in range(0, nthreads):
                     r = random.Random()
                     if site in []:
-                        t = PandaGetThr(self.getPanda(site).getJob, site, prodSourceLabel='ptest', getEventRanges=getEventRanges)
+                        call = self.getJobCall(site, 'ptest', getEventRanges)
                     elif r.randint(0,100) <= 2:
                         if (not self.getjob) and site in self.activated and self.activated[site]['rc_test'] == 0:
                             self.log.debug('%s: No rc_test activated jobs' % site)
-                            #t = PandaGetThr(self.getPanda(site).getJob, site, prodSourceLabel='ptest', getEventRanges=getEventRanges)
+                            #call = self.getJobCall(site, 'ptest', getEventRanges)
                             continue
                         else:
-                            t = PandaGetThr(self.getPanda(site).getJob, site, prodSourceLabel='rc_test', getEventRanges=getEventRanges, push=attrs['push'])
+                            call = self.getJobCall(site, 'rc_test', getEventRanges, push=attrs['push'])
                     else:
                         if (not self.getjob) and site in self.activated and self.activated[site]['rest'] == 0:
                             self.log.debug('%s: No activated jobs' % site)
                             continue
                         elif attrs['type'] == "analysis":
-                            t = PandaGetThr(self.getPanda(site).getJob, site, prodSourceLabel='user', getEventRanges=getEventRanges, push=attrs['push'])
+                            call = self.getJobCall(site, 'user', getEventRanges, push=attrs['push'])
                         else:
-                            t = PandaGetThr(self.getPanda(site).getJob, site, prodSourceLabel=prodsourcelabel, getEventRanges=getEventRanges, push=attrs['push'])
-                    tlist.append(t)
-                    t.start()
+                            call = self.getJobCall(site, prodsourcelabel, getEventRanges, push=attrs['push'])
+                    calls.append((site, call))
                     nall += 1
                     if nall >= self.sites[site]['maxjobs']:
                         self.log.info("Site %s: reached max job limit of %d" % (site, self.sites[site]['maxjobs']))
@@ -209,15 +211,16 @@ class aCTPandaGetJobs(aCTATLASProcess):
                         break
 
                 activatedjobs = False
-                for t in tlist:
-                    t.join()
-                    (pandaid, pandajob, eventranges, prodsrclabel) = t.result
+                # Jobs are inserted as soon as each getJob call returns
+                def handle(site, result):
+                    nonlocal activatedjobs, stopflag, count
+                    (pandaid, pandajob, eventranges, prodsrclabel) = result
                     if pandaid == -1: # No jobs available
-                        continue
+                        return
                     activatedjobs = True
                     if pandaid == None: # connection error
                         stopflag = True
-                        continue
+                        return
 
                     n = {}
                     # Check eventranges is defined for ES jobs
@@ -254,6 +257,7 @@ class aCTPandaGetJobs(aCTATLASProcess):
                     apfmonjobs.append((rowid, pandaid))
                     count += 1
 
+                runAll(calls, handle, nthreads, self.log)
                 if not activatedjobs:
                     if site in self.activated:
                         self.activated[site] = {'rest': 0, 'rc_test': 0}
@@ -276,12 +280,22 @@ class aCTPandaGetJobs(aCTATLASProcess):
             # Each 5 mins send the list of queues with maxjobs>0 to APFmon
             self.apfmon.registerLabels([k for (k,v) in self.sites.items() if v['maxjobs'] > 0])
 
+        # correct the job counts per site used for limits
+        if time.time() - self.treconcile > int(self.arcconf.get(['jobcounts', 'reconcile']) or 3600):
+            fixed = self.dbpanda.reconcileCounts()
+            if fixed:
+                self.log.warning("Corrected counts of %d site and state combinations" % fixed)
+            self.treconcile = time.time()
+
         # request new jobs
         num = self.getJobs(int(self.conf.get(['panda','getjobs'])))
         if num:
             self.log.info("Got %i jobs" % num)
         self.getjob = False
 
+        for role, panda in self.pandas.items():
+            panda.logStats('%s: ' % role)
+
 if __name__ == '__main__':
     am=aCTPandaGetJobs()
     am.run()
@@ -17,6 +17,8 @@ class aCTValidator(aCTATLASProcess):
     Validate output files for finished jobs, cleanup output files for failed jobs.
     '''
 
+    notifystates = {'pandajobs': ('tovalidate', 'toclean', 'toresubmit')}
+
     def __init__(self):
         aCTATLASProcess.__init__(self, ceflavour=['ARC-CE'])
 
@@ -8,6 +8,8 @@ class aCTValidatorCondor(aCTATLASProcess):
     condorjobs to clean, and cleans up any leftover temp files
     '''
 
+    notifystates = {'pandajobs': ('tovalidate', 'toclean', 'toresubmit')}
+
     def __init__(self):
         aCTATLASProcess.__init__(self, ceflavour=['HTCONDOR-CE', 'CREAM-CE'])
 
@@ -90,16 +90,11 @@ class Client2Arc(object):
         proxies = self.clidb.getProxies()
         for proxyid in proxies:
             # get number of all states of jobs with fairshare proxyid
-            states = self.getJobStateCount('fairshare = {}'.format(proxyid))
+            states = self.arcdb.getCounts('arcstate', fairshare=str(proxyid))
 
             # get number of running and submitted jobs
-            running = 0
-            submitted = 0
-            for state in states:
-                if state['arcstate'] == 'running':
-                    running = state['COUNT(arcstate)']
-                elif state['arcstate'] in ('submitted', 'submitting'):
-                    submitted += state['COUNT(arcstate)']
+            running = states.get('running', 0)
+            submitted = states.get('submitted', 0) + states.get('submitting', 0)
             #self.log.debug('{} jobs running for proxyid {}'.format(running, proxyid))
             #self.log.debug('{} jobs submitted for proxyid {}'.format(submitted, proxyid))
 
@@ -2,11 +2,46 @@ import os
 import time
 from xml.dom import minidom
 
+def _compile(element):
+    '''
+    Return (text, {tag: (node, ...)}) for a minidom node, where the dict holds
+    all descendant elements by tag name in document order, as
+    getElementsByTagName() returns them. text is the data of the first child.
+    '''
+    index = {}
+    for child in element.childNodes:
+        if child.nodeType != child.ELEMENT_NODE:
+            continue
+        node = _compile(child)
+        index.setdefault(child.tagName, []).append(node)
+        for tag, nodes in node[1].items():
+            index.setdefault(tag, []).extend(nodes)
+    text = getattr(element.firstChild, 'data', None)
+    return (text, dict((tag, tuple(nodes)) for tag, nodes in index.items()))
+
+def _select(nodes, names):
+    '''Return the elements found by following the tag names from nodes'''
+    for name in names:
+        nodes = [n for node in nodes for n in node[1].get(name, ())]
+    return nodes
+
+def _values(nodes):
+    return tuple(node[0] for node in nodes if node[0] is not None)
+
+
 class aCTConfig:
+    '''
+    XML configuration file. parse() compiles the file into an immutable index
+    of elements by tag, and re-reads it only if it was modified. Results of
+    lookups are cached until the next reload, so repeated calls in agent
+    loops do not walk the tree.
+    '''
 
     def __init__(self, configfile):
         self.configfile = configfile
-        self.top=[]
+        self.top=()
+        # results of lookups in the current top, cleared when it changes
+        self.cache = {}
         self.tparse=0
         if self.configfile:
             self.parse()
@@ -16,52 +51,31 @@ class aCTConfig:
         if mtime<=self.tparse:
             return
         xml=minidom.parse(self.configfile)
-        self.top=xml.getElementsByTagName('config')
+        top=_compile(xml)[1].get('config', ())
+        # top is replaced first so that a new cache never holds results
+        # from the old top
+        self.top = top
+        self.cache = {}
         self.tparse=mtime
 
 
     def getList(self,nodes):
-        n0=self.top
-        for name in nodes:
-            tn=[]
-            for n in n0:
-                n1=n.getElementsByTagName(name)
-                tn.extend(n1)
-            n0=tn
-        l=[]
-        for nn in n0:
-            l.append(nn.firstChild.data)
-        return l
+        key = tuple(nodes)
+        cache = self.cache
+        if key not in cache:
+            cache[key] = _values(_select(self.top, nodes))
+        return list(cache[key])
 
 
     def getListCond(self,nodesc,cond,nodes):
-        c=cond.split("=")
-        n0=self.top
-        for name in nodesc:
-            tn=[]
-            for n in n0:
-                n1=n.getElementsByTagName(name)
-                tn.extend(n1)
-            n0=tn
-
-        el=[]
-        for t in tn:
-            n1=t.getElementsByTagName(c[0])
-            if( n1 and n1[0].firstChild.data == c[1] ):
-                el.append(t)
-
-        n0=el
-        for name in nodes:
-            tn=[]
-            for n in n0:
-                n1=n.getElementsByTagName(name)
-                tn.extend(n1)
-            n0=tn
-
-        l=[]
-        for nn in n0:
-            l.append(nn.firstChild.data)
-        return l
+        key = (tuple(nodesc), cond, tuple(nodes))
+        cache = self.cache
+        if key not in cache:
+            (condtag, condvalue) = cond.split("=")[:2]
+            selected = [n for n in _select(self.top, nodesc)
+                        if n[1].get(condtag) and n[1][condtag][0][0] == condvalue]
+            cache[key] = _values(_select(selected, nodes))
+        return list(cache[key])
 
 
     def get(self,nodes):
@@ -0,0 +1,78 @@
+import argparse
+import importlib
+import sys
+from act.common.aCTLogger import aCTLogger
+from act.common.aCTConfig import aCTConfigAPP
+from act.arc.aCTDBArc import aCTDBArc
+from act.condor.aCTDBCondor import aCTDBCondor
+
+def migrate(db, dryrun):
+    '''Create missing columns, indexes and count table of db and record them. Returns False if any failed'''
+    ok = True
+    if db.table in db.counts and '%s.counts' % db.table not in db.detectSchema():
+        print(f'{db.table}: missing count table {db.counts[db.table][0]}')
+        if not dryrun:
+            ok = db.createCounts()
+    missingcolumns = db.getMissingColumns()
+    for table, name, ctype in missingcolumns:
+        print(f'{table}: missing column {name} {ctype}')
+    missing = db.getMissingIndexes()
+    for table, name, columns in missing:
+        print(f'{table}: missing index {name} ({", ".join(columns)})')
+    if dryrun:
+        return True
+    ok = (not missingcolumns or db.createColumns()) and ok
+    ok = (not missing or db.createIndexes()) and ok
+    # processes read the features available from actschema
+    return db.recordSchema() and ok
+
+def migrate_arc(log, dryrun):
+    '''Add arcjob_clusters table and indexes to ARC and Condor tables'''
+    dbarc = aCTDBArc(log)
+    ok = True
+    if 'arcjobs.clustermap' not in dbarc.detectSchema():
+        print('arcjobs: missing table arcjob_clusters or its triggers')
+        if not dryrun:
+            ok = dbarc.createClusterMap()
+    # indexes of arcjob_clusters can only be checked once it exists
+    ok = migrate(dbarc, dryrun) and ok
+    ok = migrate(aCTDBCondor(log), dryrun) and ok
+    return ok
+
+def migrate_app(log, dryrun):
+    '''Call migrate(log, dryrun) in aCTBootstrap of each app if it exists'''
+    ok = True
+    appconf = aCTConfigAPP()
+    for app in appconf.getList(["modules", "app"]):
+        try:
+            ap = importlib.import_module(f'{app}.aCTBootstrap').migrate
+        except (ModuleNotFoundError, AttributeError):
+            continue
+        try:
+            ok = ap(log, dryrun) and ok
+        except Exception as e:
+            print(f'Exception running {app}.aCTBootstrap.migrate(): {e}')
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrade the schema of an existing aCT DB: add the '
+                                     'columns, indexes and tables used by the current version. Best run '
+                                     'while aCT is stopped since creating indexes on large tables '
+                                     'can block writes.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only list the missing columns, indexes and tables')
+    args = parser.parse_args()
+
+    logger = aCTLogger('aCTDBMigrate')
+    log = logger()
+    ok = migrate_arc(log, args.dry_run)
+    ok = migrate_app(log, args.dry_run) and ok
+    if not ok:
+        print('Migration failed, see aCTDBMigrate.log for details')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,16 +20,21 @@ class aCTLogger:
         level = LEVELS.get(self.conf.get(["logger","level"]), logging.NOTSET)
         logfile = os.path.join(self.conf.get(["logger","logdir"]), name + '.log')
         self.logger.logger.setLevel(level)
-        # aCTMain calls logrotate to rotate logs
-        self.handler = logging.handlers.WatchedFileHandler(logfile)
-
-        if cluster:
-            self.formatter = logging.Formatter("[%(asctime)s] [%(filename)s:%(lineno)d] [%(levelname)s] [%(cluster)s] - %(message)s")
+        # loggers are global so a process creating several aCTLoggers with
+        # the same name must add the handler only once
+        if self.logger.logger.handlers:
+            self.handler = self.logger.logger.handlers[0]
         else:
-            self.formatter = logging.Formatter("[%(asctime)s] [%(filename)s:%(lineno)d] [%(levelname)s] - %(message)s")
+            # aCTMain calls logrotate to rotate logs
+            self.handler = logging.handlers.WatchedFileHandler(logfile)
+
+            if cluster:
+                self.formatter = logging.Formatter("[%(asctime)s] [%(filename)s:%(lineno)d] [%(levelname)s] [%(cluster)s] - %(message)s")
+            else:
+                self.formatter = logging.Formatter("[%(asctime)s] [%(filename)s:%(lineno)d] [%(levelname)s] - %(message)s")
 
-        self.handler.setFormatter(self.formatter)
-        self.logger.logger.addHandler(self.handler)
+            self.handler.setFormatter(self.formatter)
+            self.logger.logger.addHandler(self.handler)
 
         if arclog:
             self.arclogfile = arc.LogFile(str(logfile))
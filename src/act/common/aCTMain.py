@@ -236,6 +236,7 @@ class aCTMain:
                 if self.shouldrun:
                     self.procmanager.checkARCClusters()
                     self.procmanager.checkCondorClusters()
+                    self.procmanager.reconcileCounts()
                 # sleep
                 aCTUtils.sleep(10)
 
@@ -1,15 +1,57 @@
 # Monitor process to export prometheus data
 import importlib
+import os
 from prometheus_client import start_http_server
-from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily, REGISTRY
+from act.common import aCTStats
 from act.common.aCTProcess import aCTProcess
-from act.common.aCTConfig import aCTConfigAPP
+from act.common.aCTConfig import aCTConfigAPP, aCTConfigARC
 from act.arc.aCTDBArc import aCTDBArc
 
 class aCTPrometheusCollector:
 
     def __init__(self, log):
         self.log = log
+        self.statsdir = os.path.join(str(aCTConfigARC().get(['tmp', 'dir'])), 'stats')
+
+    def agent_collect(self):
+        '''Histograms written by each agent with aCTStats'''
+
+        descriptions = {'loop_duration': 'Duration of agent loop in seconds',
+                        'loop_queries': 'DB queries per agent loop',
+                        'loop_rows': 'DB rows read or changed per agent loop',
+                        'loop_db_seconds': 'Seconds spent in the DB per agent loop',
+                        'loop_db_lockwaits': 'DB deadlocks and lock wait timeouts per agent loop',
+                        'call_seconds': 'Latency of calls to external services in seconds',
+                        'pool_queue_depth': 'Tasks waiting in worker pool queue when a task is submitted',
+                        'pool_wait_seconds': 'Seconds tasks waited in worker pool queue before starting',
+                        'fetch_bytes_per_second': 'Output download rate per CE endpoint in bytes per second'}
+        metrics = {}
+        for m, desc in descriptions.items():
+            labels = ['agent', 'cluster']
+            if m == 'call_seconds':
+                labels.extend(['service', 'call'])
+            elif m.startswith('pool_'):
+                labels.append('pool')
+            elif m.startswith('fetch_'):
+                labels.append('endpoint')
+            metrics[m] = HistogramMetricFamily(f'act_{m}', desc, labels=labels)
+
+        for stats in aCTStats.readAll(self.statsdir):
+            for m, histograms in stats['histograms'].items():
+                if m not in metrics:
+                    continue
+                bounds = stats['buckets'][m]
+                for label, h in histograms.items():
+                    labels = [stats['agent'], stats['cluster'] or 'None']
+                    if m == 'call_seconds':
+                        labels.extend(label.split('/', 1))
+                    elif m.startswith('pool_') or m.startswith('fetch_'):
+                        labels.append(label)
+                    buckets = [(str(b), c) for b, c in zip(bounds, h)] + [('+Inf', h[-2])]
+                    metrics[m].add_metric(labels, buckets, h[-1])
+
+        yield from metrics.values()
 
     def app_collect(self):
 
@@ -42,10 +84,10 @@ class aCTPrometheusCollector:
                                                labels=['ce_endpoint'])
 
         db = aCTDBArc(self.log)
-        jobs = db.getGroupedJobs('cluster, arcstate')
+        jobs = db.getCounts(('cluster', 'arcstate'), arcstate=['submitted', 'running', 'finishing'])
 
-        for job in jobs:
-            count, cluster, state = (job['count(*)'], job['cluster'] or 'None', job['arcstate'])
+        for (cluster, state), count in jobs.items():
+            cluster = cluster or 'None'
             if state == 'submitted':
                 queued_arc_jobs.add_metric([cluster], count)
             if state == 'running':
@@ -56,6 +98,7 @@ class aCTPrometheusCollector:
         yield queued_arc_jobs
         yield running_arc_jobs
         yield finishing_arc_jobs
+        yield from self.agent_collect()
         yield from self.app_collect()
 
 class aCTMonitor(aCTProcess):
@@ -0,0 +1,145 @@
+# aCTNotify.py
+#
+# Lightweight notification of job state changes between aCT processes
+#
+import glob
+import hashlib
+import os
+import select
+import socket
+import time
+
+class aCTNotify:
+    '''
+    Notifications of job state changes using unix datagram sockets in
+    <tmp/dir>/notify. Each listening process binds one socket per table it
+    follows, named <table>.<clusterkey>.<pid>.sock, where clusterkey is a hash
+    of the cluster or "all" to receive changes for every cluster. After a
+    commit the DB layer sends a datagram with the comma-separated new states
+    of the changed jobs to the sockets of the affected table and cluster. A
+    process waiting in wait() is woken up if one of the states is one it
+    listens for. An empty datagram means the states are unknown and wakes up
+    every listener.
+
+    Notifications are only a hint that something changed, the DB is always
+    the source of truth. Processes still poll with the given timeout so lost
+    notifications only cost latency.
+    '''
+
+    def __init__(self, log, conf):
+        self.log = log
+        self.enabled = str(conf.get(['notify', 'enabled'])).lower() == 'true'
+        self.sockdir = os.path.join(str(conf.get(['tmp', 'dir'])), 'notify')
+        # (socket, path, states or None for all states)
+        self.socks = []
+        # socket used for sending, created on first use
+        self.sender = None
+        if self.enabled:
+            os.makedirs(self.sockdir, mode=0o755, exist_ok=True)
+
+    def __del__(self):
+        self.close()
+
+    def _clusterkey(self, cluster):
+        if cluster is None:
+            return 'all'
+        return hashlib.md5(str(cluster).encode()).hexdigest()[:16]
+
+    def listen(self, table, cluster=None, states=None):
+        '''
+        Start receiving notifications for changes in table. If cluster is None
+        changes for all clusters are received. If states is given only changes
+        to one of these states wake up the process.
+        '''
+        if not self.enabled:
+            return
+        path = os.path.join(self.sockdir, '%s.%s.%d.sock' % (table, self._clusterkey(cluster), os.getpid()))
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        s.bind(path)
+        s.setblocking(False)
+        self.socks.append((s, path, None if states is None else frozenset(states)))
+
+    def send(self, table, cluster=None, states=None):
+        '''
+        Notify listeners of table that jobs changed to states. Listeners of
+        cluster and listeners of all clusters are notified. If cluster is None
+        all listeners of table are notified. If states is None the new states
+        are unknown.
+        '''
+        if not self.enabled:
+            return
+        if cluster is None:
+            paths = glob.glob(os.path.join(self.sockdir, '%s.*.sock' % table))
+        else:
+            paths = glob.glob(os.path.join(self.sockdir, '%s.%s.*.sock' % (table, self._clusterkey(cluster)))) + \
+                    glob.glob(os.path.join(self.sockdir, '%s.all.*.sock' % table))
+        # don't wake up this process with its own changes
+        own = '.%d.sock' % os.getpid()
+        paths = [p for p in paths if not p.endswith(own)]
+        if not paths:
+            return
+        if not self.sender:
+            self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sender.setblocking(False)
+        msg = ','.join(sorted(states)).encode() if states else b''
+        for path in paths:
+            try:
+                self.sender.sendto(msg, path)
+            except BlockingIOError:
+                # Receiver queue is full so it is already notified
+                pass
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Process is gone, remove stale socket
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                self.log.debug("Failed to notify %s: %s" % (path, str(e)))
+
+    def wait(self, timeout):
+        '''
+        Wait until a notification of a state listened for arrives or timeout
+        seconds pass. Returns True if woken up by a notification.
+        '''
+        if not self.socks:
+            if timeout > 0:
+                select.select([], [], [], timeout)
+            return False
+        socks = dict((s, states) for (s, _, states) in self.socks)
+        deadline = time.time() + timeout
+        while True:
+            readable = select.select(list(socks), [], [], max(deadline - time.time(), 0))[0]
+            if not readable:
+                return False
+            # drain all pending notifications, many changes lead to one wakeup
+            woken = False
+            for s in readable:
+                try:
+                    while True:
+                        msg = s.recv(4096)
+                        if socks[s] is None or not msg or socks[s].intersection(msg.decode().split(',')):
+                            woken = True
+                except (BlockingIOError, OSError):
+                    pass
+            if woken:
+                return True
+
+    def close(self):
+        for (s, path, _) in self.socks:
+            s.close()
+            # forked children must not remove the parent's socket
+            if not path.endswith('.%d.sock' % os.getpid()):
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.socks = []
+        if self.sender:
+            self.sender.close()
+            self.sender = None
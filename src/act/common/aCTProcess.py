@@ -9,7 +9,11 @@ from urllib.parse import urlparse
 from . import aCTLogger
 from . import aCTConfig
 from . import aCTSignal
+from . import aCTStats
+from .aCTNotify import aCTNotify
+from .aCTWorkerPool import aCTWorkerPool
 from act.arc import aCTDBArc
+from act.db.aCTDBMS import aCTDBLockError
 from act.condor.aCTDBCondor import aCTDBCondor
 
 
@@ -17,22 +21,36 @@ class aCTProcess:
     '''
     Base class for all aCT processes. Sets up logging, configuration and ARC
     environment and provides basic start and stop functionality.
+
+    Agents normally run as their own process with the cluster given on the
+    command line. If cluster is passed here the agent is hosted by another
+    process (see aCTClusterHost) which calls processLoop() itself, and pool
+    may be the worker pool shared by the agents of that process.
     '''
 
-    def __init__(self):
+    # Job state changes which wake up the agent, as {table: states} where
+    # states None means any state. Subclasses list the states they process.
+    notifystates = {'arcjobs': None, 'condorjobs': None}
+
+    def __init__(self, cluster=None, pool=None):
 
-        # Get agent name from /path/to/aCTAgent.py
-        self.name = os.path.basename(sys.argv[0])[:-3]
-        self.cluster = ''
+        self.hosted = cluster is not None
+        if self.hosted:
+            self.name = type(self).__name__
+            self.cluster = cluster
+        else:
+            # Get agent name from /path/to/aCTAgent.py
+            self.name = os.path.basename(sys.argv[0])[:-3]
+            self.cluster = sys.argv[1] if len(sys.argv) == 2 else ''
         clusterhost = ''
-        if len(sys.argv) == 2:
-            self.cluster = sys.argv[1]
+        if self.cluster:
             url = urlparse(self.cluster)
             clusterhost = url.netloc.split(':')[0] if url.netloc else url.path
 
         # logger
         logname = '%s-%s' % (self.name, clusterhost) if clusterhost else self.name
-        self.logger=aCTLogger.aCTLogger(logname, cluster=self.cluster)
+        # ARC logs to the root logger, which the hosting process sets up
+        self.logger=aCTLogger.aCTLogger(logname, cluster=self.cluster, arclog=not self.hosted)
         self.log=self.logger()
         self.criticallogger = aCTLogger.aCTLogger('aCTCritical', cluster=self.cluster, arclog=False)
         self.criticallog = self.criticallogger()
@@ -46,19 +64,78 @@ class aCTProcess:
         self.dbcondor=aCTDBCondor(self.log)
 
         # ARC Configuration
-        # Credentials will be set by ARC agents for each job or set of jobs
-        # but for now set default credential in config to keep ARC happy
-        cred_type=arc.initializeCredentialsType(arc.initializeCredentialsType.SkipCredentials)
-        self.uc=arc.UserConfig(cred_type)
-        self.uc.ProxyPath(str(self.conf.get(['voms', 'proxypath'])))
-        self.uc.CACertificatesDirectory(str(self.conf.get(["voms", "cacertdir"])))
-        timeout=int(self.conf.get(['atlasgiis','timeout']))
-        self.uc.Timeout(timeout)
+        self.uc=self.userConfig()
+
+        # Notifications of job changes for this cluster, to avoid waiting for
+        # the full poll interval when there is something to do
+        self.notify = aCTNotify(self.log, self.conf)
+        # sockets are per process so only one agent in a process can listen
+        if self.cluster and not self.hosted:
+            for table, states in self.notifystates.items():
+                self.notify.listen(table, self.cluster, states)
+        self.loopinterval = float(self.conf.get(['notify', 'mininterval']) or 1)
+
+        # loop and external call timings exported by aCTMonitor
+        self.stats = aCTStats.setup(self.log, self.conf, self.name, self.cluster)
+
+        # worker pool of the hosting process, see workerPool()
+        self.sharedpool = pool
+        # time before which the agent should not run again, set by agents
+        # backing off from a failing cluster
+        self.holdoff = 0
+        # time by which a hosted agent should return from processLoop(), set
+        # by the hosting process, see pastDeadline()
+        self.deadline = None
 
         # start time for periodic restart
         self.starttime=time.time()
         self.log.info("Started %s for cluster %s", self.name, self.cluster)
 
+    def userConfig(self, proxystring=None):
+        '''
+        Return a new ARC UserConfig with the credential proxystring. Without
+        it credentials will be set by ARC agents for each job or set of jobs
+        but for now set default credential in config to keep ARC happy.
+        Tasks in worker pools should use a UserConfig of their own, since
+        tasks abandoned by the pool may still be running when the agent
+        changes the credential of self.uc.
+        '''
+        cred_type=arc.initializeCredentialsType(arc.initializeCredentialsType.SkipCredentials)
+        uc=arc.UserConfig(cred_type)
+        uc.ProxyPath(str(self.conf.get(['voms', 'proxypath'])))
+        uc.CACertificatesDirectory(str(self.conf.get(["voms", "cacertdir"])))
+        timeout=int(self.conf.get(['atlasgiis','timeout']))
+        uc.Timeout(timeout)
+        if proxystring:
+            uc.CredentialString(proxystring)
+        return uc
+
+    def workerPool(self, nworkers, timeout, name):
+        '''
+        Return the pool shared by the agents of the hosting process, or a new
+        pool of nworkers threads. Tasks should be submitted with an explicit
+        timeout as the shared pool has none.
+        '''
+        if self.sharedpool:
+            return self.sharedpool
+        return aCTWorkerPool(self.log, nworkers, timeout=timeout, name=name)
+
+    def closePool(self, pool):
+        '''Shut down pool unless it is shared with other agents'''
+        if pool is not self.sharedpool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def pastDeadline(self):
+        '''
+        True if the deadline of a hosted agent has passed. Agents check it
+        before each page of jobs so that a step ends at most one page, whose
+        tasks have their own timeouts, after the deadline.
+        '''
+        if self.deadline and time.time() > self.deadline:
+            self.log.info("Deadline of %s reached, continuing next time" % self.name)
+            return True
+        return False
+
 
     def process(self):
         '''
@@ -67,20 +144,43 @@ class aCTProcess:
         '''
         pass
 
+    def processLoop(self):
+        '''
+        Call process() and record the loop statistics. Returns the duration
+        of the loop.
+        '''
+        looptime = time.time()
+        try:
+            self.process()
+        except aCTDBLockError as e:
+            # rolled back, the jobs are processed again in the next loop
+            self.log.warning("DB lock conflict: %s" % str(e))
+        # DB connection is shared by all tables
+        dbstats = self.db.db.resetStats()
+        duration = time.time() - looptime
+        self.stats.observeLoop(duration, dbstats)
+        self.stats.write()
+        self.log.debug("DB operations in loop: %(queries)d queries, %(commits)d commits, %(reconnects)d reconnects, %(rows)d rows, %(lockwaits)d lock waits, %(dbtime).3fs" % dbstats)
+        return duration
+
     def run(self):
         '''
         Main loop
         '''
         try:
+            looptime = 0
             while 1:
                 # parse config file
                 self.conf.parse()
                 # Check if the site is in downtime
                 if self.cluster not in self.conf.getList(['downtime', 'item']):
-                    # sleep between 5 and 10 seconds
-                    time.sleep(5 + random.random()*5)
+                    # wait for a job change notification or between 5 and
+                    # 10 seconds, but not less than loopinterval between loops
+                    self.notify.wait(5 + random.random()*5)
+                    time.sleep(max(0, looptime + self.loopinterval - time.time(), self.holdoff - time.time()))
+                    looptime = time.time()
                     # do class-specific things
-                    self.process()
+                    self.processLoop()
                 # restart periodically for gsiftp crash
                 ip = int(self.conf.get(['periodicrestart', self.name.lower()]) or 0)
                 if ip and time.time()-self.starttime > ip :
@@ -94,11 +194,18 @@ class aCTProcess:
             self.log.critical("*** Process exiting ***")
             self.criticallog.critical(traceback.format_exc())
 
-    def finish(self):
+    def close(self):
         '''
-        Clean up code when process exits
+        Release the resources of this agent
         '''
+        self.notify.close()
         self.db.close()
         self.dbcondor.close()
         self.log.info("Cleanup for cluster %s", self.cluster)
+
+    def finish(self):
+        '''
+        Clean up code when process exits
+        '''
+        self.close()
         os._exit(0)
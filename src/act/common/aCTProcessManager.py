@@ -1,9 +1,12 @@
 import importlib
 import itertools
+import signal
 import subprocess
 import os
+import time
 
 from . import aCTUtils
+from .aCTZygote import aCTZygoteClient
 from act.arc import aCTDBArc
 from act.condor import aCTDBCondor
 
@@ -25,6 +28,8 @@ class aCTProcessManager:
         # list of processes to run per cluster
         self.arcprocesses = ['act/arc/aCTStatus', 'act/arc/aCTFetcher', 'act/arc/aCTCleaner']
         self.condorprocesses = ['act/condor/aCTStatus', 'act/condor/aCTFetcher', 'act/condor/aCTCleaner']
+        # process running arcprocesses for many clusters, if hosting is enabled
+        self.archost = 'act/arc/aCTClusterHost'
         # submitter process
         self.arcsubmitter = 'act/arc/aCTSubmitter'
         self.condorsubmitter = 'act/condor/aCTSubmitter'
@@ -49,6 +54,21 @@ class aCTProcessManager:
         # dictionary of cluster to list of Submitter processes handlers, there should
         # be one per unique cluster in clusterlist
         self.submitters = {}
+        # list of aCTClusterHost process handlers, index in list is host index
+        self.hosts = []
+        # time of last correction of job counts
+        self.treconcile = 0
+
+        # fork agents from a process which has already imported them
+        self.zygote = None
+        if str(self.conf.get(['zygote', 'enabled'])).lower() == 'true':
+            agents = self.arcprocesses + self.condorprocesses + [self.archost, self.arcsubmitter, self.condorsubmitter]
+            agents.extend(self.processes_single)
+            self.zygote = aCTZygoteClient(self.log, os.path.join(self.actlocation, 'act/common/aCTZygote.py'),
+                                          open(os.path.join(self.logdir, 'aCTZygote.log'), 'a'),
+                                          [a.replace('/', '.') for a in agents],
+                                          int(self.conf.get(['zygote', 'timeout']) or 60))
+        self.aCTProcessHandler.zygote = self.zygote
 
         # Start single instance processes
         for process in self.processes_single:
@@ -70,6 +90,12 @@ class aCTProcessManager:
         for appproc, proc in self.processes_single.items():
             self.log.info('Terminating %s' % appproc)
             proc.terminate()
+        for proc in self.hosts:
+            self.log.info('Terminating aCTClusterHost %s' % proc.cluster)
+            proc.terminate()
+        if self.zygote:
+            self.log.info('Terminating zygote')
+            self.zygote.stop()
 
         # Sleep to allow processes to exit before checking them in aCTProcess
         # destructor
@@ -88,12 +114,55 @@ class aCTProcessManager:
         self.dbcondor = aCTDBCondor.aCTDBCondor(self.log)
 
 
+    def reconcileCounts(self):
+        '''
+        Correct the arcjobs count table every jobcounts/reconcile seconds
+        '''
+        if time.time() - self.treconcile < int(self.conf.get(['jobcounts', 'reconcile']) or 3600):
+            return
+        self.treconcile = time.time()
+        fixed = self.dbarc.reconcileCounts()
+        if fixed:
+            self.log.warning("Corrected counts of %d cluster, fairshare and state combinations", fixed)
+
+    def checkClusterHosts(self, hosting):
+        '''
+        Start or stop aCTClusterHost processes depending on hosting config.
+        When hosting, per-cluster ARC processes are stopped.
+        '''
+        nhosts = int(self.conf.get(['hosting', 'processes']) or 1) if hosting else 0
+        while len(self.hosts) > nhosts:
+            proc = self.hosts.pop()
+            self.log.info("Stopping aCTClusterHost %s", proc.cluster)
+            proc.terminate()
+        for proc in self.hosts:
+            if proc.check() != None:
+                self.log.info("Restarting aCTClusterHost %s", proc.cluster)
+                proc.restart()
+        while len(self.hosts) < nhosts:
+            self.log.info("Starting aCTClusterHost %d", len(self.hosts))
+            ph = self.aCTProcessHandler(self.archost, self.logdir, str(len(self.hosts)), actlocation=self.actlocation)
+            ph.start()
+            self.hosts.append(ph)
+        if not hosting:
+            return
+        for cluster, procs in list(self.running.items()):
+            for proc in [p for p in procs if p.name in self.arcprocesses]:
+                self.log.info("Stopping %s for %s as clusters are hosted", proc.name, cluster)
+                proc.terminate()
+                procs.remove(proc)
+            if not procs:
+                del self.running[cluster]
+
     def checkARCClusters(self):
         '''
         Get the list of current clusters and (re)start necessary processes
         '''
 
         self.conf.parse()
+        # run status, fetcher and cleaner of all clusters in a few processes
+        hosting = str(self.conf.get(['hosting', 'enabled'])).lower() == 'true'
+        self.checkClusterHosts(hosting)
 
         clusters = self.dbarc.getActiveClusters()
         activeclusters = dict((k, v) for (k, v) in zip([c['cluster'] for c in clusters],
@@ -127,7 +196,7 @@ class aCTProcessManager:
 
         # Check for new processes to start
         for cluster in activeclusters:
-            if cluster and cluster not in self.running.keys():
+            if cluster and cluster not in self.running.keys() and not hosting:
                 self.running[cluster] = []
                 for proc in self.arcprocesses:
                     self.log.info("Starting process %s for %s", proc, cluster)
@@ -236,39 +305,63 @@ class aCTProcessManager:
 
     class aCTProcessHandler:
         """
-        Internal process control class wrapping Popen
+        Internal process control class wrapping Popen, or a process forked
+        by the zygote if one is set
         """
+        # aCTZygoteClient shared by all handlers, None to always use Popen
+        zygote = None
+
         def __init__(self, name, logdir, cluster='', actlocation=''):
             self.name = name
             self.cluster = cluster
             self.child = None
+            # pid and returncode of a process started by the zygote
+            self.pid = None
+            self.rc = None
             self.actlocation = actlocation
             # Redirect stdout and stderr to process log
-            self.fdout = open(os.path.join(logdir, name[name.rfind('/')+1:]+'.log'), 'a')
+            self.logfile = os.path.join(logdir, name[name.rfind('/')+1:]+'.log')
+            self.fdout = open(self.logfile, 'a')
         def __del__(self):
             self.kill()
         def start(self):
-            self.child = subprocess.Popen(['/usr/bin/env', 'python3', os.path.join(self.actlocation, self.name+".py"), self.cluster], stdout=self.fdout, stderr=subprocess.STDOUT)
+            script = os.path.join(self.actlocation, self.name+".py")
+            self.child = None
+            self.pid = self.zygote and self.zygote.spawn(script, [self.cluster], self.logfile)
+            self.rc = None
+            if not self.pid:
+                self.child = subprocess.Popen(['/usr/bin/env', 'python3', script, self.cluster], stdout=self.fdout, stderr=subprocess.STDOUT)
         def check(self):
-            return self.child.poll()
+            if self.child:
+                return self.child.poll()
+            if self.rc is None and self.pid:
+                self.rc = self.zygote.poll(self.pid)
+            return self.rc
         def restart(self):
             if self.check() != None:
                 self.start()
-        def terminate(self):
+        def signal(self, sig):
             if self.child:
-                self.child.terminate()
+                self.child.send_signal(sig)
+            elif self.pid and self.check() == None:
+                try:
+                    os.kill(self.pid, sig)
+                except OSError: # process already exited
+                    pass
+        def terminate(self):
+            self.signal(signal.SIGTERM)
         def kill(self):
             # first kill nicely (SIGTERM)
             self.terminate()
-            if self.child and self.check() == None:
+            pid = self.child.pid if self.child else self.pid
+            if pid and self.check() == None:
                 try:
-                    print('checking pid', self.child.pid)
-                    os.kill(self.child.pid, 0)
+                    print('checking pid', pid)
+                    os.kill(pid, 0)
                 except OSError: # process already exited
                     print('process gone')
                     return
                 print('process still running, sleeping')
                 aCTUtils.sleep(1)
                 # make sure it is gone
-                self.child.kill()
-
+                self.signal(signal.SIGKILL)
@@ -0,0 +1,162 @@
+# aCTStats.py
+#
+# Per-loop timing and external call latency of aCT agents, exported to
+# Prometheus by aCTMonitor
+#
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Upper bounds of histogram buckets for each metric
+buckets = {'loop_duration': (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600),
+           'loop_queries': (1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+           'loop_rows': (1, 10, 100, 1000, 10000, 100000),
+           'loop_db_seconds': (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60),
+           'loop_db_lockwaits': (0, 1, 5, 10, 50, 100),
+           'call_seconds': (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300),
+           'pool_queue_depth': (0, 1, 5, 10, 50, 100, 500, 1000),
+           'pool_wait_seconds': (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+           'fetch_bytes_per_second': (1e4, 1e5, 1e6, 1e7, 3e7, 1e8, 3e8, 1e9)}
+
+# Process-wide instance set up by the agent base classes
+_stats = None
+
+class aCTStats:
+    '''
+    Histograms of loop duration, DB activity per loop and latency of calls to
+    external services (ARC CEs, HTCondor, Panda) for one agent. The agent
+    writes them to <tmp/dir>/stats/<agent>.<clusterkey>.json after each loop
+    and the aCTMonitor collector exports all files as Prometheus histograms
+    labelled by agent and cluster. Histograms are cumulative over the life of
+    the process, like Prometheus counters.
+    '''
+
+    # minimum seconds between writes of the stats file
+    writeinterval = 10
+
+    def __init__(self, log, conf, name, cluster=''):
+        self.log = log
+        self.name = name
+        self.cluster = cluster
+        self.statsdir = os.path.join(str(conf.get(['tmp', 'dir'])), 'stats')
+        clusterkey = hashlib.md5(cluster.encode()).hexdigest()[:16] if cluster else 'all'
+        self.path = os.path.join(self.statsdir, '%s.%s.json' % (name, clusterkey))
+        # {metric: {label: [bucket counts..., count, sum]}}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.lastwrite = 0
+        os.makedirs(self.statsdir, mode=0o755, exist_ok=True)
+
+    def observe(self, metric, value, label=''):
+        '''Add value to the histogram of metric with the given label'''
+        bounds = buckets[metric]
+        with self.lock:
+            h = self.histograms.setdefault(metric, {}).setdefault(label, [0] * (len(bounds) + 2))
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += 1
+            h[-1] += value
+
+    def observeLoop(self, duration, dbstats):
+        '''Record one agent loop, dbstats is the output of aCTDBMS.resetStats()'''
+        self.observe('loop_duration', duration)
+        self.observe('loop_queries', dbstats['queries'])
+        self.observe('loop_rows', dbstats['rows'])
+        self.observe('loop_db_seconds', dbstats['dbtime'])
+        self.observe('loop_db_lockwaits', dbstats['lockwaits'])
+
+    def write(self, force=False):
+        '''Write histograms to the stats file, at most every writeinterval seconds'''
+        if not force and time.time() - self.lastwrite < self.writeinterval:
+            return
+        self.lastwrite = time.time()
+        with self.lock:
+            data = {'agent': self.name, 'cluster': self.cluster, 'pid': os.getpid(),
+                    'buckets': buckets, 'histograms': self.histograms}
+            content = json.dumps(data)
+        tmpfile = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(tmpfile, 'w') as f:
+                f.write(content)
+            os.replace(tmpfile, self.path)
+        except OSError as e:
+            self.log.warning("Failed to write stats to %s: %s" % (self.path, str(e)))
+
+
+def setup(log, conf, name, cluster=''):
+    '''Create the process-wide aCTStats used by timer() and instrument()'''
+    global _stats
+    _stats = aCTStats(log, conf, name, cluster)
+    return _stats
+
+def activate(stats):
+    '''Make stats the instance used by timer() and instrument(), for processes hosting several agents'''
+    global _stats
+    _stats = stats
+
+def observe(metric, value, label=''):
+    '''Add value to the histogram of metric if setup() was called in this process'''
+    if _stats:
+        _stats.observe(metric, value, label)
+
+@contextlib.contextmanager
+def timer(service, call):
+    '''
+    Context manager recording the latency of a call to an external service,
+    e.g. with timer('panda', 'getJob'): ... Does nothing if setup() was not
+    called in this process.
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        if _stats:
+            _stats.observe('call_seconds', time.time() - start, '%s/%s' % (service, call))
+
+class instrument:
+    '''
+    Proxy timing all method calls on obj as calls to service, e.g.
+    job_supervisor = instrument(arc.JobSupervisor(uc, jobs), 'arc')
+    '''
+
+    def __init__(self, obj, service):
+        self._obj = obj
+        self._service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            with timer(self._service, name):
+                return attr(*args, **kwargs)
+        return timed
+
+def readAll(statsdir, maxage=600):
+    '''
+    Return the contents of all stats files in statsdir written in the last
+    maxage seconds
+    '''
+    stats = []
+    try:
+        files = os.listdir(statsdir)
+    except OSError:
+        return stats
+    for fname in files:
+        if not fname.endswith('.json'):
+            continue
+        path = os.path.join(statsdir, fname)
+        try:
+            if time.time() - os.stat(path).st_mtime > maxage:
+                continue
+            with open(path) as f:
+                stats.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return stats
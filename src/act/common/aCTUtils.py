@@ -1,5 +1,6 @@
 import time
 import os
+import zlib
 import arc
 
 def sleep(t):
@@ -15,20 +16,13 @@ def setFilePermissionsRecursive(path, dirmod=0o755, filemod=0o644):
     # set permissions for the path itself as well
     os.chmod(path, dirmod)
 
-def RunThreadsSplit(plist,nthreads=1):
-    it=0
-    while it < len(plist):
-        tl=[]
-        for i in range(0,nthreads):
-            try:
-                t=plist[it]
-                tl.append(t)
-                t.start()
-            except:
-                pass
-            it+=1
-        for t in tl:
-            t.join()
+def adler32(path, blocksize=1024*1024):
+    '''Return the adler32 checksum of the file at path as 8 hex digits'''
+    value = 1
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            value = zlib.adler32(block, value)
+    return '%08x' % (value & 0xffffffff)
 
 class DataPoint:
     '''
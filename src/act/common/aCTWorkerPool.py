@@ -0,0 +1,171 @@
+# aCTWorkerPool.py
+#
+# Bounded pool of worker threads with a timeout on each task
+#
+import concurrent.futures
+import queue
+import threading
+import time
+
+from act.common import aCTStats
+
+class aCTWorkerPool(concurrent.futures.Executor):
+    '''
+    Fixed number of long-lived worker threads executing submitted tasks,
+    usable anywhere a concurrent.futures.Executor is expected. Tasks still
+    waiting in the queue can be cancelled through their Future.
+
+    Each task has a timeout, after which its Future fails with
+    concurrent.futures.TimeoutError so that callers waiting for it carry on.
+    A Python thread cannot be killed, so the worker running a timed out task
+    is abandoned: it exits when the call eventually returns, and a new
+    worker is started in its place to keep the pool at full size.
+
+      pool = aCTWorkerPool(log, 10, timeout=60)
+      futures = dict((pool.submit(fetch, job), job) for job in jobs)
+      for f in concurrent.futures.as_completed(futures): ...
+    '''
+
+    def __init__(self, log, nworkers, timeout=None, name='aCTWorker'):
+        self.log = log
+        self.nworkers = max(int(nworkers), 1)
+        # default timeout in seconds for tasks, None for no timeout
+        self.timeout = timeout
+        self.name = name
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        # worker threads which are not abandoned
+        self.workers = set()
+        # thread: (future, deadline, task name) for tasks in progress
+        self.running = {}
+        self.counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'timedout': 0, 'cancelled': 0}
+        self.shutdownflag = False
+        with self.lock:
+            for i in range(self.nworkers):
+                self._startWorker()
+        self.watchdog = threading.Thread(target=self._watch, name='%s-watchdog' % name, daemon=True)
+        self.watchdog.start()
+
+    def _startWorker(self):
+        # must be called with lock held
+        t = threading.Thread(target=self._work, name='%s-%d' % (self.name, len(self.workers)), daemon=True)
+        self.workers.add(t)
+        t.start()
+
+    def submit(self, fn, *args, **kwargs):
+        '''Schedule fn(*args, **kwargs) with the default timeout of the pool'''
+        return self.submitTimeout(self.timeout, fn, *args, **kwargs)
+
+    def submitTimeout(self, timeout, fn, *args, **kwargs):
+        '''Schedule fn(*args, **kwargs), failing it after timeout seconds'''
+        if self.shutdownflag:
+            raise RuntimeError('cannot schedule new tasks after shutdown')
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.counters['submitted'] += 1
+        aCTStats.observe('pool_queue_depth', self.tasks.qsize(), self.name)
+        self.tasks.put((future, fn, args, kwargs, timeout, time.time()))
+        return future
+
+    def mapChunks(self, fn, items, chunksize, timeout=None):
+        '''
+        Schedule fn(chunk) for consecutive chunks of at most chunksize items
+        and yield (chunk, future) as each completes, including failed and
+        timed out ones. timeout overrides the default timeout of the pool.
+        '''
+        chunksize = max(int(chunksize), 1)
+        timeout = timeout or self.timeout
+        futures = dict((self.submitTimeout(timeout, fn, items[i:i+chunksize]), items[i:i+chunksize])
+                       for i in range(0, len(items), chunksize))
+        for future in concurrent.futures.as_completed(futures):
+            yield (futures[future], future)
+
+    def _taskName(self, fn):
+        # unwrap functools.partial used by asyncio run_in_executor callers
+        fn = getattr(fn, 'func', fn)
+        return getattr(fn, '__qualname__', str(fn))
+
+    def _work(self):
+        me = threading.current_thread()
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                return
+            future, fn, args, kwargs, timeout, queued = item
+            if not future.set_running_or_notify_cancel():
+                with self.lock:
+                    self.counters['cancelled'] += 1
+                continue
+            aCTStats.observe('pool_wait_seconds', time.time() - queued, self.name)
+            deadline = time.time() + timeout if timeout else None
+            with self.lock:
+                self.running[me] = (future, deadline, self._taskName(fn))
+            result = exception = None
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                exception = e
+            with self.lock:
+                # if the watchdog removed this task it has already failed it
+                owner = self.running.pop(me, None) is not None
+                abandoned = me not in self.workers
+                if owner:
+                    self.counters['failed' if exception else 'completed'] += 1
+            if owner:
+                if exception:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+            if abandoned:
+                return
+
+    def _watch(self):
+        '''Fail tasks running past their deadline and replace their workers'''
+        while not self.shutdownflag:
+            time.sleep(1)
+            now = time.time()
+            expired = []
+            with self.lock:
+                for thread, (future, deadline, name) in list(self.running.items()):
+                    if deadline and now > deadline:
+                        del self.running[thread]
+                        self.workers.discard(thread)
+                        self.counters['timedout'] += 1
+                        expired.append((future, name))
+                        self._startWorker()
+            for future, name in expired:
+                self.log.warning('%s: task %s timed out' % (self.name, name))
+                future.set_exception(concurrent.futures.TimeoutError('%s timed out' % name))
+
+    def getStats(self):
+        '''Return counters of tasks since start, plus queued and busy tasks'''
+        with self.lock:
+            stats = self.counters.copy()
+            stats['busy'] = len(self.running)
+        stats['queued'] = self.tasks.qsize()
+        return stats
+
+    def cancelPending(self):
+        '''Cancel all tasks which have not started yet'''
+        while True:
+            try:
+                item = self.tasks.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                continue
+            if item[0].cancel():
+                with self.lock:
+                    self.counters['cancelled'] += 1
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shutdownflag = True
+        if cancel_futures:
+            self.cancelPending()
+        with self.lock:
+            workers = list(self.workers)
+        for t in workers:
+            self.tasks.put(None)
+        if wait:
+            for t in workers:
+                t.join()
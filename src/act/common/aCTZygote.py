@@ -0,0 +1,269 @@
+# aCTZygote.py
+#
+# Fork server which starts aCT agents from an interpreter which has already
+# imported act, arc and the DB drivers
+#
+import errno
+import importlib
+import json
+import os
+import random
+import runpy
+import select
+import subprocess
+import sys
+import time
+import traceback
+
+from act.common import aCTLogger
+from act.common import aCTSignal
+
+# Modules imported by the zygote in addition to the agent modules it is given
+preload = ['arc', 'act.common.aCTProcess', 'act.arc.aCTJobCodec']
+
+
+class aCTZygote:
+    '''
+    Process forking aCT agents on request of aCTProcessManager, so that an
+    agent starts without paying for the interpreter start and imports.
+
+    Requests and replies are JSON lines on stdin and stdout:
+      {"script": path, "args": [...], "log": logfile} -> {"started": pid}
+                                                      or {"error": message}
+      and {"exited": pid, "rc": returncode} when an agent exits, with the
+      same convention as Popen.returncode.
+    The zygote exits when stdin is closed or on SIGTERM. Its own log and
+    anything written to stdout or stderr go to the zygote log.
+
+    The zygote must not open DB connections or start threads, since forked
+    agents would share them.
+    '''
+
+    def __init__(self, modules):
+        self.logger = aCTLogger.aCTLogger('aCTZygote', arclog=False)
+        self.log = self.logger()
+        # keep the protocol pipes away from stdin and stdout so that nothing
+        # printed by imported modules ends up in the replies
+        self.infd = os.dup(0)
+        self.outfd = os.dup(1)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        os.dup2(2, 1)
+        self.children = set()
+
+        start = time.time()
+        for module in preload + modules:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                self.log.warning("Failed to preload %s: %s", module, str(e))
+        try:
+            from act.arc import aCTJobCodec
+            aCTJobCodec.codec()
+        except Exception as e:
+            self.log.warning("Failed to set up job codec: %s", str(e))
+        self.log.info("Started with %d modules preloaded in %.2fs", len(sys.modules), time.time() - start)
+
+    def reply(self, msg):
+        os.write(self.outfd, (json.dumps(msg) + '\n').encode())
+
+    def reap(self):
+        '''Report agents which exited'''
+        for pid in list(self.children):
+            try:
+                wpid, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                wpid, status = pid, 255 << 8
+            if not wpid:
+                continue
+            self.children.discard(pid)
+            rc = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            self.log.info("Agent pid %d exited with %d", pid, rc)
+            self.reply({'exited': pid, 'rc': rc})
+
+    def spawn(self, script, args, logfile):
+        '''Fork an agent running script as __main__ with args, return its pid'''
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+
+        # child
+        rc = 1
+        try:
+            os.close(self.infd)
+            os.close(self.outfd)
+            fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+            sys.argv = [script] + args
+            # agents use random for loop timings
+            random.seed()
+            runpy.run_path(script, run_name='__main__')
+            rc = 0
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(rc)
+
+    def handle(self, request):
+        try:
+            pid = self.spawn(request['script'], request['args'], request['log'])
+        except Exception as e:
+            self.log.error("Failed to start %s: %s", request.get('script'), str(e))
+            self.reply({'error': str(e)})
+            return
+        self.log.info("Started %s %s with pid %d", request['script'], ' '.join(request['args']), pid)
+        self.reply({'started': pid})
+
+    def run(self):
+        '''
+        Main loop
+        '''
+        buf = b''
+        try:
+            while 1:
+                ready = select.select([self.infd], [], [], 1)[0]
+                self.reap()
+                if not ready:
+                    continue
+                data = os.read(self.infd, 65536)
+                if not data:
+                    self.log.info("Process manager closed the connection, exiting")
+                    return
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    self.handle(json.loads(line))
+        except aCTSignal.ExceptInterrupt as x:
+            self.log.info("Received interrupt %s, exiting", str(x))
+        except:
+            self.log.critical("*** Unexpected exception! ***")
+            self.log.critical(traceback.format_exc())
+            self.log.critical("*** Process exiting ***")
+
+
+class aCTZygoteClient:
+    '''
+    Process manager side of aCTZygote. The zygote is started on first use and
+    again if it died. spawn() returns None if the zygote cannot start an
+    agent, in which case the caller should start it some other way.
+    '''
+
+    def __init__(self, log, script, logfile, modules, timeout=60):
+        self.log = log
+        self.script = script
+        self.fdout = logfile
+        self.modules = modules
+        # seconds to wait for the zygote to start an agent, including
+        # the preloading of modules for the first one
+        self.timeout = timeout
+        self.proc = None
+        self.buf = b''
+        # pid: returncode of agents which exited
+        self.exited = {}
+        # pids of agents started by the current zygote
+        self.children = set()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _start(self):
+        self.log.info("Starting zygote %s", self.script)
+        self.proc = subprocess.Popen(['/usr/bin/env', 'python3', self.script] + self.modules,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.fdout)
+        self.buf = b''
+        self.children = set()
+
+    def _read(self, timeout=0):
+        '''Read available messages, waiting up to timeout for the first one'''
+        msgs = []
+        fd = self.proc.stdout.fileno()
+        while select.select([fd], [], [], timeout)[0]:
+            timeout = 0
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            self.buf += data
+            while b'\n' in self.buf:
+                line, self.buf = self.buf.split(b'\n', 1)
+                msg = json.loads(line)
+                if 'exited' in msg:
+                    self.exited[msg['exited']] = msg['rc']
+                    self.children.discard(msg['exited'])
+                else:
+                    msgs.append(msg)
+        return msgs
+
+    def stop(self):
+        if self.alive():
+            self.proc.terminate()
+
+    def spawn(self, script, args, logfile):
+        '''Ask the zygote to start script with args, return the pid or None'''
+        try:
+            if not self.alive():
+                self._start()
+            self.proc.stdin.write((json.dumps({'script': script, 'args': args, 'log': logfile}) + '\n').encode())
+            self.proc.stdin.flush()
+            deadline = time.time() + self.timeout
+            while time.time() < deadline:
+                for msg in self._read(max(deadline - time.time(), 0)):
+                    if 'started' in msg:
+                        self.children.add(msg['started'])
+                        return msg['started']
+                    self.log.warning("Zygote failed to start %s: %s", script, msg.get('error'))
+                    return None
+                if not self.alive():
+                    break
+        except (OSError, ValueError) as e:
+            self.log.warning("Failed to talk to zygote: %s", str(e))
+        # replies would now be out of order, start a new zygote next time
+        self.log.warning("Zygote did not start %s, stopping it", script)
+        if self.alive():
+            self.proc.kill()
+            self.proc.wait()
+        return None
+
+    def poll(self, pid):
+        '''Return the returncode of agent pid, or None if it is running'''
+        if self.proc is not None:
+            try:
+                self._read()
+            except (OSError, ValueError):
+                pass
+        if pid in self.exited:
+            return self.exited.pop(pid)
+        if pid in self.children and self.alive():
+            return None
+        # the zygote which started it is gone so its exit is not reported
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return -1
+        # orphaned zombie which init has not reaped yet
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                if f.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                    return -1
+        except (OSError, IndexError):
+            pass
+        return None
+
+
+if __name__ == '__main__':
+    zygote = aCTZygote(sys.argv[1:])
+    zygote.run()
+    # agents keep running, as they would without a zygote
+    os._exit(0)
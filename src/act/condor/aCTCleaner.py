@@ -7,6 +7,8 @@ from act.common.aCTProcess import aCTProcess
 
 class aCTCleaner(aCTProcess):
 
+    notifystates = {'condorjobs': ('toclean',)}
+
     def processToClean(self):
 
         select = "condorstate='toclean' and cluster='%s' limit 100" % self.cluster
@@ -1,8 +1,18 @@
 import json
 from act.db.aCTDB import aCTDB
+from act.db.aCTDBQuery import aCTDBQuery
 
 class aCTDBCondor(aCTDB):
 
+    indexes = {'condorjobs': {
+                   # status, fetcher, cleaner: jobs of a cluster in a state not checked recently
+                   'condorstate_cluster_tcondorstate': ('condorstate', 'cluster', 'tcondorstate'),
+                   # submitter limits: queued and running jobs per cluster and share
+                   'cluster_condorstate_fairshare': ('cluster', 'condorstate', 'fairshare')}}
+
+    columns = {'condorjobs': {'claimedby': 'VARCHAR(255)',
+                              'claimexpiry': 'DATETIME NULL'}}
+
     def __init__(self, log):
         aCTDB.__init__(self, log, 'condorjobs')
 
@@ -33,6 +43,8 @@ class aCTDBCondor(aCTDB):
           - priority: ARC job priority, extracted from the job description
           - fairshare: A string representing a share. Job submission for the same
             cluster will be spread evenly over shares.
+          - claimedby: submitter which claimed the job for submission
+          - claimexpiry: time after which the claim can be taken back
         ClassAd fields:
           - ClusterID
           - GlobalJodId
@@ -63,6 +75,8 @@ class aCTDBCondor(aCTDB):
             appjobid VARCHAR(255),
             priority SMALLINT,
             fairshare VARCHAR(255),
+            claimedby VARCHAR(255),
+            claimexpiry DATETIME NULL,
             ClusterId BIGINT,
             GlobalJobId VARCHAR(255),
             GridJobId VARCHAR(255),
@@ -93,6 +107,8 @@ class aCTDBCondor(aCTDB):
         except Exception as x:
             self.log.error("failed create table %s" %x)
             return False
+        if not self.createIndexes() or not self.recordSchema():
+            return False
 
         return True
 
@@ -138,6 +154,8 @@ class aCTDBCondor(aCTDB):
         c.execute(s,list(desc.values()))
         c.execute("SELECT LAST_INSERT_ID()")
         row = c.fetchone()
+        # new job may go to any cluster in clusterlist
+        self.notify(state=desc['condorstate'])
         self.Commit()
         return row
 
@@ -167,16 +185,18 @@ class aCTDBCondor(aCTDB):
         executing update.
         '''
         c = self.db.getCursor()
-        c.execute("select id from condorjobs where id=%d limit 1" % id)
+        c.execute("select id, cluster from condorjobs where id=%d limit 1" % id)
         row = c.fetchone()
         if row is None:
             self.log.warning("Condor job id %d no longer exists" % id)
             return
+        if 'condorstate' in desc:
+            self.notify(desc['cluster'] if 'cluster' in desc else row['cluster'], desc['condorstate'])
 
         desc['modified'] = self.getTimeStamp()
         s = "update condorjobs set " + ",".join(['%s=%%s' % (k) for k in desc.keys()])
-        s += " where id="+str(id)
-        c.execute(s, list(desc.values()))
+        s += " where id=%s"
+        self.db.executePrepared(s, list(desc.values()) + [id])
 
     def updateCondorJobs(self, desc, select):
         '''
@@ -192,10 +212,13 @@ class aCTDBCondor(aCTDB):
         statement. Does not commit after executing update.
         '''
         desc['modified'] = self.getTimeStamp()
+        where, params = self._where(select)
         s = "update condorjobs set " + ",".join(['%s=%%s' % (k) for k in desc.keys()])
-        s += " where "+select
+        s += " where "+where
+        if 'condorstate' in desc:
+            self.notify(state=desc['condorstate'])
         c = self.db.getCursor()
-        c.execute(s, list(desc.values()))
+        c.execute(s, list(desc.values()) + (params or []))
 
     def getCondorJobInfo(self, id, columns=[]):
         '''
@@ -223,10 +246,35 @@ class aCTDBCondor(aCTDB):
             if not res:
                 self.log.debug("Could not get lock: %s"%str(res))
                 return []
-        c.execute("SELECT "+self._column_list2str(columns)+" FROM "+tables+" WHERE "+select)
+        where, params = self._where(select)
+        c.execute("SELECT "+self._column_list2str(columns)+" FROM "+tables+" WHERE "+where, params)
         rows=c.fetchall()
         return rows
 
+    def claimCondorJobs(self, select, columns, cluster, owner, lease):
+        '''
+        Claim jobs matching select for submission to cluster by owner, setting
+        them to submitting, and return a list of column: value dictionaries.
+        Jobs being claimed by other submitters are skipped. The claim expires
+        after lease seconds, see reclaimCondorJobs().
+        '''
+        desc = {'condorstate': 'submitting', 'cluster': cluster, 'tcondorstate': self.getTimeStamp()}
+        return self._claim(select, ['id'] + [c for c in columns if c != 'id'], desc, owner, lease)
+
+    def reclaimCondorJobs(self, cluster, owner, lease):
+        '''
+        Set jobs left in submitting for cluster to toresubmit if owner claimed
+        them, i.e. their submission failed, or if their claim expired since
+        the submitter which claimed them died. They may have been submitted
+        so the application decides what to do.
+        '''
+        select = aCTDBQuery().eq('condorstate', 'submitting').eq('cluster', cluster) \
+                             .raw(*self._claimedClause(owner, lease, 'tcondorstate'))
+        desc = {"condorstate": "toresubmit", "tcondorstate": self.getTimeStamp()}
+        if self.leases:
+            desc.update({"claimedby": None, "claimexpiry": None})
+        self.updateCondorJobs(desc, select)
+
     def getCondorJobDescription(self, jobdescid):
         '''
         Return the job description for the given id in jobdescriptions
@@ -10,6 +10,8 @@ class aCTFetcher(aCTProcess):
     Moves finished/failed jobs to the next state
     '''
 
+    notifystates = {'condorjobs': ('tofetch', 'finished')}
+
     def fetchJobs(self, condorstate, nextcondorstate):
 
         # Get list of jobs in the right state
@@ -7,6 +7,7 @@ import htcondor
 import classad
 
 from act.common.aCTProcess import aCTProcess
+from act.common import aCTStats
 
 class aCTStatus(aCTProcess):
     '''
@@ -14,6 +15,8 @@ class aCTStatus(aCTProcess):
     status in the DB.
     '''
 
+    notifystates = {'condorjobs': ('cancelling',)}
+
     def __init__(self):
 
         aCTProcess.__init__(self)
@@ -61,22 +64,23 @@ class aCTStatus(aCTProcess):
         # Here with attributes we want to query but not store
         qattrs = attrs + ['ClusterId', 'GridResourceUnavailableTime']
         t1 = time.time()
-        try:
-            status = self.schedd.xquery(requirements='ACTCluster=?="%s"' % self.cluster,
-                                        projection=qattrs)
-        except IOError as e:
-            self.log.error('Failed querying schedd: %s' % str(e))
-            return
-        condorstatuses = {}
-        while True:
+        with aCTStats.timer('condor', 'xquery'):
             try:
-                stat = next(status)
-                condorstatuses[stat['ClusterId']] = stat
-            except StopIteration:
-                break
-            except RuntimeError as e: # Usually a timeout connecting to remote host, try again
-                self.log.error('Problem querying schedd: %s' % str(e))
-                break
+                status = self.schedd.xquery(requirements='ACTCluster=?="%s"' % self.cluster,
+                                            projection=qattrs)
+            except IOError as e:
+                self.log.error('Failed querying schedd: %s' % str(e))
+                return
+            condorstatuses = {}
+            while True:
+                try:
+                    stat = next(status)
+                    condorstatuses[stat['ClusterId']] = stat
+                except StopIteration:
+                    break
+                except RuntimeError as e: # Usually a timeout connecting to remote host, try again
+                    self.log.error('Problem querying schedd: %s' % str(e))
+                    break
         t2 = time.time()
         self.log.debug('took %f to query schedd (returning %d results)' % ((t2-t1), len(condorstatuses)))
         # Loop over jobs
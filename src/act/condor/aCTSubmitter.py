@@ -1,24 +1,14 @@
 import ast
+import os
 import re
+import socket
 import time
 import htcondor
 
-from threading import Thread
+import concurrent.futures
 from act.common.aCTProcess import aCTProcess
-
-class SubmitThr(Thread):
-    def __init__ (self, func, id, appjobid, jobdesc, logger, schedd):
-        Thread.__init__(self)
-        self.func = func
-        self.id = id
-        self.appjobid = appjobid
-        self.jobdesc = jobdesc
-        self.log = logger
-        self.schedd = schedd
-        self.jobid = None
-    def run(self):
-        self.jobid = self.func(self.jobdesc, self.log, self.appjobid, self.schedd)
-
+from act.common import aCTStats
+from act.common.aCTWorkerPool import aCTWorkerPool
 
 def Submit(jobdesc, log, appjobid, schedd):
 
@@ -38,46 +28,48 @@ def Submit(jobdesc, log, appjobid, schedd):
 
 class aCTSubmitter(aCTProcess):
 
+    notifystates = {'condorjobs': ('tosubmit', 'tocancel', 'toresubmit')}
+
     def __init__(self):
         aCTProcess.__init__(self)
-        self.schedd = htcondor.Schedd()
-
-    def RunThreadsSplit(self, plist, nthreads=1):
-        it = 0
-        while it < len(plist):
-            tl = []
-            for i in range(0, nthreads):
-                try:
-                    t = plist[it]
-                    tl.append(t)
-                    t.start()
-                except:
-                    pass
-                it += 1
-            errfl = False
-            for t in tl:
-                t.join(60.0)
-                if t.isAlive() :
-                    # abort due to timeout and try again
-                    self.log.error("%s: submission timeout: exit and try again" % t.appjobid)
-                    errfl = True
-                    continue
-                # updatedb
-                if t.jobid is None:
-                    self.log.error("%s: no job defined for %d" % (t.appjobid, t.id))
-                    errfl = True
-                    continue
-                jd = {}
-                jd['condorstate'] = 'submitted'
-                # initial offset to 1 minute to force first status check
-                jd['tcondorstate'] = self.dbcondor.getTimeStamp(time.time() - int(self.conf.get(['jobs', 'checkinterval'])) + 120)
-                jd['cluster'] = self.cluster
-                jd['ClusterId'] = t.jobid
-                self.log.info("%s: Job submitted with ClusterId %d" % (t.appjobid, t.jobid))
-                self.dbcondor.updateCondorJobLazy(t.id, jd)
-            if errfl:
-                break
-
+        self.schedd = aCTStats.instrument(htcondor.Schedd(), 'condor')
+        # Submissions hanging for more than 60 seconds are abandoned
+        self.pool = aCTWorkerPool(self.log, 1, timeout=60, name='submitter')
+        # Jobs are claimed for submission under this name, for jobs/submitlease
+        # seconds after which other submitters may take them back
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease = int(self.conf.get(['jobs', 'submitlease']) or 3600)
+
+    def close(self):
+        # jobs claimed but not submitted are resubmitted
+        try:
+            self.reclaimJobs()
+        except Exception as e:
+            self.log.warning("Failed to release claimed jobs: %s" % str(e))
+        aCTProcess.close(self)
+
+    def submitted(self, id, appjobid, future):
+        '''Wait for a submission and record the result in the DB'''
+        try:
+            jobid = future.result()
+        except concurrent.futures.TimeoutError:
+            # abort due to timeout and try again
+            self.log.error("%s: submission timeout: exit and try again" % appjobid)
+            return
+        except Exception as e:
+            self.log.error("%s: submission failed: %s" % (appjobid, str(e)))
+            return
+        if jobid is None:
+            self.log.error("%s: no job defined for %d" % (appjobid, id))
+            return
+        jd = {}
+        jd['condorstate'] = 'submitted'
+        # initial offset to 1 minute to force first status check
+        jd['tcondorstate'] = self.dbcondor.getTimeStamp(time.time() - int(self.conf.get(['jobs', 'checkinterval'])) + 120)
+        jd['cluster'] = self.cluster
+        jd['ClusterId'] = jobid
+        self.log.info("%s: Job submitted with ClusterId %d" % (appjobid, jobid))
+        self.dbcondor.updateCondorJobLazy(id, jd)
 
     def submit(self):
         """
@@ -107,28 +99,10 @@ class aCTSubmitter(aCTProcess):
 
         for fairshare in fairshares:
 
-            try:
-                # catch any exceptions here to avoid leaving lock
-                # Lock row for update in case multiple clusters are specified
-                jobs = self.dbcondor.getCondorJobsInfo("condorstate='tosubmit' and ( clusterlist like '% {0}%' or clusterlist like '%{0},%' ) and fairshare='{1}' limit 10".format(self.cluster, fairshare),
-                                            columns=["id", "jobdesc", "appjobid", "priority", "proxyid", "clusterlist"], lock=True)
-                if jobs:
-                    self.log.debug("started lock for writing %d jobs" % len(jobs))
-
-                # mark submitting in db
-                jobs_taken = []
-                for j in jobs:
-                    jd = {'cluster': self.cluster, 'condorstate': 'submitting', 'tcondorstate': self.dbcondor.getTimeStamp()}
-                    self.dbcondor.updateCondorJobLazy(j['id'], jd)
-                    jobs_taken.append(j)
-                jobs = jobs_taken
-
-            finally:
-                try:
-                    self.dbcondor.Commit(lock=True)
-                    self.log.debug("ended lock")
-                except:
-                    self.log.warning("Failed to release DB lock")
+            # mark submitting in db, skipping jobs other submitters are claiming
+            jobs = self.dbcondor.claimCondorJobs("condorstate='tosubmit' and ( clusterlist like '% {0}%' or clusterlist like '%{0},%' ) and fairshare='{1}' limit 10".format(self.cluster, fairshare),
+                                                 ["id", "jobdesc", "appjobid", "priority", "proxyid", "clusterlist"],
+                                                 self.cluster, self.owner, self.lease)
 
             if len(jobs) == 0:
                 #self.log.debug("No jobs to submit")
@@ -205,8 +179,8 @@ class aCTSubmitter(aCTProcess):
                 jobdesc['+ACTCluster'] = '"%s"' % self.cluster
                 self.log.debug('%s: Set GridResource to %s, queue %s' % (j['appjobid'], gridresource, queue))
                 self.log.debug(jobdesc)
-                t = SubmitThr(Submit, j['id'], j['appjobid'], jobdesc, self.log, self.schedd)
-                self.RunThreadsSplit([t], 1)
+                future = self.pool.submit(Submit, jobdesc, self.log, j['appjobid'], self.schedd)
+                self.submitted(j['id'], j['appjobid'], future)
                 count += 1
 
             self.log.info("threads finished")
@@ -218,15 +192,13 @@ class aCTSubmitter(aCTProcess):
         return count
 
 
-    def checkFailedSubmissions(self):
-
-        jobs = self.dbcondor.getCondorJobsInfo("condorstate='submitting' and cluster='"+self.cluster+"'",
-                                               ["id"])
-
-        for job in jobs:
-            # set to toresubmit and the application should figure out what to do
-            self.dbcondor.updateCondorJob(job['id'], {"condorstate": "toresubmit",
-                                                      "tcondorstate": self.dbcondor.getTimeStamp()})
+    def reclaimJobs(self):
+        '''
+        Set to toresubmit jobs this submitter failed to submit and jobs whose
+        claim expired since their submitter died, the application should
+        figure out what to do
+        '''
+        self.dbcondor.reclaimCondorJobs(self.cluster, self.owner, self.lease)
 
     def processToCancel(self):
 
@@ -281,7 +253,7 @@ class aCTSubmitter(aCTProcess):
     def process(self):
 
         # check jobs which failed to submit the previous loop
-        self.checkFailedSubmissions()
+        self.reclaimJobs()
         # process jobs which have to be cancelled
         self.processToCancel()
         # process jobs which have to be resubmitted
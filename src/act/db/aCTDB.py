@@ -1,15 +1,48 @@
 import datetime
+import time
 from act.db import aCTDBMS
+from act.db.aCTDBQuery import aCTDBQuery
 from act.common.aCTConfig import aCTConfigARC
+from act.common.aCTNotify import aCTNotify
+
+# Optional schema features recorded by recordSchema(), read once per process
+# by getSchema()
+schema = None
 
 class aCTDB(object):
     '''Superclass representing a general table in the DB'''
 
+    # Secondary indexes matching the queries made by the agents, as
+    # {table: {index name: (columns, ...)}}. Created by createTables() and by
+    # actdbmigrate on existing DBs.
+    indexes = {}
+
+    # Columns added to tables after their first release, as
+    # {table: {column: type}}. Part of the CREATE TABLE statements and added
+    # by actdbmigrate on existing DBs.
+    columns = {}
+
+    # Summary tables of row counts per combination of key columns, as
+    # {table: (count table, {key column: type})}. Kept up to date by triggers
+    # in the transactions changing the rows, so counts are read without
+    # scanning the table. Created by createCounts().
+    counts = {}
+
     def __init__(self, logger, tablename):
         self.log = logger
         self.table = tablename
         self.conf = aCTConfigARC()
         self.db = aCTDBMS.getDB(self.log, self.conf)
+        # notifications of state changes to send after next commit
+        self.notifier = aCTNotify(self.log, self.conf)
+        self.pendingnotify = set()
+        features = self.getSchema()
+        # rows can be claimed with owner and expiry, see _claim()
+        self.leases = {tablename+'.claimedby', tablename+'.claimexpiry'} <= features
+        # time of next status check is stored per row
+        self.scheduled = tablename+'.nextcheck' in features
+        # counts are read from the count table, see getCounts()
+        self.counted = tablename+'.counts' in features
 
     def _column_list2str(self,columns):
         s=""
@@ -21,6 +54,310 @@ class aCTDB(object):
             s="*"
         return s
 
+    def _where(self, select):
+        '''
+        Return (sql, params) for select, which is either a string with the
+        WHERE clause or an aCTDBQuery. params is None for strings so that
+        they are sent unmodified.
+        '''
+        if isinstance(select, aCTDBQuery):
+            return (select.sql(), select.values())
+        return (select, None)
+
+    def _pageQuery(self, select, key, last, batch):
+        '''
+        Return an aCTDBQuery for the page of at most batch rows of select
+        following the row with key value last, ordered by key
+        '''
+        if isinstance(select, aCTDBQuery):
+            if select.orderby or select.nlimit is not None:
+                raise ValueError('Selection to page through cannot have ORDER BY or LIMIT')
+            q = select.copy()
+        else:
+            # plain strings are sent unmodified by _where so escape %
+            q = aCTDBQuery().raw('(%s)' % select.replace('%', '%%'))
+        if last is not None:
+            q.raw('%s>%%s' % key, last)
+        return q.order(key).limit(batch)
+
+    def _iterPages(self, fetch, select, key, batch, lastkey):
+        '''
+        Generator of the results of fetch(query) for successive pages of
+        select, using the value of key, a unique column, in the last row of
+        a page as the start of the next one. lastkey(result) returns the
+        number of rows in a result and the key of its last row. Rows changed
+        by the caller between pages are neither skipped nor returned twice.
+        '''
+        last = None
+        while True:
+            result = fetch(self._pageQuery(select, key, last, batch))
+            nrows, last = lastkey(result)
+            if not nrows:
+                return
+            yield result
+            if nrows < batch:
+                return
+
+    def getSchema(self):
+        '''
+        Return the set of optional schema features recorded by bootstrap and
+        actdbmigrate, such as "arcjobs.nextcheck", read once per process.
+        Empty if none were recorded, in which case only the base schema is
+        used.
+        '''
+        global schema
+        if schema is None:
+            try:
+                c = self.db.getCursor()
+                c.execute("SELECT feature FROM actschema")
+                schema = set(row['feature'] for row in c.fetchall())
+            except Exception as e:
+                self.log.info("No schema features recorded, run actdbmigrate to use them: %s" % str(e))
+                schema = set()
+        return schema
+
+    def detectSchema(self):
+        '''
+        Return the optional schema features of this table present in the DB:
+        "<table>.<column>" for columns of self.columns and "<table>.counts"
+        for the count table
+        '''
+        missing = set((table, name) for table, name, ctype in self.getMissingColumns())
+        tables = [table for table in self.columns if self.tableExists(table)]
+        features = set('%s.%s' % (table, name) for table in tables for name in self.columns[table]
+                       if (table, name) not in missing)
+        if self.table in self.counts and self.tableExists(self.counts[self.table][0]):
+            features.add('%s.counts' % self.table)
+        return features
+
+    def recordSchema(self):
+        '''
+        Record the features of this table found by detectSchema() in the
+        actschema table, so that processes read them with getSchema() instead
+        of inspecting the schema. Called after creating or migrating tables.
+        '''
+        global schema
+        features = self.detectSchema()
+        c = self.db.getCursor()
+        try:
+            c.execute("CREATE TABLE IF NOT EXISTS actschema (feature VARCHAR(255) PRIMARY KEY)")
+            c.execute("DELETE FROM actschema WHERE feature LIKE %s", [self.table + '.%'])
+            if features:
+                c.executemany("INSERT INTO actschema (feature) VALUES (%s)", [(f,) for f in sorted(features)])
+            self.Commit()
+        except Exception as x:
+            self.log.error("failed to record schema of %s: %s" % (self.table, x))
+            return False
+        schema = set(f for f in (schema or set()) if not f.startswith(self.table + '.')) | features
+        return True
+
+    def tableExists(self, table):
+        c = self.db.getCursor()
+        c.execute("show tables like '%s'" % table, readonly=True)
+        return c.fetchone() is not None
+
+    def getTriggers(self):
+        '''Return the names of the triggers on this table'''
+        c = self.db.getCursor()
+        c.execute("SHOW TRIGGERS LIKE '%s'" % self.table, readonly=True)
+        return set(row['Trigger'] for row in c.fetchall())
+
+    def getMissingIndexes(self):
+        '''
+        Return a list of (table, name, columns) for indexes in self.indexes
+        which do not exist in the DB
+        '''
+        missing = []
+        c = self.db.getCursor()
+        for table, indexes in self.indexes.items():
+            if not self.tableExists(table):
+                continue
+            c.execute("SHOW INDEX FROM %s" % table, readonly=True)
+            existing = set(row['Key_name'] for row in c.fetchall())
+            missing.extend([(table, name, columns) for name, columns in indexes.items() if name not in existing])
+        return missing
+
+    def getMissingColumns(self):
+        '''
+        Return a list of (table, column, type) for columns in self.columns
+        which do not exist in the DB
+        '''
+        missing = []
+        c = self.db.getCursor()
+        for table, columns in self.columns.items():
+            if not self.tableExists(table):
+                continue
+            c.execute("SHOW COLUMNS FROM %s" % table, readonly=True)
+            existing = set(row['Field'] for row in c.fetchall())
+            missing.extend([(table, name, ctype) for name, ctype in columns.items() if name not in existing])
+        return missing
+
+    def createColumns(self):
+        '''
+        Add the columns in self.columns which do not exist yet. Returns
+        False if any failed.
+        '''
+        ok = True
+        c = self.db.getCursor()
+        for table, name, ctype in self.getMissingColumns():
+            self.log.info("adding column %s %s to %s" % (name, ctype, table))
+            try:
+                c.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, ctype))
+            except Exception as x:
+                self.log.error("failed to add column %s: %s" % (name, x))
+                ok = False
+        self.Commit()
+        return ok
+
+    def createIndexes(self):
+        '''
+        Create the indexes in self.indexes which do not exist yet. Returns
+        False if any failed.
+        '''
+        ok = True
+        c = self.db.getCursor()
+        for table, name, columns in self.getMissingIndexes():
+            self.log.info("creating index %s on %s (%s)" % (name, table, ", ".join(columns)))
+            try:
+                c.execute("CREATE INDEX %s ON %s (%s)" % (name, table, ", ".join(columns)))
+            except Exception as x:
+                self.log.error("failed to create index %s: %s" % (name, x))
+                ok = False
+        self.Commit()
+        return ok
+
+    def _countTriggers(self):
+        '''
+        Return {trigger name: definition} maintaining the count table. Every
+        change of a key updates one row of the count table, so concurrent
+        writers contend on the rows of busy keys until they commit. Deadlocks
+        and lock wait timeouts are retried by aCTDBMySQL and counted in the
+        loop_db_lockwaits statistics of the agents.
+        '''
+        counttable, keys = self.counts[self.table]
+        cols = ", ".join(keys)
+        def change(row, delta):
+            values = ", ".join(["IFNULL(%s.%s, '')" % (row, k) for k in keys])
+            return "INSERT INTO %s (%s, n) VALUES (%s, %d) ON DUPLICATE KEY UPDATE n=n+(%d)" % (counttable, cols, values, delta, delta)
+        same = " AND ".join(["OLD.%s <=> NEW.%s" % (k, k) for k in keys])
+        return {'%s_count_insert' % self.table: "AFTER INSERT ON %s FOR EACH ROW %s" % (self.table, change('NEW', 1)),
+                '%s_count_delete' % self.table: "AFTER DELETE ON %s FOR EACH ROW %s" % (self.table, change('OLD', -1)),
+                '%s_count_update' % self.table: "AFTER UPDATE ON %s FOR EACH ROW BEGIN IF NOT (%s) THEN %s; %s; END IF; END" \
+                                                % (self.table, same, change('OLD', -1), change('NEW', 1))}
+
+    def createCounts(self):
+        '''
+        Create the count table of this table with its triggers and fill it.
+        Returns False on failure, in which case counts are made by scanning
+        the table. Creating triggers needs the TRIGGER privilege, and SUPER
+        or log_bin_trust_function_creators if binary logging is on.
+        '''
+        if self.table not in self.counts:
+            return True
+        counttable, keys = self.counts[self.table]
+        self.log.info("creating %s table" % counttable)
+        create = "CREATE TABLE IF NOT EXISTS %s (%s, n INTEGER NOT NULL, PRIMARY KEY (%s))" \
+                 % (counttable, ", ".join(["%s %s NOT NULL" % (k, t) for k, t in keys.items()]), ", ".join(keys))
+        c = self.db.getCursor()
+        try:
+            c.execute(create)
+            for name, trigger in self._countTriggers().items():
+                c.execute("DROP TRIGGER IF EXISTS %s" % name)
+                c.execute("CREATE TRIGGER %s %s" % (name, trigger))
+            self.Commit()
+        except Exception as x:
+            self.log.error("failed to create %s: %s" % (counttable, x))
+            try:
+                for name in self._countTriggers():
+                    c.execute("DROP TRIGGER IF EXISTS %s" % name)
+                c.execute("DROP TABLE IF EXISTS %s" % counttable)
+                self.Commit()
+            except Exception:
+                pass
+            return False
+        self.counted = True
+        self.reconcileCounts()
+        return True
+
+    def reconcileCounts(self):
+        '''
+        Correct the count table from the actual counts of rows, in case it
+        drifted (e.g. rows changed while triggers were missing). Keys changed
+        by other transactions while counting are left for the next call.
+        Returns the number of keys corrected.
+        '''
+        if not self.counted:
+            return 0
+        counttable, keys = self.counts[self.table]
+        cols = ", ".join(keys)
+        c = self.db.getCursor()
+        def readcounts():
+            c.execute("SELECT %s, n FROM %s" % (cols, counttable))
+            return dict((tuple(row[k] for k in keys), row['n']) for row in c.fetchall())
+        before = readcounts()
+        nullcols = ", ".join(["COALESCE(%s, '')" % k for k in keys])
+        c.execute("SELECT %s, COUNT(*) AS n FROM %s GROUP BY %s"
+                  % (", ".join(["COALESCE(%s, '') AS %s" % (k, k) for k in keys]), self.table, nullcols))
+        actual = {}
+        for row in c.fetchall():
+            key = tuple(row[k] for k in keys)
+            actual[key] = actual.get(key, 0) + row['n']
+        after = readcounts()
+
+        fixed = 0
+        for key in set(actual) | set(after):
+            drift = actual.get(key, 0) - after.get(key, 0)
+            if not drift or before.get(key, 0) != after.get(key, 0):
+                continue
+            self.log.warning("%s: correcting count of %s by %d" % (counttable, str(key), drift))
+            c.execute("INSERT INTO %s (%s, n) VALUES (%s, %%s) ON DUPLICATE KEY UPDATE n=n+%%s"
+                      % (counttable, cols, ", ".join(['%s'] * len(keys))), list(key) + [drift, drift])
+            fixed += 1
+        c.execute("DELETE FROM %s WHERE n=0" % counttable)
+        self.Commit()
+        return fixed
+
+    def getCounts(self, groupby, **keys):
+        '''
+        Return {value: count} of rows per value of the key column(s) groupby,
+        a column name or a tuple of them (then values are tuples), for rows
+        with the given key column values, e.g.
+          getCounts('arcstate', cluster=cluster, fairshare=share)
+        Values may be lists to match any of them. NULL keys are returned as ''.
+        '''
+        group = (groupby,) if isinstance(groupby, str) else tuple(groupby)
+        where = []
+        params = []
+        for k, v in keys.items():
+            v = list(v) if isinstance(v, (list, tuple, set)) else [v]
+            clause = "%s IN (%s)" % (k, ",".join(['%s'] * len(v))) if v else "FALSE"
+            if '' in v and not self.counted:
+                # NULL keys are counted as '' as in the count table
+                clause = "(%s OR %s IS NULL)" % (clause, k)
+            where.append(clause)
+            params.extend(v)
+        where = " AND ".join(where) or "TRUE"
+        if self.counted:
+            s = "SELECT %s, SUM(n) AS n FROM %s WHERE %s GROUP BY %s" % (", ".join(group), self.counts[self.table][0], where, ", ".join(group))
+        else:
+            # NULL keys are counted as '' as in the count table
+            cols = ["COALESCE(%s, '')" % k for k in group]
+            s = "SELECT %s, COUNT(*) AS n FROM %s WHERE %s GROUP BY %s" \
+                % (", ".join(["%s AS %s" % (col, k) for col, k in zip(cols, group)]), self.table, where, ", ".join(cols))
+        c = self.db.getCursor()
+        c.execute(s, params)
+        counts = {}
+        for row in c.fetchall():
+            key = tuple(row[k] for k in group)
+            key = key[0] if len(group) == 1 else key
+            counts[key] = counts.get(key, 0) + int(row['n'])
+        return counts
+
+    def getCount(self, **keys):
+        '''Return the number of rows with the given key column values, see getCounts()'''
+        groupby = list(keys)[:1] or list(self.counts[self.table][1])[:1]
+        return sum(self.getCounts(groupby, **keys).values())
+
     def getTimeStamp(self, seconds=None):
         if seconds:
             return datetime.datetime.utcfromtimestamp(seconds).isoformat()
@@ -33,19 +370,128 @@ class aCTDB(object):
     def timeStampGreaterThan(self, column, timediff, utc=True):
         return self.db.timeStampGreaterThan(column, timediff, utc)
 
+    def _updateBulkLazy(self, keycolumn, rows):
+        '''
+        Update many rows of the table without committing. rows is a list of
+        (key, desc) where desc is a dictionary of column: value to set on the
+        row(s) where keycolumn=key. Rows setting identical values are updated
+        together with "WHERE keycolumn IN (...)", the rest are grouped by
+        column set and sent with executemany.
+        '''
+        # same timestamp for all rows so they can be grouped
+        modified = self.getTimeStamp()
+        groups = {}
+        for key, desc in rows:
+            desc['modified'] = modified
+            groups.setdefault(tuple(desc.keys()), []).append((key, desc))
+
+        c = self.db.getCursor()
+        for columns, group in groups.items():
+            setcolumns = ",".join(['%s=%%s' % k for k in columns])
+            byvalues = {}
+            single = []
+            for key, desc in group:
+                try:
+                    byvalues.setdefault(tuple(desc.values()), []).append(key)
+                except TypeError: # unhashable value
+                    single.append(list(desc.values()) + [key])
+            for values, keys in byvalues.items():
+                if len(keys) == 1:
+                    single.append(list(values) + keys)
+                    continue
+                for i in range(0, len(keys), 1000):
+                    chunk = keys[i:i+1000]
+                    s = "UPDATE %s SET %s WHERE %s IN (%s)" % (self.table, setcolumns, keycolumn, ",".join(['%s'] * len(chunk)))
+                    c.execute(s, list(values) + chunk)
+            if single:
+                s = "UPDATE %s SET %s WHERE %s=%%s" % (self.table, setcolumns, keycolumn)
+                c.executemany(s, single)
+
+    def _claim(self, select, columns, desc, owner, lease):
+        '''
+        Claim the rows matching select, which should have a limit, by setting
+        desc plus claimedby=owner and claimexpiry lease seconds from now, and
+        commit. Rows locked by other transactions are skipped instead of
+        waited for, so several processes can claim rows concurrently without
+        taking the same ones. Returns the claimed rows with columns, which
+        must include id. Without claim columns (actdbmigrate not run yet)
+        only desc is set.
+        '''
+        where, params = self._where(select)
+        c = self.db.getCursor()
+        c.execute("SELECT "+self._column_list2str(columns)+" FROM "+self.table+" WHERE "+where+self.db.addSkipLock(), params)
+        rows = c.fetchall()
+        if rows:
+            if self.leases:
+                desc = dict(desc, claimedby=owner, claimexpiry=self.getTimeStamp(time.time()+lease))
+            self._updateBulkLazy('id', [(row['id'], dict(desc)) for row in rows])
+        self.Commit()
+        return rows
+
+    def _claimedClause(self, owner, lease, tstatecolumn):
+        '''
+        Return (clause, params...) for aCTDBQuery.raw() selecting rows claimed
+        by owner or whose claim expired. Rows without claim, set by older
+        versions, expire lease seconds after tstatecolumn.
+        '''
+        if not self.leases:
+            # all claims, as they cannot be told apart
+            return ("TRUE",)
+        return ("(claimedby=%s or "+self.timeStampLessThan('claimexpiry', 0)+
+                " or (claimexpiry IS NULL and "+self.timeStampLessThan(tstatecolumn, lease)+"))", owner)
+
+    def notify(self, cluster=None, state=None):
+        '''
+        Mark jobs of cluster (or all clusters if None) as changed to state (or
+        unknown states if None). Listening processes are notified after the
+        next commit.
+        '''
+        self.pendingnotify.add((cluster, state))
+
+    def sendNotifications(self):
+        # {cluster: set of states, None if any state is unknown}
+        changes = {}
+        for (cluster, state) in self.pendingnotify:
+            states = changes.setdefault(cluster, set())
+            if state is None or states is None:
+                changes[cluster] = None
+            else:
+                states.add(state)
+        if None in changes:
+            # all listeners of the table are notified with all the states
+            states = set()
+            for cstates in changes.values():
+                states = None if states is None or cstates is None else states | cstates
+            changes = {None: states}
+        for cluster, states in changes.items():
+            self.notifier.send(self.table, cluster, states)
+        self.pendingnotify.clear()
+
     def Commit(self, lock=False):
         if lock:
             res = self.db.releaseMutexLock(self.table)
             if not res:
                 self.log.warning("Could not release lock: %s" % str(res))
         try:
-            self.db.conn.commit()
+            self.db.commit()
         except Exception as e:
             self.log.error("Exception on commit: %s" % str(e))
+        else:
+            if self.pendingnotify:
+                self.sendNotifications()
         if lock:
             c = self.db.getCursor()
             c.execute("UNLOCK TABLES")
 
+    def Rollback(self):
+        '''Discard changes not committed yet'''
+        try:
+            self.db.rollback()
+        except Exception as e:
+            self.log.error("Exception on rollback: %s" % str(e))
+        self.pendingnotify.clear()
+
     def close(self):
-        self.db.close()
+        self.notifier.close()
+        self.db.release()
 
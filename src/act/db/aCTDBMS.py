@@ -1,5 +1,16 @@
+import os
+import threading
+
+# DB connections shared by all tables used in the same thread, as
+# {(dbtype, pid): db} in thread local storage. The pid keeps forked children
+# from using the connection of the parent thread.
+shared = threading.local()
+
 def getDB(log, config):
-    '''Factory method for getting specific DB implementation'''
+    '''
+    Factory method for getting specific DB implementation. All DB objects
+    created in the same process and thread share the same connection.
+    '''
 
     supported_dbms = {}
 
@@ -22,7 +33,27 @@ def getDB(log, config):
     dbtype = config.get(('db', 'type')).lower()
     if dbtype not in supported_dbms:
         raise Exception("DB type %s is not implemented." % dbtype)
-    return supported_dbms[dbtype](log, config)
+
+    if not hasattr(shared, 'dbs'):
+        shared.dbs = {}
+    key = (dbtype, os.getpid())
+    db = shared.dbs.get(key)
+    if db is None or db.conn is None:
+        db = supported_dbms[dbtype](log, config)
+        db.sharedkey = key
+        db.shareddbs = shared.dbs
+        shared.dbs[key] = db
+    db.refs += 1
+    return db
+
+
+class aCTDBLockError(Exception):
+    '''
+    A statement failed on a deadlock or lock wait timeout which could not be
+    retried and its transaction was rolled back. The agent can carry on and
+    process the same jobs again in its next loop.
+    '''
+    pass
 
 
 class aCTDBMS(object):
@@ -39,8 +70,49 @@ class aCTDBMS(object):
         self.passwd = str(config.get(('db', 'password')))
         self.host =   str(config.get(('db', 'host')))
         self.port =   str(config.get(('db', 'port')))
+        self.conn = None
+        # number of DB objects using this connection
+        self.refs = 0
+        self.sharedkey = None
+        self.shareddbs = {}
+        # counters of DB round trips, rows read or changed, deadlocks and
+        # lock wait timeouts and seconds spent in the DB since last call to
+        # resetStats()
+        self.stats = {'queries': 0, 'commits': 0, 'reconnects': 0, 'rows': 0, 'lockwaits': 0, 'dbtime': 0.0}
+
+    def release(self):
+        '''Release shared connection, closing it when no longer used'''
+        self.refs -= 1
+        if self.refs > 0:
+            return
+        if self.shareddbs.get(self.sharedkey) is self:
+            del self.shareddbs[self.sharedkey]
+        self.close()
+
+    def commit(self):
+        self.stats['commits'] += 1
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
 
-    # Each subclass must implement the 6 methods below
+    def resetStats(self):
+        '''Return counters of DB operations and reset them to zero'''
+        stats = self.stats.copy()
+        for k in self.stats:
+            self.stats[k] = 0
+        return stats
+
+    def executePrepared(self, sql, params):
+        '''
+        Execute sql using a cached server-side prepared statement if the DB
+        supports it. Returns the cursor.
+        '''
+        c = self.getCursor()
+        c.execute(sql, params)
+        return c
+
+    # Each subclass must implement the 7 methods below
     def getCursor(self):
         raise Exception("Method not implemented")
 
@@ -53,6 +125,9 @@ class aCTDBMS(object):
     def addLock(self):
         raise Exception("Method not implemented")
 
+    def addSkipLock(self):
+        raise Exception("Method not implemented")
+
     def getMutexLock(self, lock_name, timeout=2):
         raise Exception("Method not implemented")
 
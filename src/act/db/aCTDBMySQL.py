@@ -1,16 +1,108 @@
+import collections
+import random
+import time
 import mysql.connector as mysql
 from _mysql_connector import MySQLInterfaceError # pylint: disable-msg=E0611
-from act.common import aCTUtils
-from act.db.aCTDBMS import aCTDBMS
+from act.db.aCTDBMS import aCTDBMS, aCTDBLockError
+
+# ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK
+LOCK_WAIT_TIMEOUT = 1205
+LOCK_DEADLOCK = 1213
+
+class aCTCursor:
+    '''
+    Wrapper around a mysql cursor which counts round trips, rows and time
+    spent and records whether statements may have changed data or taken row
+    locks.
+    '''
+
+    def __init__(self, db, cursor):
+        self._db = db
+        self._cursor = cursor
+
+    def _timed(self, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self._db.stats['dbtime'] += time.time() - start
+
+    def _retry(self, func, operation, params, readonly):
+        '''
+        Call func(operation, params), retrying after a deadlock or lock wait
+        timeout, which happen on the hot rows of count tables updated by
+        triggers. InnoDB rolls back only the statement after a lock wait
+        timeout but the whole transaction after a deadlock, so a deadlock is
+        only retried if the statement started the transaction. Otherwise, or
+        after lockretries attempts, aCTDBLockError is raised with the
+        transaction rolled back.
+        '''
+        for attempt in range(self._db.lockretries + 1):
+            # no earlier changes or row locks in this transaction
+            started = not self._db.dirty
+            self._db.countQuery(operation, readonly)
+            try:
+                res = self._timed(func, operation, params)
+            except mysql.Error as err:
+                if err.errno not in (LOCK_WAIT_TIMEOUT, LOCK_DEADLOCK):
+                    raise
+                self._db.stats['lockwaits'] += 1
+                if attempt == self._db.lockretries or (err.errno == LOCK_DEADLOCK and not started):
+                    self._db.rollback()
+                    raise aCTDBLockError("%s in %s" % (str(err), operation[:200])) from err
+                if err.errno == LOCK_DEADLOCK:
+                    self._db.rollback()
+                self._db.log.warning("%s, retrying: %s" % (str(err), operation[:200]))
+                time.sleep(random.uniform(0, 0.1 * 2**attempt))
+                continue
+            self._db.countRows(self._cursor.rowcount)
+            return res
+
+    def execute(self, operation, params=None, readonly=None):
+        '''
+        Execute operation. readonly tells if it neither changes data nor takes
+        row locks, if None it is true for selects without FOR UPDATE.
+        '''
+        return self._retry(self._cursor.execute, operation, params, readonly)
+
+    def executemany(self, operation, seq_params):
+        return self._retry(self._cursor.executemany, operation, seq_params, None)
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        if row is not None:
+            self._db.countRows(1)
+        return row
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._db.countRows(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
 
 class aCTDBMySQL(aCTDBMS):
     """Class for MySQL specific db operations."""
 
+    # max number of cached prepared statements per connection
+    maxprepared = 50
+    # retries of statements failing on a deadlock or lock wait timeout
+    lockretries = 3
+
     def __init__(self, log, config):
         aCTDBMS.__init__(self, log, config)
         # mysql.connector must be 8.
         if mysql.__version_info__[0] != 8:
             raise Exception("mysql-connector must be version 8.x")
+        # True if statements since last commit may have modified data
+        self.dirty = False
+        # cursors of prepared statements keyed by SQL, in LRU order
+        self.prepared = collections.OrderedDict()
         try:
             self._connect(self.dbname)
         except mysql.Error as err:
@@ -26,8 +118,10 @@ class aCTDBMySQL(aCTDBMS):
         self.log.debug("initialized aCTDBMySQL")
 
     def close(self):
+        self.prepared.clear()
         if self.conn is not None:
             self.conn.close()
+            self.conn = None
         if self.log is not None:
             self.log.warning("Database session closed")
 
@@ -39,30 +133,106 @@ class aCTDBMySQL(aCTDBMS):
                 self.conn = mysql.connect(user=self.user, password=self.passwd, host=self.host, port=self.port, database=dbname)
             else:
                 self.conn = mysql.connect(user=self.user, password=self.passwd, db=dbname)
+        # Each statement sees the newest committed state, so it is not
+        # necessary to commit before reading to refresh the snapshot
+        self.conn.cmd_query("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        self.dirty = False
+        self.prepared.clear()
 
-    def getCursor(self):
-        # make sure cursor reads newest db state
+    def _reconnect(self, attempts=5):
+        '''
+        Close the connection and reconnect, backing off exponentially between
+        failed attempts.
+        '''
+        self.stats['reconnects'] += 1
         try:
-            self.conn.commit()
-        except (mysql.errors.InternalError, MySQLInterfaceError) as e:
-            # Unread result, force reconnection
-            self.log.warning(str(e))
             self.conn.close()
-            self._connect(self.dbname)
+        except Exception:
+            pass
+        for i in range(attempts):
+            try:
+                self._connect(self.dbname)
+                return
+            except mysql.Error as err:
+                if i == attempts - 1:
+                    raise err
+                self.log.warning("Failed to reconnect to DB: %s" % str(err))
+                time.sleep(2**i)
+
+    def countQuery(self, operation, readonly=None):
+        self.stats['queries'] += 1
+        if readonly is None:
+            readonly = operation.lstrip()[:6].lower() == 'select' and 'for update' not in operation.lower()
+        if not readonly:
+            self.dirty = True
+
+    def countRows(self, n):
+        # rowcount is -1 for selects until rows are fetched
+        if n > 0:
+            self.stats['rows'] += n
+
+    def commit(self):
+        start = time.time()
+        aCTDBMS.commit(self)
+        self.stats['dbtime'] += time.time() - start
+        self.dirty = False
 
+    def rollback(self):
+        start = time.time()
+        aCTDBMS.rollback(self)
+        self.stats['dbtime'] += time.time() - start
+        self.dirty = False
+
+    def _commitDirty(self):
+        '''
+        Commit if previous statements may have changed data or taken row
+        locks, so that they are released. Reconnects if the connection is
+        broken.
+        '''
+        if self.dirty or self.conn.unread_result:
+            try:
+                self.commit()
+            except (mysql.errors.InternalError, MySQLInterfaceError) as e:
+                # Unread result, force reconnection
+                self.log.warning(str(e))
+                self._reconnect()
+            except mysql.errors.OperationalError as e:
+                # Lost connection
+                self.log.warning(str(e))
+                self._reconnect()
+
+    def getCursor(self):
+        # make sure previous changes are committed and row locks released
+        self._commitDirty()
         for _ in range(3):
             try:
                 cur = self.conn.cursor(dictionary=True)
-                return cur
+                return aCTCursor(self, cur)
             except mysql.errors.OperationalError as err:
                 self.log.warning("Error getting cursor: %s" % str(err))
-                aCTUtils.sleep(1)
                 # Try closing connection and reconnecting
-                self.conn.close()
-                self._connect(self.dbname)
+                self._reconnect()
 
         raise Exception("Could not get cursor")
 
+    def executePrepared(self, sql, params):
+        '''
+        Execute sql using a server-side prepared statement. Statements are
+        cached per connection so they are only parsed once by the server.
+        '''
+        # commit or reconnect if necessary
+        self._commitDirty()
+        c = self.prepared.get(sql)
+        if c is None:
+            c = aCTCursor(self, self.conn.cursor(prepared=True))
+            self.prepared[sql] = c
+            if len(self.prepared) > self.maxprepared:
+                self.prepared.popitem(last=False)[1].close()
+        else:
+            self.prepared.move_to_end(sql)
+        c.execute(sql, params)
+        return c
+
     def timeStampLessThan(self,column,timediff,utc=True):
         # utc should be set to False for columns with auto incremented timestamp
         return f"UNIX_TIMESTAMP({column}) < UNIX_TIMESTAMP({'UTC_TIMESTAMP()' if utc else ''}) - {timediff}"
@@ -74,6 +244,10 @@ class aCTDBMySQL(aCTDBMS):
     def addLock(self):
         return " FOR UPDATE"
 
+    def addSkipLock(self):
+        # lock rows, leaving out rows locked by other transactions
+        return " FOR UPDATE SKIP LOCKED"
+
     def getMutexLock(self, lock_name, timeout=2):
         """
         Function to get named lock. Returns 1 if lock was obtained, 0 if attempt timed out, None if error occured.
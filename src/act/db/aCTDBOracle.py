@@ -23,6 +23,9 @@ class aCTDBOracle(aCTDBMS):
     def addLock(self):
         return " FOR UPDATE"
 
+    def addSkipLock(self):
+        return " FOR UPDATE SKIP LOCKED"
+
     def getMutexLock(self, lock_name, timeout=2):
         """
         Function to get named lock. Returns 1 if lock was obtained, 0 if attempt timed out, None if error occured.
@@ -0,0 +1,78 @@
+import functools
+
+@functools.lru_cache(maxsize=256)
+def _compile(clauses, orderby, limit):
+    '''Build the SQL text of a query shape. Cached since agents issue the same shapes every loop'''
+    sql = " and ".join(clauses) if clauses else "TRUE"
+    if orderby:
+        sql += " ORDER BY " + ", ".join(orderby)
+    if limit:
+        sql += " LIMIT %s"
+    return sql
+
+
+class aCTDBQuery:
+    '''
+    Builder for WHERE clauses with bound parameters. Values are never put in
+    the SQL text, so identical queries have identical text and can be served
+    by cached prepared statements. Methods return self so calls can be chained:
+
+      q = aCTDBQuery().eq('arcstate', 'tosubmit').eq('cluster', cluster).limit(100)
+      db.getArcJobsInfo(q, ['id'])
+
+    raw() adds an arbitrary clause, which must use %s for any values, e.g.
+    raw(db.timeStampLessThan('tarcstate', '%s'), 3600). The DB methods
+    accepting a select string also accept an aCTDBQuery.
+    '''
+
+    def __init__(self):
+        self.clauses = []
+        self.params = []
+        self.orderby = []
+        self.nlimit = None
+
+    def raw(self, clause, *params):
+        self.clauses.append(clause)
+        self.params.extend(params)
+        return self
+
+    def eq(self, column, value):
+        return self.raw('%s=%%s' % column, value)
+
+    def ne(self, column, value):
+        return self.raw('%s!=%%s' % column, value)
+
+    def like(self, column, pattern):
+        return self.raw('%s LIKE %%s' % column, pattern)
+
+    def isin(self, column, values):
+        values = list(values)
+        if not values:
+            return self.raw('FALSE')
+        return self.raw('%s IN (%s)' % (column, ','.join(['%s'] * len(values))), *values)
+
+    def order(self, column, desc=False):
+        self.orderby.append('%s%s' % (column, ' DESC' if desc else ''))
+        return self
+
+    def limit(self, n):
+        self.nlimit = int(n)
+        return self
+
+    def copy(self):
+        q = aCTDBQuery()
+        q.clauses = list(self.clauses)
+        q.params = list(self.params)
+        q.orderby = list(self.orderby)
+        q.nlimit = self.nlimit
+        return q
+
+    def sql(self):
+        '''Return the WHERE clause text, including ORDER BY and LIMIT'''
+        return _compile(tuple(self.clauses), tuple(self.orderby), self.nlimit is not None)
+
+    def values(self):
+        '''Return the parameters to bind to sql()'''
+        if self.nlimit is not None:
+            return self.params + [self.nlimit]
+        return list(self.params)
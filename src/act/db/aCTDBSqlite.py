@@ -36,6 +36,10 @@ class aCTDBSqlite(aCTDBMS):
         # SQLite does not support row locking
         return ""
 
+    def addSkipLock(self):
+        # SQLite does not support row locking
+        return ""
+
     def getMutexLock(self):
         # SQLite does not support mutex locking
         return
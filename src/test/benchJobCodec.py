@@ -0,0 +1,45 @@
+#!/usr/bin/python
+#
+# Time conversions between arc.Job and arcjobs rows done by aCTJobCodec for
+# a status cycle over many jobs. Usage: benchJobCodec.py [njobs]
+#
+
+import sys
+import time
+import arc
+from act.arc import aCTJobCodec
+
+njobs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+start = time.time()
+codec = aCTJobCodec.codec()
+print('Codec built in %.3fs, %d columns' % (time.time() - start, len(codec.columns)))
+
+job = arc.Job()
+job.JobID = 'https://arc.example.org:443/arex/rest/1.0/jobs/aBcDeFgHiJkLmNoP'
+job.Name = 'mc16_13TeV.123456.evgen.é'
+job.State = arc.JobState('Running', arc.JobState.RUNNING)
+job.RequestedSlots = 8
+job.ExecutionNode.append('wn001.example.org')
+job.Error.append('first error')
+job.Error.append('second error')
+job.SubmissionTime = arc.Time()
+job.LocalIDFromManager = '123456'
+job.ActivityOldID.append('old1')
+
+row = codec.job2db(job)
+rows = [dict(row) for i in range(njobs)]
+
+start = time.time()
+jobs = [codec.db2job(r) for r in rows]
+t = time.time() - start
+print('db2job: %d jobs in %.3fs, %.1fus per job' % (njobs, t, t / njobs * 1e6))
+
+start = time.time()
+for j in jobs:
+    codec.job2db(j)
+t = time.time() - start
+print('job2db: %d jobs in %.3fs, %.1fus per job' % (njobs, t, t / njobs * 1e6))
+
+# round trip must be stable
+assert codec.job2db(codec.db2job(row)) == row, 'round trip changed the row'
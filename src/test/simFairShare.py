@@ -0,0 +1,60 @@
+#!/usr/bin/python
+#
+# Replay a job mix through aCTFairShare as aCTSubmitter would for one cluster
+# and print the jobs submitted per share against their weights.
+# Usage: simFairShare.py [cycles]
+#
+
+import logging
+import random
+import sys
+from act.arc.aCTFairShare import aCTFairShare
+
+cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+class Conf:
+    '''Minimal stand-in for aCTConfigARC'''
+    weights = {'production': 3, 'analysis': 1, 'test': 0.5}
+    def get(self, path):
+        return {('fairshare', 'quantum'): '10', ('fairshare', 'defaultweight'): '1'}.get(tuple(path))
+    def getCond(self, path, cond, nodes):
+        w = self.weights.get(cond.split('=', 1)[1])
+        return None if w is None else str(w)
+
+logging.basicConfig(level=logging.INFO)
+random.seed(1)
+scheduler = aCTFairShare(logging.getLogger('simFairShare'), Conf())
+
+# share: (jobs arriving per cycle, jobs waiting)
+mix = {('production', 1): [40, 0],
+       ('analysis', 2): [40, 0],
+       ('test', 1): [2, 0],        # short of jobs, should not hold slots
+       ('unlisted', 3): [40, 0]}
+slots = 2000
+qfraction, qoffset = 0.15, 100
+queued = running = 0
+submitted = dict.fromkeys(mix, 0)
+
+for cycle in range(cycles):
+    for share in mix:
+        mix[share][1] += mix[share][0]
+    # jobs start and finish
+    starting = min(queued, max(slots - running, 0), 150)
+    queued -= starting
+    running += starting - int(running * 0.05)
+    free = max(0, int(running * qfraction + qoffset) - queued)
+    for share, n in scheduler.schedule(dict((s, v[1]) for s, v in mix.items()), free):
+        # some submissions fail
+        ok = sum(random.random() > 0.05 for i in range(n))
+        scheduler.charge(share, ok)
+        mix[share][1] -= ok
+        submitted[share] += ok
+        queued += ok
+
+total = sum(submitted.values())
+weights = dict((s, scheduler.weight(s)) for s in mix)
+print('%d cycles, %d jobs submitted, %d running, %d queued' % (cycles, total, running, queued))
+print('%-14s %8s %10s %8s %8s' % ('share', 'weight', 'submitted', 'share', 'waiting'))
+for share in mix:
+    print('%-14s %8.1f %10d %7.1f%% %8d' % ('%s/%s' % share, weights[share], submitted[share],
+                                            100.0 * submitted[share] / max(total, 1), mix[share][1]))